@@ -0,0 +1,285 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/main/python/conveyor/binary.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A compact binary encoding for the JSON data model.
+
+Every value starts with a one byte tag:
+
+    N               null
+    T               true
+    F               false
+    I <varint>      integer (zigzag encoded)
+    D <8 bytes>     floating point number (IEEE 754, big-endian)
+    S <varint> ...  string (length in bytes, then UTF-8)
+    L <varint> ...  array (element count, then the elements)
+    M <varint> ...  object (member count, then key and value pairs)
+
+Object keys are not tagged. A key is either a varint `n + 1` followed by `n`
+bytes of UTF-8 (the first occurrence of the key in the message) or `0x00`
+followed by a varint index into the keys seen so far. The conveyor service sends lists
+of jobs and printers that repeat the same keys many times over.
+
+The values decode to the same types as `json.loads` produces: `unicode`
+strings, `list` arrays, and `dict` objects. Non-string keys are converted to
+strings the way JSON converts them and `decimal.Decimal` values are sent as
+floating point numbers.
+
+'''
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import decimal
+import struct
+
+import conveyor.json
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+_DOUBLE = struct.Struct(str('>d'))
+
+# The single byte varints, indexed by value.
+_SMALL = [chr(i) for i in range(128)]
+
+
+def _writevarint(chunks, value):
+    if 128 > value:
+        chunks.append(_SMALL[value])
+    else:
+        data = bytearray()
+        while 128 <= value:
+            data.append(0x80 | (value & 0x7f))
+            value >>= 7
+        data.append(value)
+        chunks.append(bytes(data))
+
+
+def _writekey(chunks, keys, key):
+    if None is key:
+        key = 'null'
+    elif not isinstance(key, basestring):
+        key = unicode(key)
+    index = keys.get(key)
+    if None is not index:
+        chunks.append(b'\x00')
+        _writevarint(chunks, index)
+    else:
+        keys[key] = len(keys)
+        data = key.encode('UTF-8')
+        # NOTE: the length is off by one so that zero marks a reference, even
+        # for the empty key.
+        _writevarint(chunks, len(data) + 1)
+        chunks.append(data)
+
+
+def _write(chunks, keys, obj):
+    # NOTE: the common types are tested first. `bool` must be tested before
+    # the integer types since it is a subclass of `int`.
+    if isinstance(obj, basestring):
+        if isinstance(obj, unicode):
+            data = obj.encode('UTF-8')
+        else:
+            data = obj.decode('UTF-8').encode('UTF-8')
+        chunks.append(b'S')
+        _writevarint(chunks, len(data))
+        chunks.append(data)
+    elif isinstance(obj, dict):
+        chunks.append(b'M')
+        _writevarint(chunks, len(obj))
+        for key, value in obj.iteritems():
+            _writekey(chunks, keys, key)
+            _write(chunks, keys, value)
+    elif isinstance(obj, (list, tuple)):
+        chunks.append(b'L')
+        _writevarint(chunks, len(obj))
+        for value in obj:
+            _write(chunks, keys, value)
+    elif None is obj:
+        chunks.append(b'N')
+    elif True is obj:
+        chunks.append(b'T')
+    elif False is obj:
+        chunks.append(b'F')
+    elif isinstance(obj, (int, long)):
+        chunks.append(b'I')
+        if 0 <= obj:
+            _writevarint(chunks, obj << 1)
+        else:
+            _writevarint(chunks, ((-obj) << 1) - 1)
+    elif isinstance(obj, (float, decimal.Decimal)):
+        chunks.append(b'D')
+        chunks.append(_DOUBLE.pack(float(obj)))
+    else:
+        raise TypeError('%r is not serializable' % (obj,))
+
+
+def dumps(obj):
+    '''Encode `obj` and return the result as a `str`.'''
+
+    chunks = []
+    _write(chunks, {}, obj)
+    result = b''.join(chunks)
+    return result
+
+
+class _Reader(object):
+    def __init__(self, data):
+        self._data = data
+        self._offset = 0
+        self._keys = []
+
+    def _readbyte(self):
+        try:
+            value = ord(self._data[self._offset])
+        except IndexError:
+            raise ValueError('truncated data')
+        self._offset += 1
+        return value
+
+    def _readvarint(self):
+        value = self._readbyte()
+        if 128 <= value:
+            value &= 0x7f
+            shift = 7
+            while True:
+                byte = self._readbyte()
+                value |= (byte & 0x7f) << shift
+                if 128 > byte:
+                    break
+                shift += 7
+        return value
+
+    def _readbytes(self, size):
+        end = self._offset + size
+        if len(self._data) < end:
+            raise ValueError('truncated data')
+        result = self._data[self._offset:end]
+        self._offset = end
+        return result
+
+    def _readkey(self):
+        size = self._readvarint()
+        if 0 == size:
+            index = self._readvarint()
+            if len(self._keys) <= index:
+                raise ValueError('invalid key reference: %d' % (index,))
+            key = self._keys[index]
+        else:
+            key = self._readbytes(size - 1).decode('UTF-8')
+            self._keys.append(key)
+        return key
+
+    def read(self):
+        tag = self._readbytes(1)
+        if b'S' == tag:
+            size = self._readvarint()
+            result = self._readbytes(size).decode('UTF-8')
+        elif b'M' == tag:
+            count = self._readvarint()
+            result = {}
+            for i in xrange(count):
+                key = self._readkey()
+                result[key] = self.read()
+        elif b'L' == tag:
+            count = self._readvarint()
+            result = [self.read() for i in xrange(count)]
+        elif b'I' == tag:
+            value = self._readvarint()
+            if 0 == value & 1:
+                result = value >> 1
+            else:
+                result = -((value + 1) >> 1)
+        elif b'D' == tag:
+            result, = _DOUBLE.unpack(self._readbytes(_DOUBLE.size))
+        elif b'N' == tag:
+            result = None
+        elif b'T' == tag:
+            result = True
+        elif b'F' == tag:
+            result = False
+        else:
+            raise ValueError('invalid tag: %r' % (tag,))
+        return result
+
+    def readall(self):
+        result = self.read()
+        if len(self._data) != self._offset:
+            raise ValueError('extra data')
+        return result
+
+
+def loads(data):
+    '''
+    Decode a `str` produced by `dumps`. Raises a `ValueError` if the data is
+    not valid.
+
+    '''
+
+    reader = _Reader(data)
+    result = reader.readall()
+    return result
+
+
+class _BinaryTestCase(unittest.TestCase):
+    _VALUES = [
+        None, True, False, 0, 1, -1, 63, 64, -64, -65, 127, 128, 300,
+        2 ** 40, -(2 ** 40), 2 ** 70, 0.5, -1e300, '', 'abc', 'é中',
+        [], [1, [2, [3]]], {}, {'a': 1, 'b': {'a': 2, 'c': [{'a': None}]}},
+        {'': 1}, [{'': 1}, {'': 2}],
+    ]
+
+    def test_roundtrip(self):
+        '''Test that values decode to what they were encoded from.'''
+
+        for value in self._VALUES:
+            self.assertEqual(value, loads(dumps(value)))
+
+    def test_json(self):
+        '''Test that values decode to what JSON would decode them to.'''
+
+        value = {2: (b'x', 0.25), True: [{None: 1}]}
+        self.assertEqual(
+            conveyor.json.loads(conveyor.json.dumps(value)),
+            loads(dumps(value)))
+        self.assertEqual(0.25, loads(dumps(decimal.Decimal('0.25'))))
+
+    def test_keys(self):
+        '''Test that repeated keys are sent only once.'''
+
+        jobs = [{'conclusion': None, 'progress': i} for i in range(100)]
+        data = dumps(jobs)
+        self.assertEqual(1, data.count(b'conclusion'))
+        self.assertEqual(jobs, loads(data))
+
+    def test_loads_ValueError(self):
+        data = dumps({'a': ['b', 1.5]})
+        for i in range(len(data)):
+            with self.assertRaises(ValueError):
+                loads(data[:i])
+        for data in (b'X', b'NN', b'M\x01\x00\x05N'):
+            with self.assertRaises(ValueError):
+                loads(data)
+
+    def test_dumps_TypeError(self):
+        with self.assertRaises(TypeError):
+            dumps(object())
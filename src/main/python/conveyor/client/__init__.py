@@ -30,7 +30,9 @@ import textwrap
 import time
 
 import conveyor.arg
+import conveyor.client.session
 import conveyor.domain
+import conveyor.error
 import conveyor.job
 import conveyor.jsonrpc
 import conveyor.main
@@ -59,6 +61,25 @@ class _ClientCommand(conveyor.main.Command):
             profile_name = self._config.get('client', 'profile')
         return profile_name
 
+    def _get_hello_params(self):
+        '''
+        Returns the framings, codecs, and compressions to offer in `hello`.
+
+        '''
+
+        framing = self._config.get('client', 'framing')
+        if 'stream' == framing:
+            result = (), (), ()
+        else:
+            codec = self._config.get('client', 'codec')
+            compression = self._config.get('client', 'compression')
+            if 'none' == compression:
+                compressions = ()
+            else:
+                compressions = (compression,)
+            result = (framing,), (codec,), compressions
+        return result
+
 
 class _JsonRpcCommand(_ClientCommand):
     '''
@@ -89,13 +110,28 @@ class _JsonRpcCommand(_ClientCommand):
             self._jsonrpc = conveyor.jsonrpc.JsonRpc(
                 self._connection, self._connection)
             self._export_methods()
-            hello_task = self._jsonrpc.request('hello', {})
-            hello_task.stoppedevent.attach(
-                self._guard_callback(self._hello_callback))
-            hello_task.start()
+            framings, codecs, compressions = self._get_hello_params()
+            self._start_hello(framings, codecs, compressions)
             self._jsonrpc.run()
         return self._code
 
+    def _start_hello(self, framings, codecs, compressions):
+        hello_task = self._jsonrpc.hello(framings, codecs, compressions)
+        guard = self._guard_callback(self._hello_callback)
+        def callback(hello_task):
+            if (0 != len(framings)
+                    and conveyor.task.TaskConclusion.FAILED == hello_task.conclusion
+                    and isinstance(hello_task.failure, dict)
+                    and -32602 == hello_task.failure.get('code')):
+                # NOTE: older versions of the conveyor service do not accept
+                # any parameters for `hello`. Fall back to the stream framing.
+                self._log.debug('framing negotiation not supported')
+                self._start_hello((), (), ())
+            else:
+                guard(hello_task)
+        hello_task.stoppedevent.attach(callback)
+        hello_task.start()
+
     def _pid_file_exists(self):
         pid_file = self._config.get('common', 'pid_file')
         result = os.path.exists(pid_file)
@@ -108,15 +144,17 @@ class _JsonRpcCommand(_ClientCommand):
 
         '''
 
-    def _guard_callback(self, callback):
+    def _guard_callback(self, callback, check=None):
         '''
-        Creates a new callback that invokes `_check_task` and then invokes
-        `callback` only if `_check_task` returns `True`. This reduces some
+        Creates a new callback that invokes `_check_task` (or `check`) and then
+        invokes `callback` only if it returns `True`. This reduces some
         repetitive code.
 
         '''
+        if None is check:
+            check = self._check_task
         def guard(task):
-            if self._check_task(task):
+            if check(task):
                 def func():
                     try:
                         callback(task)
@@ -256,6 +294,28 @@ class _MonitorCommand(_MethodCommand):
     def _export_methods(self):
         self._jsonrpc.addmethod('jobchanged', self._job_changed)
 
+    def _hello_callback(self, hello_task):
+        # NOTE: the command only needs job notifications; there is no need for
+        # the conveyor service to send it temperatures and the like.
+        params = {'notifications': ['jobchanged']}
+        subscribe_task = self._jsonrpc.request('subscribe', params)
+        def check(subscribe_task):
+            if conveyor.task.TaskConclusion.FAILED == subscribe_task.conclusion:
+                # NOTE: older versions of the conveyor service do not support
+                # `subscribe`; they send every notification, which works just
+                # as well.
+                self._log.debug('subscriptions not supported')
+                result = True
+            else:
+                result = self._check_task(subscribe_task)
+            return result
+        subscribe_task.stoppedevent.attach(
+            self._guard_callback(self._subscribe_callback, check))
+        subscribe_task.start()
+
+    def _subscribe_callback(self, subscribe_task):
+        _MethodCommand._hello_callback(self, subscribe_task)
+
     def _job_changed(self, *args, **kwargs):
         '''
         Invoked by the conveyor service to inform the client that a job has
@@ -314,7 +374,7 @@ class _ConnectedCommand(_MonitorCommand):
         _MonitorCommand.__init__(self, parsed_args, config)
         self._machine_name = None
 
-    def _hello_callback(self, hello_task):
+    def _subscribe_callback(self, subscribe_task):
         # NOTE: this method doesn't use the `_get_driver_name` nor
         # `_get_profile_name` as the driver and profile can often be detected
         # automatically.
@@ -338,6 +398,98 @@ class _ConnectedCommand(_MonitorCommand):
         method_task.start()
 
 
+@args(conveyor.arg.positional_input_file)
+class BatchCommand(_ClientCommand):
+    '''
+    Sends every request in a file over one connection without waiting for the
+    previous request to finish. Each line of the file is a JSON-RPC method
+    name, optionally followed by its parameters as JSON:
+
+        getjobs
+        slice {"inputpath": "/tmp/a.stl", "outputpath": "/tmp/a.gcode", ...}
+
+    Blank lines and lines that start with `#` are ignored. A request that
+    returns a job waits for the job to stop. One JSON object is printed per
+    request, in order.
+
+    '''
+
+    name = 'batch'
+
+    help = 'send the requests in INPUT-FILE (use - for stdin)'
+
+    def run(self):
+        try:
+            if '-' == self._parsed_args.input_file:
+                requests = self._read_requests(sys.stdin)
+            else:
+                with open(self._parsed_args.input_file) as fp:
+                    requests = self._read_requests(fp)
+        except conveyor.error.BatchSyntaxException as e:
+            code = e.handle(self._log)
+        else:
+            address = self._config.get('common', 'address')
+            framings, codecs, compressions = self._get_hello_params()
+            try:
+                session = conveyor.client.session.Session.connect(
+                    address, framings, codecs, compressions)
+            except EnvironmentError as e:
+                self._log.critical(
+                    'failed to connect to address: %s: %s',
+                    address, e.strerror, exc_info=True)
+                code = 1
+            else:
+                with session:
+                    code = self._run_requests(session, requests)
+        return code
+
+    def _read_requests(self, fp):
+        requests = []
+        for number, line in enumerate(fp, 1):
+            line = line.strip()
+            if 0 != len(line) and not line.startswith('#'):
+                fields = line.split(None, 1)
+                method = fields[0]
+                if 1 == len(fields):
+                    params = {}
+                else:
+                    try:
+                        params = json.loads(fields[1])
+                    except ValueError as e:
+                        raise conveyor.error.BatchSyntaxException(
+                            number, unicode(e))
+                requests.append((method, params))
+        return requests
+
+    def _run_requests(self, session, requests):
+        futures = [
+            session.request(method, params) for method, params in requests]
+        code = 0
+        for (method, params), future in zip(requests, futures):
+            output = {'method': method}
+            try:
+                result = future.result()
+                if self._is_job(result):
+                    job = session.waitforjob(result['id']).result()
+                    result = job.to_dict()
+                    if conveyor.task.TaskConclusion.ENDED != job.conclusion:
+                        code = 1
+            except conveyor.error.RequestFailedException as e:
+                output['error'] = e.failure
+                code = 1
+            else:
+                output['result'] = result
+            json.dump(output, sys.stdout)
+            print()
+            sys.stdout.flush()
+        return code
+
+    def _is_job(self, result):
+        result = (isinstance(result, dict) and 'id' in result
+            and 'state' in result and 'conclusion' in result)
+        return result
+
+
 @args(conveyor.arg.positional_job)
 class CancelCommand(_MethodCommand):
     name = 'cancel'
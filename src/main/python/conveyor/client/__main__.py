@@ -29,6 +29,7 @@ import conveyor.main
 from conveyor.decorator import command
 
 
+@command(conveyor.client.BatchCommand)
 @command(conveyor.client.CancelCommand)
 @command(conveyor.client.ConnectCommand)
 @command(conveyor.client.CompatibleFirmware)
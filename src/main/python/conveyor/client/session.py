@@ -0,0 +1,508 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/main/python/conveyor/client/session.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A client library that keeps one connection to the conveyor service open for
+any number of requests.
+
+    session = Session.connect(address)
+    futures = [session.request('getjob', {'id': id}) for id in ids]
+    jobs = [future.result() for future in futures]
+    job = session.waitforjob(job_id).result()
+    with open('/tmp/bunny.stl', 'rb') as fp:
+        upload = session.upload(fp, 'bunny.stl')
+    session.close()
+
+Requests are pipelined: `request` returns a `Future` right away and any number
+of requests may be outstanding. The tasks behind the futures are driven by the
+event queue, so something must run it (i.e., the event threads that
+`conveyor.main.AbstractMain` starts, or `Session.connect(..., eventthread=True)`
+for a script that has none; the session then has an event queue of its own).
+
+`upload` sends a file to the conveyor service in chunks; the result's id is
+passed as `{"upload": id}` in place of an input file.
+
+'''
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import base64
+import collections
+import hashlib
+import socket
+import threading
+
+import conveyor.error
+import conveyor.event
+import conveyor.job
+import conveyor.jsonrpc
+import conveyor.log
+import conveyor.task
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class Future(object):
+    '''The eventual result of a request or a job.'''
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._log = conveyor.log.getlogger(self)
+
+    @classmethod
+    def fromtask(cls, task):
+        future = cls()
+        task.stoppedevent.attach(future._taskstopped)
+        return future
+
+    def _taskstopped(self, task):
+        if conveyor.task.TaskConclusion.ENDED == task.conclusion:
+            self.setresult(task.result)
+        elif conveyor.task.TaskConclusion.FAILED == task.conclusion:
+            self.setexception(
+                conveyor.error.RequestFailedException(task.failure))
+        else:
+            self.setexception(
+                conveyor.error.RequestFailedException('canceled'))
+
+    def done(self):
+        with self._condition:
+            result = self._done
+        return result
+
+    def result(self, timeout=None):
+        '''
+        Waits for the result and returns it. Raises the request's
+        `RequestFailedException` or a `RequestTimeoutException`.
+
+        '''
+
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise conveyor.error.RequestTimeoutException(timeout)
+            elif None is not self._exception:
+                raise self._exception
+            else:
+                return self._result
+
+    def adddonecallback(self, func):
+        '''Calls `func(future)` once the future is done.'''
+
+        with self._condition:
+            done = self._done
+            if not done:
+                self._callbacks.append(func)
+        if done:
+            func(self)
+
+    def setresult(self, result):
+        self._finish(result, None)
+
+    def setexception(self, exception):
+        self._finish(None, exception)
+
+    def _finish(self, result, exception):
+        with self._condition:
+            if self._done:
+                callbacks = []
+            else:
+                self._done = True
+                self._result = result
+                self._exception = exception
+                callbacks = self._callbacks
+                self._callbacks = []
+                self._condition.notify_all()
+        for func in callbacks:
+            conveyor.error.guard(self._log, lambda: func(self))
+
+
+class Session(object):
+    '''A connection to the conveyor service that stays open.'''
+
+    @classmethod
+    def connect(
+            cls, address, framings=('length',), codecs=('json',),
+            compressions=('zlib',), eventthread=False, timeout=30.0):
+        '''
+        Connects to the conveyor service at `address` (a `conveyor.address`
+        address) and waits for `hello`.
+
+        '''
+
+        connection = address.connect()
+        session = cls(connection, eventthread)
+        try:
+            session.start(framings, codecs, compressions, timeout)
+        except:
+            session.close()
+            raise
+        return session
+
+    def __init__(self, connection, eventthread=False):
+        self._connection = connection
+        self._log = conveyor.log.getlogger(self)
+        if eventthread:
+            # NOTE: stopping an event queue stops every thread that runs it,
+            # so the session's thread runs a private queue that `close` can
+            # stop.
+            eventqueue = conveyor.event.EventQueue()
+            self._eventthread = conveyor.event.EventQueueThread(
+                eventqueue, 'session_event_thread')
+            self._eventthread.daemon = True
+        else:
+            eventqueue = None
+            self._eventthread = None
+        self._jsonrpc = conveyor.jsonrpc.JsonRpc(
+            connection, connection, eventqueue=eventqueue)
+        self._jsonrpc.addmethod('jobchanged', self._jobchanged)
+        self._thread = threading.Thread(target=self._run, name='session')
+        self._thread.daemon = True
+        self._lock = threading.Lock()
+        self._waiters = collections.defaultdict(list)
+        self._requests = set()
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def start(self, framings=(), codecs=(), compressions=(), timeout=30.0):
+        '''Starts reading the connection and says `hello`.'''
+
+        if None is not self._eventthread:
+            self._eventthread.start()
+        self._thread.start()
+        future = self._hello(framings, codecs, compressions)
+        try:
+            future.result(timeout)
+        except conveyor.error.RequestFailedException as e:
+            if (0 != len(framings) and isinstance(e.failure, dict)
+                    and -32602 == e.failure.get('code')):
+                # NOTE: older versions of the conveyor service do not accept
+                # any parameters for `hello`.
+                self._hello((), (), ()).result(timeout)
+            else:
+                raise
+
+    def _hello(self, framings, codecs, compressions):
+        task = self._jsonrpc.hello(framings, codecs, compressions)
+        future = Future.fromtask(task)
+        task.start()
+        return future
+
+    def _run(self):
+        try:
+            self._jsonrpc.run()
+        finally:
+            self._lost()
+
+    def close(self):
+        self._jsonrpc.stop()
+        if self._thread.is_alive():
+            self._thread.join(1.0)
+        if None is not self._eventthread and self._eventthread.is_alive():
+            self._eventthread.stop()
+        self._lost()
+
+    def _lost(self):
+        '''
+        Fails everything that waits for the conveyor service once the
+        connection is gone; no reply can arrive anymore.
+
+        '''
+
+        with self._lock:
+            self._closed = True
+            waiters = self._waiters
+            self._waiters = collections.defaultdict(list)
+            requests = self._requests
+            self._requests = set()
+        for futures in waiters.values():
+            for future in futures:
+                future.setexception(
+                    conveyor.error.RequestFailedException('closed'))
+        for future in requests:
+            future.setexception(
+                conveyor.error.RequestFailedException('closed'))
+
+    def wait(self, timeout=None):
+        '''Waits for the connection to close and returns whether it did.'''
+
+        self._thread.join(timeout)
+        result = not self._thread.is_alive()
+        return result
+
+    def addmethod(self, method, func):
+        '''Handles notifications (or requests) from the conveyor service.'''
+
+        self._jsonrpc.addmethod(method, func)
+
+    def request(self, method, params=None):
+        '''Sends a request and returns a `Future` for its result.'''
+
+        if None is params:
+            params = {}
+        task = self._jsonrpc.request(method, params)
+        future = Future.fromtask(task)
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._requests.add(future)
+        if closed:
+            future.setexception(
+                conveyor.error.RequestFailedException('closed'))
+        else:
+            future.adddonecallback(self._requestdone)
+            task.start()
+        return future
+
+    def _requestdone(self, future):
+        with self._lock:
+            self._requests.discard(future)
+
+    def upload(self, fp, name, upload_id=None, timeout=30.0):
+        '''
+        Uploads the content of the file object `fp` (from its start) and
+        returns the finished upload. With `upload_id` it resumes an upload
+        that was interrupted, from wherever the conveyor service left off.
+        This waits for the replies, so it must not be called on an event
+        queue thread.
+
+        '''
+
+        if None is upload_id:
+            upload = self.request('beginupload', {'name': name}).result(timeout)
+        else:
+            upload = self.request('getupload', {'id': upload_id}).result(
+                timeout)
+        chunk_limit = upload['chunk_limit']
+        window = max(1, upload['window'] // chunk_limit)
+        sha256 = hashlib.sha256()
+        remaining = upload['offset']
+        while 0 < remaining:
+            data = fp.read(min(remaining, chunk_limit))
+            if 0 == len(data):
+                raise conveyor.error.RequestFailedException('short file')
+            sha256.update(data)
+            remaining -= len(data)
+        offset = upload['offset']
+        pending = collections.deque()
+        while True:
+            data = fp.read(chunk_limit)
+            if 0 == len(data):
+                break
+            sha256.update(data)
+            params = {
+                'id': upload['id'],
+                'offset': offset,
+                'data': base64.b64encode(data),
+            }
+            pending.append(self.request('uploadchunk', params))
+            offset += len(data)
+            # NOTE: at most `window` chunks are waiting for a reply; this is
+            # the backpressure that keeps a fast client from flooding the
+            # service.
+            while window <= len(pending):
+                pending.popleft().result(timeout)
+        while 0 != len(pending):
+            pending.popleft().result(timeout)
+        result = self.request('finishupload', {'id': upload['id']}).result(
+            timeout)
+        if sha256.hexdigest() != result['sha256']:
+            self.request('cancelupload', {'id': upload['id']})
+            raise conveyor.error.RequestFailedException('corrupt upload')
+        return result
+
+    def waitforjob(self, job_id):
+        '''
+        Returns a `Future` for the `conveyor.job.JobInfo` of a job once it
+        stops (the caller checks its conclusion).
+
+        '''
+
+        future = Future()
+        with self._lock:
+            self._waiters[job_id].append(future)
+        # NOTE: the job may have stopped before the future was registered, in
+        # which case there will not be another `jobchanged`.
+        getjob = self.request('getjob', {'id': job_id})
+        def callback(getjob):
+            try:
+                job = conveyor.job.JobInfo.from_dict(getjob.result())
+            except conveyor.error.RequestFailedException as e:
+                self._jobfailed(job_id, e)
+            else:
+                if conveyor.task.TaskState.STOPPED == job.state:
+                    self._jobstopped(job)
+        getjob.adddonecallback(callback)
+        return future
+
+    def _jobchanged(self, *args, **kwargs):
+        job = conveyor.job.JobInfo.from_dict(kwargs)
+        if conveyor.task.TaskState.STOPPED == job.state:
+            self._jobstopped(job)
+
+    def _jobstopped(self, job):
+        with self._lock:
+            futures = self._waiters.pop(job.id, [])
+        for future in futures:
+            future.setresult(job)
+
+    def _jobfailed(self, job_id, exception):
+        with self._lock:
+            futures = self._waiters.pop(job_id, [])
+        for future in futures:
+            future.setexception(exception)
+
+
+class _SessionTestCase(unittest.TestCase):
+    def setUp(self):
+        import conveyor.connection
+        clientsock, serversock = socket.socketpair()
+        self._serverconnection = conveyor.connection.SocketConnection(
+            serversock, None)
+        self._server = conveyor.jsonrpc.JsonRpc(
+            self._serverconnection, self._serverconnection)
+        self._jobs = {}
+        self._server.addmethod(
+            'hello', lambda framing=None, codec=(), compression=():
+                self._server.negotiate(framing, codec, compression))
+        self._server.addmethod('echo', lambda value: value)
+        self._server.addmethod('getjob', lambda id: self._jobs[id])
+        import conveyor.upload
+        self._uploads = conveyor.upload.UploadManager.create('', 1024, 8, 60.0)
+        def upload_result(dct):
+            dct['chunk_limit'] = 8
+            dct['window'] = 32
+            return dct
+        self._server.addmethod(
+            'beginupload', lambda name:
+                upload_result(self._uploads.begin(name).to_dict()))
+        self._server.addmethod(
+            'getupload', lambda id:
+                upload_result(self._uploads.get(id).to_dict()))
+        self._server.addmethod(
+            'uploadchunk', lambda id, offset, data:
+                self._uploads.write(id, offset, base64.b64decode(data)))
+        self._server.addmethod(
+            'finishupload', lambda id: self._uploads.finish(id))
+        self._serverthread = threading.Thread(target=self._server.run)
+        self._serverthread.start()
+        self._session = Session(
+            conveyor.connection.SocketConnection(clientsock, None), True)
+        self._session.start(('length',), ('json',), ('zlib',))
+
+    def tearDown(self):
+        self._session.close()
+        self._server.stop()
+        self._serverthread.join(5.0)
+        self._uploads.close()
+
+    def _job(self, id, state):
+        job = conveyor.job.JobInfo(
+            'SLICE', id, 'bunny', state, None, None, None, None, None, None,
+            None)
+        if conveyor.task.TaskState.STOPPED == state:
+            job.conclusion = conveyor.task.TaskConclusion.ENDED
+        return job.to_dict()
+
+    def test_request(self):
+        '''Test that many requests can be outstanding at once.'''
+
+        futures = [self._session.request('echo', [i]) for i in range(100)]
+        self.assertEqual(
+            list(range(100)), [future.result(5.0) for future in futures])
+        with self.assertRaises(conveyor.error.RequestFailedException):
+            self._session.request('missing').result(5.0)
+
+    def test_request_closed(self):
+        '''Test that the requests still waiting fail when the connection goes.'''
+
+        self._server.addmethod('hang', lambda: conveyor.task.Task())
+        future = self._session.request('hang')
+        self._server.stop()
+        self._serverthread.join(5.0)
+        with self.assertRaises(conveyor.error.RequestFailedException):
+            future.result(5.0)
+        self.assertTrue(self._session.wait(5.0))
+
+    def test_waitforjob(self):
+        '''Test that a job wait ends when the job stops.'''
+
+        self._jobs[1] = self._job(1, conveyor.task.TaskState.RUNNING)
+        self._jobs[2] = self._job(2, conveyor.task.TaskState.STOPPED)
+        future1 = self._session.waitforjob(1)
+        future2 = self._session.waitforjob(2)
+        self.assertEqual(2, future2.result(5.0).id)
+        self.assertFalse(future1.done())
+        self._jobs[1] = self._job(1, conveyor.task.TaskState.STOPPED)
+        self._server.notify('jobchanged', self._jobs[1])
+        job = future1.result(5.0)
+        self.assertEqual(conveyor.task.TaskConclusion.ENDED, job.conclusion)
+        with self.assertRaises(conveyor.error.RequestFailedException):
+            self._session.waitforjob(3).result(5.0)
+
+    def test_close(self):
+        '''Test that closing a session leaves the global event queue running.'''
+
+        eventqueue = conveyor.event.geteventqueue()
+        thread = conveyor.event.EventQueueThread(eventqueue, 'test')
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(thread.join, 5.0)
+        self.addCleanup(thread.stop)
+        self._session.close()
+        event = threading.Event()
+        task = conveyor.task.Task()
+        task.stoppedevent.attach(lambda task: event.set())
+        task.start()
+        task.end(None)
+        self.assertTrue(event.wait(5.0))
+
+    def test_upload(self):
+        '''Test that an interrupted upload resumes where it left off.'''
+
+        import io
+        data = b'solid bunny\n' * 20
+        upload = self._session.upload(io.BytesIO(data[:100]), 'bunny.stl')
+        self.assertEqual(100, upload['offset'])
+        upload = self._session.request(
+            'beginupload', {'name': 'bunny.stl'}).result(5.0)
+        self._session.request(
+            'uploadchunk', {
+                'id': upload['id'], 'offset': 0,
+                'data': base64.b64encode(data[:8])}).result(5.0)
+        upload = self._session.upload(
+            io.BytesIO(data), 'bunny.stl', upload['id'])
+        self.assertEqual(len(data), upload['offset'])
+        self.assertEqual(hashlib.sha256(data).hexdigest(), upload['sha256'])
+        with open(self._uploads.claim(upload['id']), 'rb') as fp:
+            self.assertEqual(data, fp.read())
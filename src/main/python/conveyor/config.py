@@ -231,6 +231,34 @@ class _Address(_Type):
             return result
 
 
+class _AddressMap(_Type):
+    '''
+    A type representing a map from names to conveyor service addresses. The
+    names may not contain a colon.
+
+    '''
+
+    def _getdefault(self):
+        return {}
+
+    def convert(self, config_path, key, value):
+        if not isinstance(value, dict):
+            raise conveyor.error.ConfigTypeError(config_path, key, value)
+        else:
+            result = {}
+            for name, address in value.items():
+                if ':' in name or 0 == len(name):
+                    raise conveyor.error.ConfigValueError(
+                        config_path, key, value)
+                elif not isinstance(address, basestring):
+                    raise conveyor.error.ConfigTypeError(
+                        config_path, key, value)
+                else:
+                    result[name] = conveyor.address.Address.address_factory(
+                        address)
+            return result
+
+
 class _LogLevel(_Type):
     '''A type representing a log level.'''
 
@@ -250,6 +278,25 @@ class _LogLevel(_Type):
             return value
 
 
+class _Choice(_Type):
+    '''A type representing one of a fixed set of strings.'''
+
+    def __init__(self, default, choices):
+        self._default = default
+        self._choices = choices
+
+    def _getdefault(self):
+        return self._default
+
+    def convert(self, config_path, key, value):
+        if not isinstance(value, basestring):
+            raise conveyor.error.ConfigTypeError(config_path, key, value)
+        elif value not in self._choices:
+            raise conveyor.error.ConfigValueError(config_path, key, value)
+        else:
+            return value
+
+
 class _FilesystemItem(_Type):
     '''
     An abstract type that represents a filesystem item. No check is made for
@@ -356,10 +403,18 @@ class _Formatter(conveyor.visitor.Visitor):
         self._text(conveyor.json.dumps(str(address._getdefault())))
         self._newline()
 
+    def accept__AddressMap(self, address_map):
+        self._text(conveyor.json.dumps(address_map._getdefault()))
+        self._newline()
+
     def accept__LogLevel(self, level):
         self._text(conveyor.json.dumps(level._default))
         self._newline()
 
+    def accept__Choice(self, choice):
+        self._text(conveyor.json.dumps(choice._default))
+        self._newline()
+
     def accept__FilesystemItem(self, filesystem_item):
         self._text(conveyor.json.dumps(os.path.join(*filesystem_item._path)))
         self._newline()
@@ -489,6 +544,136 @@ def _gettype():
                     'chdir',
                     _Bool(False),
                 ),
+                _Field(
+                    'Whether or not the conveyor service serves all of its clients from a single epoll loop (Linux only). The requests run on the dispatch threads (4 of them when dispatch_threads is 0).',
+                    'reactor',
+                    _Bool(False),
+                ),
+                _Field(
+                    'The number of threads that run JSON-RPC requests for all of the clients. When it is 0, each client runs its requests (including the elements of a batch) one at a time on its own thread.',
+                    'dispatch_threads',
+                    _Int(0),
+                ),
+                _Field(
+                    'The number of seconds after which the conveyor service answers a batch of JSON-RPC requests with whatever responses are ready (the rest time out). It only applies when there are dispatch threads. When it is 0 there is no deadline.',
+                    'batch_timeout',
+                    _Float(0.0),
+                ),
+                _Field(
+                    'The number of seconds that notifications to a client may wait so that they are sent together. When it is 0 they are sent as soon as possible.',
+                    'coalesce_window',
+                    _Float(0.002),
+                ),
+                _Field(
+                    'The minimum number of seconds between two notifications about the same job or machine. Notifications that arrive in between are collapsed into the latest one. A job that stops is always reported right away.',
+                    'notification_interval',
+                    _Float(0.5),
+                ),
+                _Field(
+                    'The number of degrees a temperature reading must change before the conveyor service notifies the clients.',
+                    'temperature_deadband',
+                    _Float(1.0),
+                ),
+                _Field(
+                    'The maximum number of bytes waiting to be sent to a client. A client that falls further behind is disconnected.',
+                    'outbound_limit',
+                    _Int(4194304),
+                ),
+                _Field(
+                    'The maximum number of bytes in one message from a client that uses the "line" or "length" framing. A client that sends a longer message is disconnected.',
+                    'max_frame_size',
+                    _Int(16777216),
+                ),
+                _Field(
+                    'The number of seconds after which a client that is not reading what the conveyor service sends it is disconnected.',
+                    'stall_timeout',
+                    _Float(30.0),
+                ),
+                _Field(
+                    'The number of stopped jobs the conveyor service keeps in memory. Older jobs are moved to the job archive.',
+                    'job_history',
+                    _Int(100),
+                ),
+                _Field(
+                    'The SQLite database where the conveyor service archives old jobs. When it is empty, jobs that leave the history are forgotten.',
+                    'job_archive_file',
+                    _Str(''),
+                ),
+                _Field(
+                    'The number of jobs kept in the job archive (the oldest are deleted first). When it is 0 the archive keeps every job.',
+                    'job_archive_limit',
+                    _Int(10000),
+                ),
+                _Field(
+                    'The directory where the conveyor service keeps the files that clients upload. When it is empty, the conveyor service uses a new temporary directory.',
+                    'upload_directory',
+                    _Str(''),
+                ),
+                _Field(
+                    'The maximum number of bytes in an uploaded file.',
+                    'upload_limit',
+                    _Int(268435456),
+                ),
+                _Field(
+                    'The maximum number of bytes in one chunk of an upload.',
+                    'upload_chunk_limit',
+                    _Int(262144),
+                ),
+                _Field(
+                    'The number of chunks of an upload a client may send before it waits for the reply to the first of them.',
+                    'upload_window',
+                    _Int(4),
+                ),
+                _Field(
+                    'The number of seconds after which an upload that is idle (and that no job is using) is removed.',
+                    'upload_timeout',
+                    _Float(3600.0),
+                ),
+                _Field(
+                    'The other conveyor services (by name) whose ports, machines, and jobs this conveyor service serves as its own. A remote machine or port is named after its service, i.e., "host1:/dev/ttyACM0".',
+                    'federation',
+                    _AddressMap(),
+                ),
+                _Field(
+                    'The number of seconds between attempts to reconnect to a federated conveyor service.',
+                    'federation_retry',
+                    _Float(5.0),
+                ),
+                _Field(
+                    'The number of seconds to wait for a federated conveyor service to answer a request.',
+                    'federation_timeout',
+                    _Float(30.0),
+                ),
+                _Field(
+                    'The conveyor services (by name) that slice models for this conveyor service. When none of them has a free slot the model is sliced locally.',
+                    'slicer_workers',
+                    _AddressMap(),
+                ),
+                _Field(
+                    'The number of seconds before a slicing worker that could not be reached is tried again.',
+                    'slicer_worker_retry',
+                    _Float(5.0),
+                ),
+                _Field(
+                    'The number of seconds to wait for a slicing worker to answer a request (except for the slice itself).',
+                    'slicer_worker_timeout',
+                    _Float(30.0),
+                ),
+                _Field(
+                    'The number of models this conveyor service slices at once for other conveyor services. When it is 0 this conveyor service is not a slicing worker.',
+                    'worker_slots',
+                    _Int(0),
+                ),
+                _Field(
+                    'The number of slicers the conveyor service runs at once. When it is 0 there is one for each CPU.',
+                    'slicer_slots',
+                    _Int(0),
+                ),
+                _Field(
+                    'The number of print-to-files, g-code processors, and g-code verifications the conveyor service runs at once.',
+                    'io_slots',
+                    _Int(2),
+                ),
                 _Field(
                     'The number of threads available for handling events.',
                     'event_threads',
@@ -531,6 +716,21 @@ def _gettype():
                     'event_threads',
                     _Int(2),
                 ),
+                _Field(
+                    'The framing the client requests for its connection to the conveyor service (length, line, or stream).',
+                    'framing',
+                    _Choice('length', ('length', 'line', 'stream',)),
+                ),
+                _Field(
+                    'The encoding the client requests for its connection to the conveyor service when it is connected over TCP (json or binary).',
+                    'codec',
+                    _Choice('json', ('json', 'binary',)),
+                ),
+                _Field(
+                    'The compression the client requests for its connection to the conveyor service when it is connected over TCP (zlib or none).',
+                    'compression',
+                    _Choice('zlib', ('zlib', 'none',)),
+                ),
                 _Field(
                     'The logging configuration for the conveyor client.',
                     'logging',
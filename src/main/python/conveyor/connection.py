@@ -26,10 +26,16 @@ import os.path
 import select
 import socket
 import threading
+import time
 
 import conveyor.log
 import conveyor.stoppable
 
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
 
 class Connection(conveyor.stoppable.StoppableInterface):
     """ Base class for all conveyor connection objects """
@@ -46,6 +52,13 @@ class Connection(conveyor.stoppable.StoppableInterface):
         "Template write function, not implemented."
         raise NotImplementedError
 
+    def flush(self):
+        "Connections are unbuffered; there is nothing to flush."
+
+    def shutdown(self):
+        """ Stops the connection and makes a blocked write return. """
+        self.stop()
+
     def close(self):
         raise NotImplementedError
 
@@ -76,6 +89,16 @@ class _AbstractSocketConnection(Connection):
         self._stopped = True
         # ^ threading.Condition lock unneeded, boolean write is atomic
 
+    def shutdown(self):
+        self._stopped = True
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except IOError as e:
+            if e.args[0] not in (errno.EBADF, errno.ENOTCONN):
+                raise
+            else:
+                self._log.debug('handled exception', exc_info=True)
+
     def write(self, data):
         """ writes data over a socket. Loops until either .stop() is set or 
         data has been sent successfully. Exceptions for flow are handled in 
@@ -83,10 +106,12 @@ class _AbstractSocketConnection(Connection):
         @param data The data you want to send 
         """
         with self._condition:
+            # NOTE: slicing a memoryview does not copy the unsent remainder.
+            view = memoryview(data)
             i = 0
             while not self._stopped and i < len(data):
                 try:
-                    sent = self._socket.send(data[i:])
+                    sent = self._socket.send(view[i:])
                 except IOError as e:
                     if e.args[0] in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK):
                         # NOTE: debug too spammy
@@ -106,6 +131,230 @@ class _AbstractSocketConnection(Connection):
     def close(self):
         self._socket.close()
 
+# A buffered writer writes as soon as it holds this many bytes.
+_FLUSH_SIZE = 64 * 1024
+
+# The most bytes a buffered writer hands to its connection at once. A client
+# makes progress (see `stalltimeout`) whenever one of these goes out.
+_WRITE_SIZE = 64 * 1024
+
+class BufferedWriter(object):
+    """ The outbound queue for a connection. Writes never block: the data is
+    queued and a writer thread sends it. Data written within a short window
+    is coalesced into a single write; .flush() asks for latency-critical
+    data (i.e., a response) to go out right away, together with anything
+    queued before it.
+
+    Data written with a key replaces queued data that has the same key and
+    has not been sent yet; use it for notifications that carry the latest
+    state of something. A client that falls too far behind (more than
+    `limit` bytes queued) or that makes no progress for `stalltimeout`
+    seconds is disconnected.
+    """
+
+    @classmethod
+    def create(cls, connection, window, limit, stalltimeout):
+        """
+        @param connection the connection to write to
+        @param window the number of seconds that data may wait in the queue
+        @param limit the maximum number of bytes in the queue
+        @param stalltimeout the number of seconds without progress after which
+            the connection is stopped
+        """
+        writer = cls(connection, window, limit, stalltimeout)
+        thread = threading.Thread(target=writer._writer)
+        thread.daemon = True
+        thread.start()
+        writer._thread = thread
+        return writer
+
+    def __init__(self, connection, window, limit, stalltimeout):
+        self._connection = connection
+        self._window = window
+        self._limit = limit
+        self._stalltimeout = stalltimeout
+        self._log = conveyor.log.getlogger(self)
+        self._condition = threading.Condition()
+        self._thread = None
+        self._reset()
+        self._closed = False
+        self._failed = False
+        self._urgent = False
+        self._writing = False
+        self._progress = time.time()
+        self._since = None
+        self._messages = 0
+        self._bytes = 0
+        self._writes = 0
+        self._collapsed = 0
+
+    def _reset(self):
+        self._chunks = []
+        self._keys = {}
+        self._size = 0
+
+    def write(self, data, key=None):
+        evict = None
+        with self._condition:
+            if not self._failed and not self._closed:
+                self._messages += 1
+                self._bytes += len(data)
+                index = self._keys.get(key)
+                if None is not index:
+                    self._size += len(data) - len(self._chunks[index])
+                    self._chunks[index] = data
+                    self._collapsed += 1
+                else:
+                    if 0 == len(self._chunks):
+                        self._since = time.time()
+                        if not self._writing:
+                            self._progress = self._since
+                    if None is not key:
+                        self._keys[key] = len(self._chunks)
+                    self._chunks.append(data)
+                    self._size += len(data)
+                if self._limit < self._size:
+                    evict = 'queue limit exceeded: %d bytes' % (self._size,)
+                else:
+                    evict = self._stalled(time.time())
+                if None is evict:
+                    if _FLUSH_SIZE <= self._size:
+                        self._urgent = True
+                    self._wake()
+        if None is not evict:
+            self._evict(evict)
+
+    def flush(self):
+        with self._condition:
+            self._urgent = True
+            self._wake()
+
+    def getstats(self):
+        """ Returns the number of messages and bytes written to the queue,
+        the number of writes to the connection, the number of writes saved by
+        coalescing, and the number of messages replaced by newer ones.
+        """
+        with self._condition:
+            stats = {
+                'messages': self._messages,
+                'bytes': self._bytes,
+                'writes': self._writes,
+                'saved': self._messages - self._writes,
+                'collapsed': self._collapsed,
+            }
+        return stats
+
+    def stop(self):
+        self._connection.stop()
+
+    def close(self):
+        """ Sends whatever is queued and closes the connection. A client that
+        makes no progress for `stalltimeout` seconds meanwhile is disconnected.
+        """
+        evict = None
+        with self._condition:
+            self._closed = True
+            self._wake()
+            if (None is not self._thread
+                    and threading.current_thread() is not self._thread):
+                while (not self._failed
+                        and (self._writing or 0 != len(self._chunks))):
+                    now = time.time()
+                    evict = self._stalled(now)
+                    if None is not evict:
+                        break
+                    else:
+                        self._condition.wait(
+                            self._progress + self._stalltimeout - now)
+        if None is not evict:
+            self._evict(evict)
+        if (None is not self._thread
+                and threading.current_thread() is not self._thread):
+            # NOTE: an evicted writer's blocked write returns right away.
+            self._thread.join(self._stalltimeout)
+        self._connection.close()
+
+    def _stalled(self, now):
+        '''
+        Called with the lock held. Returns why the client is stalled (or
+        `None`).
+
+        '''
+
+        if self._stalltimeout < now - self._progress:
+            reason = 'stalled for %.1f seconds' % (now - self._progress,)
+        else:
+            reason = None
+        return reason
+
+    def _evict(self, reason):
+        self._log.warning('disconnecting client: %s', reason)
+        with self._condition:
+            self._failed = True
+            self._reset()
+            self._wake()
+        # NOTE: a shut down socket makes a blocked send in the writer thread
+        # return.
+        self._connection.shutdown()
+
+    def _wake(self):
+        '''Called with the lock held whenever there is something to do.'''
+        self._condition.notify_all()
+
+    def _take(self):
+        '''Called with the lock held. Takes the queued data for one write.'''
+        data = b''.join(self._chunks)
+        self._reset()
+        self._urgent = False
+        self._writing = True
+        self._writes += 1
+        return data
+
+    def _sent(self):
+        '''Called after part of a write that `_take` started went out.'''
+        with self._condition:
+            self._progress = time.time()
+
+    def _written(self, failed):
+        '''Called after a write that `_take` started.'''
+        with self._condition:
+            self._writing = False
+            if failed:
+                self._failed = True
+                self._reset()
+            else:
+                self._progress = time.time()
+            self._wake()
+
+    def _writer(self):
+        while True:
+            with self._condition:
+                while (0 == len(self._chunks) and not self._closed
+                        and not self._failed):
+                    self._condition.wait()
+                if 0 == len(self._chunks):
+                    break
+                else:
+                    if not self._closed and not self._urgent:
+                        # NOTE: let more data accumulate unless something
+                        # needs to go out right away.
+                        deadline = time.time() + self._window
+                        while (not self._urgent and not self._closed
+                                and time.time() < deadline):
+                            self._condition.wait(deadline - time.time())
+                    data = self._take()
+            try:
+                for offset in range(0, len(data), _WRITE_SIZE):
+                    self._connection.write(data[offset:offset + _WRITE_SIZE])
+                    self._sent()
+            except (IOError, ConnectionWriteException):
+                self._log.debug('handled exception', exc_info=True)
+                self._written(True)
+                break
+            else:
+                self._written(False)
+
+
 if 'nt' != os.name:
 # TRICKY: Due to windows issues installing pywintypes, we wrote our own 
 # lower level socket classes. This is the posix section of those  
@@ -294,3 +543,193 @@ else: # case for os == 'nt' (ie, windows machines')
     # use custom windowns socket classes as 'PipeConnection' and 'SocketConnection
     PipeConnection = _Win32PipeConnection
     SocketConnection = _Win32SocketConnection
+
+
+class _Sink(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.writes = []
+        self.stopped = False
+        self.closed = False
+
+    def write(self, data):
+        with self.condition:
+            self.writes.append(data)
+            self.condition.notify_all()
+
+    def wait(self, count):
+        with self.condition:
+            deadline = time.time() + 5.0
+            while len(self.writes) < count and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+
+    def stop(self):
+        self.stopped = True
+
+    def shutdown(self):
+        self.stop()
+
+    def close(self):
+        self.closed = True
+
+
+class _BlockedSink(_Sink):
+    def __init__(self):
+        _Sink.__init__(self)
+        self.started = threading.Event()
+        self.event = threading.Event()
+
+    def write(self, data):
+        self.started.set()
+        self.event.wait(5.0)
+        _Sink.write(self, data)
+
+    def shutdown(self):
+        # NOTE: like a shut down socket, this makes a blocked write return.
+        _Sink.shutdown(self)
+        self.event.set()
+
+
+class _SlowSink(_Sink):
+    def write(self, data):
+        time.sleep(0.1)
+        _Sink.write(self, data)
+
+
+class _BufferedWriterTestCase(unittest.TestCase):
+    def test_coalesce(self):
+        '''Test that writes within the window go out as one.'''
+
+        sink = _Sink()
+        writer = BufferedWriter.create(sink, 0.05, 1024, 60.0)
+        for i in range(10):
+            writer.write(b'%d' % (i,))
+        sink.wait(1)
+        self.assertEqual([b'0123456789'], sink.writes)
+        self.assertEqual(
+            {'messages': 10, 'bytes': 10, 'writes': 1, 'saved': 9,
+                'collapsed': 0},
+            writer.getstats())
+        writer.close()
+        self.assertTrue(sink.closed)
+
+    def test_flush(self):
+        '''Test that a flush sends the queued data along with it.'''
+
+        sink = _Sink()
+        writer = BufferedWriter.create(sink, 60.0, 1024, 60.0)
+        writer.write(b'a')
+        writer.write(b'b')
+        writer.flush()
+        sink.wait(1)
+        self.assertEqual([b'ab'], sink.writes)
+        writer.write(b'c')
+        writer.close()
+        self.assertEqual([b'ab', b'c'], sink.writes)
+
+    def test_collapse(self):
+        '''Test that keyed data replaces queued data with the same key.'''
+
+        sink = _Sink()
+        writer = BufferedWriter.create(sink, 60.0, 1024, 60.0)
+        writer.write(b'a1', 'a')
+        writer.write(b'b1', 'b')
+        writer.write(b'x')
+        writer.write(b'a2', 'a')
+        writer.close()
+        self.assertEqual([b'a2b1x'], sink.writes)
+        self.assertEqual(1, writer.getstats()['collapsed'])
+
+    def test_limit(self):
+        '''Test that a client that falls too far behind is disconnected.'''
+
+        sink = _BlockedSink()
+        writer = BufferedWriter.create(sink, 0.0, 16, 60.0)
+        writer.write(b'x' * 8)
+        writer.flush()
+        sink.started.wait(5.0)
+        for i in range(3):
+            writer.write(b'y' * 8)
+        self.assertTrue(sink.stopped)
+        writer.write(b'z')
+        sink.event.set()
+        writer.close()
+        self.assertEqual([b'x' * 8], sink.writes)
+
+    def test_stalled(self):
+        '''Test that a client that makes no progress is disconnected.'''
+
+        sink = _BlockedSink()
+        writer = BufferedWriter.create(sink, 0.0, 1024, 0.05)
+        writer.write(b'x')
+        writer.flush()
+        sink.started.wait(5.0)
+        time.sleep(0.1)
+        self.assertFalse(sink.stopped)
+        writer.write(b'y')
+        self.assertTrue(sink.stopped)
+        sink.event.set()
+        writer.close()
+
+    def test_slow(self):
+        '''Test that a client that reads slowly but steadily stays.'''
+
+        sink = _SlowSink()
+        writer = BufferedWriter.create(sink, 0.0, 1024 * 1024, 0.15)
+        writer.write(b'x' * (4 * _WRITE_SIZE))
+        writer.flush()
+        time.sleep(0.25)
+        writer.write(b'y')
+        self.assertFalse(sink.stopped)
+        writer.close()
+        self.assertEqual(
+            b'x' * (4 * _WRITE_SIZE) + b'y', b''.join(sink.writes))
+
+    def test_close_stalled(self):
+        '''Test that close disconnects a client that makes no progress.'''
+
+        sink = _BlockedSink()
+        writer = BufferedWriter.create(sink, 0.0, 1024, 0.05)
+        writer.write(b'x')
+        writer.flush()
+        sink.started.wait(5.0)
+        writer.close()
+        self.assertTrue(sink.stopped)
+        self.assertTrue(sink.closed)
+        self.assertFalse(writer._thread.is_alive())
+
+
+
+class _SocketConnectionTestCase(unittest.TestCase):
+    def test_write(self):
+        '''Test that partial sends write everything exactly once.'''
+
+        class Socket(object):
+            def __init__(self):
+                self.data = []
+
+            def send(self, data):
+                chunk = data[:3].tobytes()
+                self.data.append(chunk)
+                return len(chunk)
+
+        sock = Socket()
+        connection = _AbstractSocketConnection(sock, None)
+        connection.write(b'abcdefgh')
+        self.assertEqual([b'abc', b'def', b'gh'], sock.data)
+
+    def test_shutdown(self):
+        '''Test that shutdown makes a blocked write return.'''
+
+        left, right = socket.socketpair()
+        connection = _AbstractSocketConnection(left, None)
+        thread = threading.Thread(
+            target=connection.write, args=(b'x' * (16 * 1024 * 1024),))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        connection.shutdown()
+        thread.join(5.0)
+        self.assertFalse(thread.is_alive())
+        left.close()
+        right.close()
@@ -40,9 +40,11 @@ def command(command_class):
     return decorator
 
 
-def jsonrpc(name=None):
+def jsonrpc(name=None, concurrency=None, timeout=None):
     def decorator(func):
         setattr(func, '_jsonrpc', True)
         setattr(func, '_jsonrpc_name', name)
+        setattr(func, '_jsonrpc_concurrency', concurrency)
+        setattr(func, '_jsonrpc_timeout', timeout)
         return func
     return decorator
@@ -0,0 +1,329 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/main/python/conveyor/embed.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Runs the `slice` and `print_to_file` recipes in the calling process, without
+the conveyor service.
+
+    embedded = Embedded.create(config)
+    job = embedded.slice(
+        's3g', 'Replicator2', '/tmp/a.stl', '/tmp/a.gcode', True, '0', None,
+        'PLA', 'miraclegrue', slicer_settings)
+    embedded.wait(job)
+    embedded.stop()
+
+The tasks run on the embedding's own event queue (not the global one), so
+any number of embeddings can run in one process. Either call `wait` (which
+runs the event queue on the calling thread until the job stops) or call
+`start` to run it on a thread of its own and pass a `callback` to follow the
+jobs.
+
+'''
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import os.path
+import threading
+
+import conveyor.event
+import conveyor.executor
+import conveyor.job
+import conveyor.log
+import conveyor.machine
+import conveyor.process
+import conveyor.recipe
+import conveyor.stoppable
+import conveyor.task
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class Embedded(conveyor.stoppable.StoppableInterface):
+    @classmethod
+    def create(cls, config, work_threads=1, eventqueue=None):
+        '''
+        @param config a `conveyor.config.Config`
+        @param work_threads the number of slicers (or print-to-files) to run
+            at once
+        @param eventqueue an event queue that someone else runs (i.e., the
+            global event queue); by default the embedding has its own
+        '''
+        driver_manager = conveyor.machine.DriverManager.create(config)
+        embedded = cls(config, driver_manager, work_threads, eventqueue)
+        return embedded
+
+    def __init__(self, config, driver_manager, work_threads, eventqueue=None):
+        conveyor.stoppable.StoppableInterface.__init__(self)
+        self._config = config
+        self._driver_manager = driver_manager
+        self._log = conveyor.log.getlogger(self)
+        # NOTE: the queue is unbounded; work is only submitted from event
+        # callbacks, which must not block.
+        self._executor = conveyor.executor.Executor.create(
+            work_threads, work_threads, 'embedded_work')
+        if None is eventqueue:
+            self._eventqueue = conveyor.event.EventQueue()
+            self._owned = True
+        else:
+            self._eventqueue = eventqueue
+            self._owned = False
+        self._thread = None
+        self._lock = threading.Lock()
+        self._job_id_counter = 0
+        self._stopped = {}
+
+    def queue_work(self, work, pool=None, job=None):
+        # NOTE: an embedding runs all of its work on one pool of threads.
+        self._executor.submit(work, False)
+
+    def queue_slice(self, task, work, request, job=None):
+        self.queue_work(work, 'slicer', job)
+
+    def start(self):
+        '''Runs the event queue on a thread of its own until `stop`.'''
+
+        if self._owned and None is self._thread:
+            self._thread = conveyor.event.EventQueueThread(
+                self._eventqueue, 'embedded_event_thread')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._executor.stop()
+        if self._owned:
+            self._eventqueue.stop()
+        if None is not self._thread:
+            self._thread.join(1.0)
+
+    def slice(
+            self, driver_name, profile_name, input_file, output_file,
+            add_start_end, extruder_name, gcode_processor_name, material_name,
+            slicer_name, slicer_settings, callback=None):
+        '''
+        Starts slicing `input_file` and returns the job. `callback(job)` is
+        called on the event queue's thread whenever the job makes progress
+        and once when it stops.
+
+        '''
+
+        driver = self._driver_manager.get_driver(driver_name)
+        profile = driver.get_profile(profile_name)
+        job = conveyor.job.SliceJob(
+            self._create_job_id(), self._get_job_name(output_file), driver,
+            profile, input_file, output_file, add_start_end, extruder_name,
+            gcode_processor_name, material_name, slicer_name, slicer_settings)
+        job.task = self._get_recipe(job).slice()
+        self._start(job, callback)
+        return job
+
+    def print_to_file(
+            self, driver_name, profile_name, input_file, output_file,
+            extruder_name, file_type, gcode_processor_name, has_start_end,
+            material_name, slicer_name, slicer_settings, callback=None):
+        '''
+        Starts printing `input_file` to `output_file` and returns the job (see
+        `slice`).
+
+        '''
+
+        driver = self._driver_manager.get_driver(driver_name)
+        profile = driver.get_profile(profile_name)
+        job = conveyor.job.PrintToFileJob(
+            self._create_job_id(), self._get_job_name(output_file), driver,
+            profile, input_file, output_file, extruder_name, file_type,
+            gcode_processor_name, has_start_end, material_name, slicer_name,
+            slicer_settings)
+        job.task = self._get_recipe(job).print_to_file()
+        self._start(job, callback)
+        return job
+
+    def wait(self, job, timeout=None):
+        '''
+        Waits for a job to stop and returns whether or not it stopped. Unless
+        the event queue is already running (see `start`), it runs on the
+        calling thread until the job stops (there is no `timeout`) and only
+        one thread may do that at a time.
+
+        '''
+
+        with self._lock:
+            stopped = self._stopped[job.id]
+        if self._owned and None is self._thread:
+            while not stopped.is_set():
+                self._eventqueue.runiteration(True)
+        else:
+            stopped.wait(timeout)
+        with self._lock:
+            result = stopped.is_set()
+            if result:
+                self._stopped.pop(job.id, None)
+        return result
+
+    def _create_job_id(self):
+        with self._lock:
+            self._job_id_counter += 1
+            id_ = self._job_id_counter
+        return id_
+
+    def _get_job_name(self, p):
+        root, ext = os.path.splitext(p)
+        job_name = os.path.basename(root)
+        return job_name
+
+    def _get_recipe(self, job):
+        recipe_manager = conveyor.recipe.RecipeManager(
+            self._config, self, None, self._eventqueue)
+        recipe = recipe_manager.get_recipe(job)
+        return recipe
+
+    def _start(self, job, callback):
+        stopped = threading.Event()
+        with self._lock:
+            self._stopped[job.id] = stopped
+        if None is not callback:
+            job.task.heartbeatevent.attach(lambda task: callback(job))
+        def stopped_callback(task):
+            if None is not callback:
+                callback(job)
+            stopped.set()
+        job.task.stoppedevent.attach(stopped_callback)
+        job.task.start()
+
+
+class _Profile(object):
+    class _Scaffold(object):
+        start = ['; start']
+        end = ['; end']
+        variables = {}
+
+    name = 'Replicator2'
+    _s3g_profile = None
+
+    def get_gcode_scaffold(
+            self, extruders, extruder_temperature, platform_temperature,
+            material_name):
+        return self._Scaffold()
+
+
+class _DriverManager(object):
+    class _Driver(object):
+        name = 's3g'
+
+        def get_profile(self, profile_name):
+            return _Profile()
+
+    def get_driver(self, driver_name):
+        return self._Driver()
+
+
+class _SliceEmbedded(Embedded):
+    '''An embedding whose "slicer" copies the model to the G-code.'''
+
+    def queue_slice(self, task, work, request, job=None):
+        def slice():
+            with open(request.input_path) as ifp:
+                with open(request.output_path, 'w') as ofp:
+                    ofp.write(ifp.read())
+            task.end(None)
+        self.queue_work(slice, 'slicer', job)
+
+
+class _EmbeddedTestCase(unittest.TestCase):
+    def _job(self, embedded, count):
+        def worktask():
+            def running_callback(task):
+                def work():
+                    task.heartbeat({'name': 'work', 'progress': 50})
+                    task.end(None)
+                embedded.queue_work(work)
+            task = conveyor.task.Task(embedded._eventqueue)
+            task.runningevent.attach(running_callback)
+            return task
+        job = conveyor.job.Job('TEST', embedded._create_job_id(), 'test')
+        job.task = conveyor.process.tasksequence(
+            job, [worktask() for i in range(count)], embedded._eventqueue)
+        return job
+
+    def test_wait(self):
+        '''Test that `wait` runs the embedding's own event queue.'''
+
+        embedded = Embedded(None, None, 2)
+        calls = []
+        job = self._job(embedded, 3)
+        embedded._start(job, calls.append)
+        self.assertTrue(embedded.wait(job))
+        embedded.stop()
+        self.assertEqual(conveyor.task.TaskConclusion.ENDED, job.task.conclusion)
+        self.assertEqual(4, len(calls))
+        self.assertEqual({}, embedded._stopped)
+
+    def test_start(self):
+        '''Test that `wait` waits while another thread runs the event queue.'''
+
+        embedded = Embedded(None, None, 2)
+        embedded.start()
+        jobs = [self._job(embedded, 2) for i in range(10)]
+        for job in jobs:
+            embedded._start(job, None)
+        for job in jobs:
+            self.assertTrue(embedded.wait(job, 5.0))
+        embedded.stop()
+        self.assertFalse(embedded._thread.is_alive())
+        for job in jobs:
+            self.assertEqual(
+                conveyor.task.TaskConclusion.ENDED, job.task.conclusion)
+
+    def test_thing(self):
+        '''Test that a single-mesh thing runs on the embedding's queue.'''
+
+        import conveyor.config
+        import conveyor.domain
+        import conveyor.slicer
+        import shutil
+        import stat
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        input_file = os.path.join(directory, 'bunny.thing')
+        with open(input_file, 'w') as fp:
+            fp.write('G1 X0 Y0 Z0\n')
+        # NOTE: a stand-in for unified_mesh_hack that extracts one mesh.
+        exe = os.path.join(directory, 'unified_mesh_hack')
+        with open(exe, 'w') as fp:
+            fp.write('#!/bin/sh\ncp "$1" "$2/UNIFIED_MESH_HACK_0.stl"\n')
+        os.chmod(exe, stat.S_IRWXU)
+        config = conveyor.config.Config('test', conveyor.config.convert(
+            'test', {'server': {'unified_mesh_hack_exe': exe}}))
+        slicer_settings = conveyor.domain.SlicerConfiguration(
+            conveyor.slicer.Slicer.MIRACLEGRUE, '0', False, False, 0.1, 0.27,
+            2, 230, 110, 80, 100)
+        embedded = _SliceEmbedded(config, _DriverManager(), 1)
+        embedded.start()
+        self.addCleanup(embedded.stop)
+        output_file = os.path.join(directory, 'bunny.gcode')
+        job = embedded.slice(
+            's3g', 'Replicator2', input_file, output_file, True, '0', None,
+            'PLA', conveyor.slicer.Slicer.MIRACLEGRUE, slicer_settings)
+        self.assertTrue(embedded.wait(job, 5.0))
+        self.assertEqual(conveyor.task.TaskConclusion.ENDED, job.task.conclusion)
+        with open(output_file) as fp:
+            self.assertEqual('; start\nG1 X0 Y0 Z0\n; end\n', fp.read())
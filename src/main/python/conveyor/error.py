@@ -35,6 +35,19 @@ class Handleable(object):
 # derive from the built-in `KeyError`.
 
 
+class BatchSyntaxException(Exception, Handleable):
+    '''Raised when a line of a batch file is not a valid request.'''
+
+    def __init__(self, line, message):
+        Exception.__init__(self, line, message)
+        self.line = line
+        self.message = message
+
+    def handle(self, log):
+        log.critical('invalid request on line %d: %s', self.line, self.message)
+        return 1
+
+
 class ConfigKeyError(KeyError, Handleable):
     '''
     Raised when the configuration is missing a key. Since there are default
@@ -160,6 +173,18 @@ class NoDriversException(Exception, Handleable):
         return 1
 
 
+class NodeUnavailableException(Exception, Handleable):
+    '''Raised when a federated conveyor service is not connected.'''
+
+    def __init__(self, node_name):
+        Exception.__init__(self, node_name)
+        self.node_name = node_name
+
+    def handle(self, log):
+        log.critical('conveyor service unavailable: %s', self.node_name)
+        return 1
+
+
 class NoPortsException(Exception, Handleable):
     def handle(self, log):
         log.critical('there are no ports available', exc_info=True)
@@ -175,6 +200,14 @@ class NotFileException(Exception, Handleable):
         return 1
 
 
+class NotSliceWorkerException(Exception, Handleable):
+    '''Raised when a service without worker slots is asked to slice.'''
+
+    def handle(self, log):
+        log.critical('this conveyor service is not a slicing worker')
+        return 1
+
+
 class PortMismatchException(Exception, Handleable):
     def handle(self, log):
         log.critical(
@@ -197,6 +230,32 @@ class ProfileMismatchException(Exception, Handleable):
         return 1
 
 
+class RequestFailedException(Exception, Handleable):
+    '''
+    Raised when the conveyor service answers a request with an error (or the
+    request is canceled). `failure` is the JSON-RPC error object.
+
+    '''
+
+    def __init__(self, failure):
+        Exception.__init__(self, failure)
+        self.failure = failure
+
+    def handle(self, log):
+        log.error('request failed: %r', self.failure)
+        return 1
+
+
+class RequestTimeoutException(Exception, Handleable):
+    def __init__(self, timeout):
+        Exception.__init__(self, timeout)
+        self.timeout = timeout
+
+    def handle(self, log):
+        log.error('request timed out after %s seconds', self.timeout)
+        return 1
+
+
 class UnknownDriverError(KeyError, Handleable):
     def __init__(self, driver_name):
         KeyError.__init__(self, driver_name)
@@ -247,6 +306,16 @@ class UnknownProfileError(KeyError, Handleable):
         return 1
 
 
+class UnknownUploadError(KeyError, Handleable):
+    def __init__(self, upload_id):
+        KeyError.__init__(self, upload_id)
+        self.upload_id = upload_id
+
+    def handle(self, log):
+        log.critical('unknown upload: %s', self.upload_id, exc_info=True)
+        return 1
+
+
 class UnsupportedModelTypeException(Exception, Handleable):
     def __init__(self, path):
         Exception.__init__(self, path)
@@ -282,3 +351,67 @@ def guard(log, func):
         code = 1
         log.critical('internal error', exc_info=True)
     return code
+
+
+class UploadLimitException(Exception, Handleable):
+    '''Raised when an upload (or one of its chunks) is too large.'''
+
+    def __init__(self, upload_id, limit):
+        Exception.__init__(self, upload_id, limit)
+        self.upload_id = upload_id
+        self.limit = limit
+
+    def handle(self, log):
+        log.critical('upload is larger than %d bytes', self.limit)
+        return 1
+
+
+class UploadMismatchException(Exception, Handleable):
+    '''
+    Raised when a finished upload does not have the size or SHA-256 that the
+    client declared.
+
+    '''
+
+    def __init__(self, upload_id, size, sha256):
+        Exception.__init__(self, upload_id, size, sha256)
+        self.upload_id = upload_id
+        self.size = size
+        self.sha256 = sha256
+
+    def handle(self, log):
+        log.critical(
+            'upload %s is corrupt: %d bytes, sha256 %s', self.upload_id,
+            self.size, self.sha256)
+        return 1
+
+
+class UploadOffsetException(Exception, Handleable):
+    '''
+    Raised when a chunk of an upload is not at the offset where the last chunk
+    ended. The client resumes the upload from `expected`.
+
+    '''
+
+    def __init__(self, upload_id, offset, expected):
+        Exception.__init__(self, upload_id, offset, expected)
+        self.upload_id = upload_id
+        self.offset = offset
+        self.expected = expected
+
+    def handle(self, log):
+        log.critical(
+            'upload %s expected a chunk at offset %d, not %d', self.upload_id,
+            self.expected, self.offset)
+        return 1
+
+
+class UploadStateException(Exception, Handleable):
+    def __init__(self, upload_id, state):
+        Exception.__init__(self, upload_id, state)
+        self.upload_id = upload_id
+        self.state = state
+
+    def handle(self, log):
+        log.critical('upload %s is %s', self.upload_id, self.state)
+        return 1
@@ -23,24 +23,97 @@ import collections
 import logging
 import threading
 import time
+import weakref
 
 try:
     import unittest2 as unittest
 except ImportError:
     import unittest
 
+import conveyor.enum
 import conveyor.log
 import conveyor.stoppable
 import conveyor.test
 
+EventPriority = conveyor.enum.enum(
+    'EventPriority', CONTROL=0, NORMAL=1, TELEMETRY=2)
+# Events are delivered CONTROL first (i.e., a task that ends or is canceled),
+# then NORMAL, then TELEMETRY (i.e., heartbeats and temperatures).
+
+_PRIORITIES = (
+    EventPriority.CONTROL, EventPriority.NORMAL, EventPriority.TELEMETRY)
+
+_PRIORITY_NAMES = ('CONTROL', 'NORMAL', 'TELEMETRY')
+
 _eventqueue = None
 
+_lanes = None
+
+# The maximum number of events a thread takes from the queue at once.
+_BATCH_SIZE = 16
+
+# The maximum number of a lane's events that are delivered before the lane
+# goes to the back of its event queue.
+_LANE_BATCH_SIZE = 8
+
 def geteventqueue():
     global _eventqueue
     if None is _eventqueue:
         _eventqueue = EventQueue()
     return _eventqueue
 
+def getlane(key):
+    """ Returns the lane of the global event queue for `key` (i.e.,
+    `('job', 17)` or `('machine', 'Replicator2')`).
+    """
+    global _lanes
+    if None is _lanes:
+        _lanes = Lanes()
+    lane = _lanes.get(key)
+    return lane
+
+def getstats():
+    """ Returns the depth and latency of each priority of the global event
+    queue and of each of its lanes.
+    """
+    global _lanes
+    if None is _lanes:
+        _lanes = Lanes()
+    stats = {
+        'priorities': geteventqueue().getstats(),
+        'lanes': _lanes.getstats(),
+    }
+    return stats
+
+class _Stats(object):
+    """ The number of events delivered from a queue and how long they waited
+    (in seconds).
+    """
+
+    def __init__(self):
+        self.delivered = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def add(self, latency):
+        self.delivered += 1
+        self.latency += latency
+        if self.max_latency < latency:
+            self.max_latency = latency
+
+    def todict(self, depth):
+        if 0 == self.delivered:
+            latency = 0.0
+        else:
+            latency = self.latency / self.delivered
+        dct = {
+            'depth': depth,
+            'delivered': self.delivered,
+            'latency': latency,
+            'max_latency': self.max_latency,
+        }
+        return dct
+
 class EventQueueThread(conveyor.stoppable.StoppableThread):
     def __init__(self, eventqueue, name):
         conveyor.stoppable.StoppableThread.__init__(self, name=name)
@@ -57,32 +130,91 @@ class EventQueueThread(conveyor.stoppable.StoppableThread):
         self._eventqueue.stop()
 
 class EventQueue(object):
+    """ A queue of events that any number of threads deliver. An event wakes
+    at most one waiting thread and a thread takes a batch of events each time
+    it holds the lock. It leaves a share of the queue to the other threads
+    that are waiting, so that one slow handler holds up as few events as
+    possible.
+
+    There is a queue for each `EventPriority` and an event is delivered after
+    the events of the higher priorities that are waiting. The events of one
+    priority are delivered in order.
+    """
+
     def __init__(self):
         self._lock = threading.Lock()
         self._log = conveyor.log.getlogger(self)
         self._condition = threading.Condition(self._lock)
-        self._queue = collections.deque()
+        self._queues = [collections.deque() for priority in _PRIORITIES]
+        self._stats = [_Stats() for priority in _PRIORITIES]
+        self._length = 0
         self._stop = False
+        self._waiting = 0
 
     def runiteration(self, block):
-        self._log.debug('block=%r', block)
+        """ Delivers a batch of events; when `block` is set it first waits for
+        an event (or `stop`).
+        @return whether or not any event was delivered
+        """
+        debug = conveyor.log.isdebug(self._log)
+        if debug:
+            self._log.debug('block=%r', block)
         with self._condition:
             if block:
-                while 0 == len(self._queue) and not self._stop:
-                    self._log.debug('waiting')
-                    self._condition.wait()
-                    self._log.debug('resumed')
-            if 0 == len(self._queue):
-                tuple_ = None
-            else:
-                tuple_ = self._queue.pop()
-        if None is not tuple_:
-            event, args, kwargs = tuple_
+                while 0 == self._length and not self._stop:
+                    if debug:
+                        self._log.debug('waiting')
+                    self._waiting += 1
+                    try:
+                        self._condition.wait()
+                    finally:
+                        self._waiting -= 1
+                    if debug:
+                        self._log.debug('resumed')
+            count = min(
+                _BATCH_SIZE, (self._length + self._waiting)
+                    // (self._waiting + 1))
+            batch = self._take(count)
+            if 0 != self._length and 0 != self._waiting:
+                self._condition.notify()
+        for i, (event, args, kwargs, priority, enqueued) in enumerate(batch):
             event._deliver(args, kwargs)
-        result = None is not tuple_
-        self._log.debug('result=%r', result)
+            if self._stop:
+                # NOTE: the events after the one that stopped the queue are
+                # delivered by whoever runs it next.
+                with self._condition:
+                    self._putback(batch[i + 1:])
+                break
+        result = 0 != len(batch)
+        if debug:
+            self._log.debug('result=%r', result)
         return result
 
+    def _take(self, count):
+        now = time.time()
+        batch = []
+        for queue, stats in zip(self._queues, self._stats):
+            while count > len(batch) and 0 != len(queue):
+                tuple_ = queue.pop()
+                stats.add(now - tuple_[4])
+                batch.append(tuple_)
+        self._length -= len(batch)
+        return batch
+
+    def _putback(self, batch):
+        for tuple_ in reversed(batch):
+            self._queues[tuple_[3]].append(tuple_)
+        self._length += len(batch)
+
+    def _clear(self):
+        with self._condition:
+            for queue in self._queues:
+                for event, args, kwargs, priority, enqueued in queue:
+                    if isinstance(event, Event):
+                        event._pending = False
+                queue.clear()
+            self._length = 0
+
     def run(self):
         self._log.debug('starting')
         self._stop = False
@@ -99,12 +231,160 @@ class EventQueue(object):
         event.attach(func)
         event()
 
-    def _enqueue(self, event, args, kwargs):
-        self._log.debug('event=%r, args=%r, kwargs=%r', event, args, kwargs)
-        tuple_ = event, args, kwargs
+    def getstats(self):
+        """ Returns the depth and latency of each priority's queue. """
+        with self._condition:
+            stats = []
+            for priority, queue in enumerate(self._queues):
+                dct = self._stats[priority].todict(len(queue))
+                dct['priority'] = _PRIORITY_NAMES[priority]
+                stats.append(dct)
+        return stats
+
+    def _enqueue(self, event, args, kwargs, priority=EventPriority.NORMAL):
+        if conveyor.log.isdebug(self._log):
+            self._log.debug(
+                'event=%r, args=%r, kwargs=%r, priority=%r', event, args,
+                kwargs, priority)
+        tuple_ = event, args, kwargs, priority, time.time()
         with self._condition:
+            self._queues[priority].appendleft(tuple_)
+            self._length += 1
+            if 0 != self._waiting:
+                self._condition.notify()
+
+class Lane(object):
+    """ An ordered lane of events on a shared event queue. A lane's events are
+    delivered one at a time in the order they were fired, while the events of
+    other lanes are delivered in parallel by the event queue's threads. A lane
+    delivers at most `_LANE_BATCH_SIZE` events before it goes to the back of
+    the event queue, so a busy lane cannot starve the others.
+
+    A lane waits on the event queue with the highest priority of its events,
+    so a lane with a CONTROL event goes ahead of the lanes that only have
+    TELEMETRY events. Its own events are never reordered.
+
+    A lane stands in for an event queue: pass it as the `eventqueue` of an
+    `Event` or a `conveyor.task.Task`.
+    """
+
+    def __init__(self, name, eventqueue=None):
+        self._name = name
+        self._eventqueue = eventqueue
+        self._lock = threading.Lock()
+        self._log = conveyor.log.getlogger(self)
+        self._queue = collections.deque()
+        self._counts = [0 for priority in _PRIORITIES]
+        self._stats = _Stats()
+        self._delivering = False
+        # NOTE: the lane's current place on the event queue. A lane that
+        # gets an event of a higher priority takes a new place and the old
+        # one is skipped when its turn comes.
+        self._token = None
+        self._priority = None
+
+    def _enqueue(self, event, args, kwargs, priority=EventPriority.NORMAL):
+        if conveyor.log.isdebug(self._log):
+            self._log.debug(
+                'name=%r, event=%r, args=%r, kwargs=%r, priority=%r',
+                self._name, event, args, kwargs, priority)
+        tuple_ = event, args, kwargs, priority, time.time()
+        with self._lock:
             self._queue.appendleft(tuple_)
-            self._condition.notify_all()
+            self._counts[priority] += 1
+            if (self._delivering
+                    or (None is not self._priority
+                        and self._priority <= priority)):
+                token = None
+            else:
+                token = self._place(priority)
+        if None is not token:
+            self._schedule(token, priority)
+
+    def _place(self, priority):
+        self._token = object()
+        self._priority = priority
+        return self._token
+
+    def _schedule(self, token, priority):
+        eventqueue = self._eventqueue
+        if None is eventqueue:
+            eventqueue = geteventqueue()
+        eventqueue._enqueue(self, (token,), {}, priority)
+
+    def _deliver(self, args, kwargs):
+        # NOTE: the lane has at most one current place on the event queue, so
+        # only one thread at a time delivers its events.
+        token, = args
+        with self._lock:
+            if token is not self._token:
+                return
+            self._token = None
+            self._priority = None
+            self._delivering = True
+            now = time.time()
+            count = min(_LANE_BATCH_SIZE, len(self._queue))
+            batch = [self._queue.pop() for i in range(count)]
+            for event, args, kwargs, priority, enqueued in batch:
+                self._counts[priority] -= 1
+                self._stats.add(now - enqueued)
+        try:
+            for event, args, kwargs, priority, enqueued in batch:
+                event._deliver(args, kwargs)
+        finally:
+            with self._lock:
+                self._delivering = False
+                token = None
+                for priority, count in enumerate(self._counts):
+                    if 0 != count:
+                        token = self._place(priority)
+                        break
+        if None is not token:
+            self._schedule(token, priority)
+
+    def getstats(self):
+        """ Returns the depth and latency of the lane. """
+        with self._lock:
+            stats = self._stats.todict(len(self._queue))
+        return stats
+
+    def __repr__(self):
+        result = '%s(name=%r, eventqueue=%r)' % (
+            self.__class__.__name__, self._name, self._eventqueue)
+        return result
+
+class Lanes(object):
+    """ The lanes of an event queue by key. A lane lasts as long as something
+    (i.e., a task's events) refers to it.
+    """
+
+    def __init__(self, eventqueue=None):
+        self._eventqueue = eventqueue
+        self._lock = threading.Lock()
+        self._lanes = weakref.WeakValueDictionary()
+
+    def get(self, key):
+        with self._lock:
+            lane = self._lanes.get(key)
+            if None is lane:
+                lane = Lane(key, self._eventqueue)
+                self._lanes[key] = lane
+        return lane
+
+    def getstats(self):
+        """ Returns the depth and latency of each lane by name (i.e.,
+        "job:17").
+        """
+        with self._lock:
+            lanes = self._lanes.items()
+        stats = {}
+        for key, lane in lanes:
+            if isinstance(key, tuple):
+                name = ':'.join(unicode(part) for part in key)
+            else:
+                name = unicode(key)
+            stats[name] = lane.getstats()
+        return stats
 
 class Event(object):
     """ This represents some kind of event in the conveyor system, mostly 
@@ -112,38 +392,58 @@ class Event(object):
     a subproject or subsystem. 
     """
 
-    def __init__(self, name, eventqueue=None):
+    def __init__(
+            self, name, eventqueue=None, priority=EventPriority.NORMAL,
+            coalesce=False):
         """ Creates an event object.
         @param eventqueue if a specifi eventqueue is desired.
+        @param priority the `EventPriority` of the event's deliveries.
+        @param coalesce if the event is not queued again while it is waiting
+            to be delivered (for events whose handlers read the latest state,
+            i.e., heartbeats).
         """
         self._name = name
         self._eventqueue = eventqueue
+        self._priority = priority
+        self._coalesce = coalesce
+        self._pending = False
         self._handles = {}
         self._log = conveyor.log.getlogger(self)
 
     def attach(self, func):
         handle = object()
         self._handles[handle] = func
-        self._log.debug(
-            'name=%r, func=%r, handle=%r', self._name, func, handle)
+        if conveyor.log.isdebug(self._log):
+            self._log.debug(
+                'name=%r, func=%r, handle=%r', self._name, func, handle)
         return handle
 
     def detach(self, handle):
-        self._log.debug('handle=%r', handle)
+        if conveyor.log.isdebug(self._log):
+            self._log.debug('handle=%r', handle)
         del self._handles[handle]
 
     def __call__(self, *args, **kwargs):
         """allows calls as Event(foo) to work  """
-        self._log.debug(
-            'name=%r, args=%r, kwargs=%r', self._name, args, kwargs)
+        if conveyor.log.isdebug(self._log):
+            self._log.debug(
+                'name=%r, args=%r, kwargs=%r', self._name, args, kwargs)
+        if self._coalesce:
+            if self._pending:
+                return
+            self._pending = True
         eventqueue = self._eventqueue
         if None is eventqueue:
             eventqueue = geteventqueue()
-        eventqueue._enqueue(self, args, kwargs)
+        eventqueue._enqueue(self, args, kwargs, self._priority)
 
     def _deliver(self, args, kwargs):
-        self._log.debug(
-            'name=%r, args=%r, kwargs=%r', self._name, args, kwargs)
+        if conveyor.log.isdebug(self._log):
+            self._log.debug(
+                'name=%r, args=%r, kwargs=%r', self._name, args, kwargs)
+        # NOTE: the event is queued again as soon as its handlers may miss
+        # the state that fires it.
+        self._pending = False
         for func in self._handles.itervalues():
             try:
                 func(*args, **kwargs)
@@ -179,7 +479,7 @@ class EventQueueTestCase(unittest.TestCase):
         '''Test the event queue.'''
 
         eventqueue = geteventqueue()
-        eventqueue._queue.clear()
+        eventqueue._clear()
 
         event = Event('event')
         callback1 = Callback()
@@ -219,7 +519,7 @@ class EventQueueTestCase(unittest.TestCase):
         '''Test the runiteration method with an empty queue.'''
 
         eventqueue = geteventqueue()
-        eventqueue._queue.clear()
+        eventqueue._clear()
 
         self.assertFalse(eventqueue.runiteration(False))
 
@@ -227,7 +527,7 @@ class EventQueueTestCase(unittest.TestCase):
         '''Test waiting for an event to be delivered by a second thread.'''
 
         eventqueue = geteventqueue()
-        eventqueue._queue.clear()
+        eventqueue._clear()
 
         event = Event('event')
         callback = Callback()
@@ -245,7 +545,7 @@ class EventQueueTestCase(unittest.TestCase):
         '''Test the stop method.'''
 
         eventqueue = geteventqueue()
-        eventqueue._queue.clear()
+        eventqueue._clear()
 
         event1 = Event('event1')
         callback1 = Callback()
@@ -259,12 +559,87 @@ class EventQueueTestCase(unittest.TestCase):
         eventqueue.run()
         self.assertTrue(callback1.delivered)
         self.assertFalse(callback2.delivered)
+        eventqueue.runiteration(False)
+        self.assertTrue(callback2.delivered)
+
+    def test_run_threads(self):
+        '''Test that several threads deliver every event exactly once.'''
+
+        eventqueue = EventQueue()
+        lock = threading.Lock()
+        delivered = []
+        def callback(i):
+            with lock:
+                delivered.append(i)
+        event = Event('event', eventqueue)
+        event.attach(callback)
+        threads = [
+            EventQueueThread(eventqueue, 'event_thread_%d' % (i,))
+            for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(1000):
+            event(i)
+        for i in range(50):
+            with lock:
+                if 1000 == len(delivered):
+                    break
+            time.sleep(0.1)
+        for thread in threads:
+            thread.stop()
+        for thread in threads:
+            thread.join(5.0)
+        self.assertEqual(list(range(1000)), sorted(delivered))
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def test_priority(self):
+        '''Test that events are delivered by priority and then in order.'''
+
+        eventqueue = EventQueue()
+        delivered = []
+        events = [
+            Event(name, eventqueue, priority)
+            for name, priority in (
+                ('telemetry', EventPriority.TELEMETRY),
+                ('normal', EventPriority.NORMAL),
+                ('control', EventPriority.CONTROL))]
+        for event in events:
+            event.attach(delivered.append)
+        for i in range(3):
+            for event in events:
+                event(event._name + unicode(i))
+        while eventqueue.runiteration(False):
+            pass
+        self.assertEqual(
+            ['control0', 'control1', 'control2', 'normal0', 'normal1',
+                'normal2', 'telemetry0', 'telemetry1', 'telemetry2'],
+            delivered)
+
+    def test_getstats(self):
+        '''Test the depth and latency of each priority.'''
+
+        eventqueue = EventQueue()
+        event = Event('event', eventqueue, EventPriority.TELEMETRY)
+        event()
+        event()
+        stats = eventqueue.getstats()
+        self.assertEqual(
+            ['CONTROL', 'NORMAL', 'TELEMETRY'],
+            [dct['priority'] for dct in stats])
+        self.assertEqual(2, stats[2]['depth'])
+        self.assertEqual(0, stats[2]['delivered'])
+        while eventqueue.runiteration(False):
+            pass
+        stats = eventqueue.getstats()
+        self.assertEqual(0, stats[2]['depth'])
+        self.assertEqual(2, stats[2]['delivered'])
+        self.assertLessEqual(stats[2]['latency'], stats[2]['max_latency'])
 
     def test_Exception(self):
         '''Test an event handler that throws an exception.'''
 
         eventqueue = geteventqueue()
-        eventqueue._queue.clear()
+        eventqueue._clear()
 
         conveyor.test.listlogging('ERROR')
         conveyor.test.ListHandler.list = []
@@ -279,7 +654,119 @@ class EventQueueTestCase(unittest.TestCase):
         self.assertEqual(1, len(conveyor.test.ListHandler.list))
         self.assertEqual('internal error', conveyor.test.ListHandler.list[0].msg)
 
+class _LaneTestCase(unittest.TestCase):
+    def test_order(self):
+        '''Test that a lane delivers its events in order, one at a time.'''
+
+        eventqueue = EventQueue()
+        lane = Lane('lane', eventqueue)
+        lock = threading.Lock()
+        delivered = []
+        running = [0]
+        overlapped = [False]
+        def callback(i):
+            with lock:
+                running[0] += 1
+                overlapped[0] = overlapped[0] or 1 < running[0]
+            delivered.append(i)
+            with lock:
+                running[0] -= 1
+        event = Event('event', lane)
+        event.attach(callback)
+        threads = [
+            EventQueueThread(eventqueue, 'event_thread_%d' % (i,))
+            for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(1000):
+            event(i)
+        for i in range(50):
+            if 1000 == len(delivered):
+                break
+            time.sleep(0.1)
+        for thread in threads:
+            thread.stop()
+        for thread in threads:
+            thread.join(5.0)
+        self.assertEqual(list(range(1000)), delivered)
+        self.assertFalse(overlapped[0])
+
+    def test_fair(self):
+        '''Test that a busy lane does not hold up the other lanes.'''
+
+        eventqueue = EventQueue()
+        lanes = Lanes(eventqueue)
+        delivered = []
+        busy = Event('busy', lanes.get(('job', 1)))
+        busy.attach(lambda: delivered.append('busy'))
+        other = Event('other', lanes.get(('job', 2)))
+        other.attach(lambda: delivered.append('other'))
+        for i in range(100):
+            busy()
+        other()
+        while eventqueue.runiteration(False):
+            pass
+        self.assertEqual(101, len(delivered))
+        self.assertGreaterEqual(_LANE_BATCH_SIZE, delivered.index('other'))
+
+    def test_priority(self):
+        '''Test that a lane with a control event goes ahead of the lanes
+        with telemetry but keeps its own events in order.'''
+
+        eventqueue = EventQueue()
+        lanes = Lanes(eventqueue)
+        delivered = []
+        def event(key, name, priority):
+            event = Event(name, lanes.get(key), priority)
+            event.attach(lambda: delivered.append(name))
+            return event
+        other = event(('job', 2), 'other', EventPriority.TELEMETRY)
+        heartbeat = event(('job', 1), 'heartbeat', EventPriority.TELEMETRY)
+        cancel = event(('job', 1), 'cancel', EventPriority.CONTROL)
+        other()
+        heartbeat()
+        heartbeat()
+        cancel()
+        while eventqueue.runiteration(False):
+            pass
+        self.assertEqual(
+            ['heartbeat', 'heartbeat', 'cancel', 'other'], delivered)
+        self.assertEqual(
+            {'job:1': 3, 'job:2': 1},
+            dict((name, dct['delivered'])
+                for name, dct in lanes.getstats().items()))
+
+    def test_Lanes(self):
+        '''Test that there is one lane for each key while it is in use.'''
+
+        lanes = Lanes()
+        lane = lanes.get(('job', 1))
+        self.assertIs(lane, lanes.get(('job', 1)))
+        self.assertIsNot(lane, lanes.get(('job', 2)))
+        del lane
+        import gc
+        gc.collect()
+        self.assertEqual(0, len(lanes._lanes))
+
 class _EventTestCase(unittest.TestCase):
+    def test_coalesce(self):
+        '''Test that a coalesced event is queued once until it is
+        delivered.'''
+
+        eventqueue = EventQueue()
+        calls = []
+        event = Event('event', eventqueue, coalesce=True)
+        event.attach(lambda: calls.append(None))
+        for i in range(5):
+            event()
+        while eventqueue.runiteration(False):
+            pass
+        self.assertEqual(1, len(calls))
+        event()
+        while eventqueue.runiteration(False):
+            pass
+        self.assertEqual(2, len(calls))
+
     def test___repr__(self):
         '''Test the __repr__ method of Event.'''
 
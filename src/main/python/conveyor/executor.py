@@ -0,0 +1,166 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/main/python/conveyor/executor.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import collections
+import threading
+
+import conveyor.error
+import conveyor.log
+import conveyor.stoppable
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class Executor(conveyor.stoppable.StoppableInterface):
+    '''
+    A fixed pool of worker threads that run submitted functions in the order
+    they were submitted. The queue is bounded: `submit` blocks while it is
+    full, which pushes back on whoever is producing the work (i.e., the thread
+    reading requests from a connection). A producer that must not block (i.e.,
+    `conveyor.reactor.Reactor`) submits without blocking and uses `whenready`
+    to stop producing until there is room.
+
+    '''
+
+    @classmethod
+    def create(cls, count, size, name):
+        executor = cls(size)
+        for i in range(count):
+            thread = threading.Thread(
+                target=executor.run, name='%s-%d' % (name, i))
+            thread.daemon = True
+            thread.start()
+            executor._threads.append(thread)
+        return executor
+
+    def __init__(self, size):
+        conveyor.stoppable.StoppableInterface.__init__(self)
+        self._condition = threading.Condition()
+        self._log = conveyor.log.getlogger(self)
+        self._queue = collections.deque()
+        self._size = size
+        self._stop = False
+        self._threads = []
+        self._waiters = []
+
+    def submit(self, func, block=True):
+        '''
+        Queue `func` to run on a worker thread. When `block` is false the queue
+        may grow past its bound; worker threads must use that to queue
+        follow-on work or they could all end up waiting on each other.
+
+        '''
+
+        with self._condition:
+            while (block and self._size <= len(self._queue)
+                    and not self._stop):
+                self._condition.wait()
+            self._queue.appendleft(func)
+            self._condition.notify_all()
+
+    def whenready(self, callback):
+        '''
+        Returns whether or not the queue has room. If it does not, `callback`
+        is called once (on a worker thread) when it does.
+
+        '''
+
+        with self._condition:
+            result = self._size > len(self._queue) or self._stop
+            if not result:
+                self._waiters.append(callback)
+        return result
+
+    def run(self):
+        '''Run submitted functions on the current thread until stopped.'''
+
+        while True:
+            with self._condition:
+                while 0 == len(self._queue) and not self._stop:
+                    self._condition.wait()
+                if self._stop:
+                    break
+                else:
+                    func = self._queue.pop()
+                    self._condition.notify_all()
+                    if self._size > len(self._queue):
+                        waiters, self._waiters = self._waiters, []
+                    else:
+                        waiters = ()
+            for waiter in waiters:
+                conveyor.error.guard(self._log, waiter)
+            conveyor.error.guard(self._log, func)
+
+    def stop(self):
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+
+
+class _ExecutorTestCase(unittest.TestCase):
+    def test_submit(self):
+        '''Test that every submitted function runs.'''
+
+        executor = Executor.create(4, 2, 'test')
+        condition = threading.Condition()
+        results = []
+        def func(i):
+            with condition:
+                results.append(i)
+                condition.notify_all()
+        for i in range(100):
+            executor.submit(lambda i=i: func(i))
+        with condition:
+            while 100 != len(results):
+                condition.wait(1.0)
+        executor.stop()
+        self.assertEqual(list(range(100)), sorted(results))
+
+    def test_submit_Exception(self):
+        '''Test that an exception does not kill the worker thread.'''
+
+        executor = Executor.create(1, 2, 'test')
+        event = threading.Event()
+        def fail():
+            raise Exception('failure')
+        executor.submit(fail)
+        executor.submit(event.set)
+        event.wait(5.0)
+        executor.stop()
+        self.assertTrue(event.is_set())
+
+    def test_whenready(self):
+        '''Test that a waiter is called once the full queue has room.'''
+
+        executor = Executor(2)
+        ready = threading.Event()
+        self.assertTrue(executor.whenready(ready.set))
+        executor.submit(lambda: None, False)
+        executor.submit(lambda: None, False)
+        self.assertFalse(executor.whenready(ready.set))
+        thread = threading.Thread(target=executor.run)
+        thread.start()
+        self.assertTrue(ready.wait(5.0))
+        executor.stop()
+        thread.join(5.0)
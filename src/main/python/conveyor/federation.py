@@ -0,0 +1,696 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/main/python/conveyor/federation.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A conveyor service that serves the ports, machines, and jobs of other
+conveyor services (its nodes) as its own.
+
+The federation connects to each node as a client (see
+`conveyor.client.session.Session`). A node's port and machine names get the
+node's name as a prefix (i.e., `host1:/dev/ttyACM0`) and its jobs get job ids
+of the federation's own. The requests for a remote machine or job (`connect`,
+`disconnect`, `print`, `pause`, `unpause`, and `canceljob`) are sent to the
+node that owns it and the node's notifications are passed on to the
+federation's clients.
+
+A node that goes away is retried every `server.federation_retry` seconds. Its
+ports are reported detached in the meantime and its jobs keep their last known
+state until it comes back. A node may have restarted by then and numbered its
+jobs from 1 again, so its job ids only mean something within one connection:
+the jobs that had not stopped fail and the node's current jobs get new job
+ids. A stopped job that was already reported is kept as it is.
+
+'''
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import os.path
+import threading
+import time
+
+import conveyor.client.session
+import conveyor.error
+import conveyor.job
+import conveyor.log
+import conveyor.stoppable
+import conveyor.task
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+_SEPARATOR = ':'
+
+
+class Federation(object):
+    @classmethod
+    def create(cls, config, server):
+        federation = cls(
+            server, config.get('server', 'federation'),
+            config.get('server', 'federation_retry'),
+            config.get('server', 'federation_timeout'))
+        return federation
+
+    def __init__(self, server, addresses, retry, timeout):
+        '''
+        @param server the `conveyor.server.Server` that serves the nodes'
+            ports, machines, and jobs
+        @param addresses the nodes' `conveyor.address` addresses by name
+        '''
+        self._nodes = {}
+        for name, address in addresses.items():
+            self._nodes[name] = _Node(server, name, address, retry, timeout)
+
+    def start(self):
+        for node in self._nodes.values():
+            node.start()
+
+    def stop(self):
+        for node in self._nodes.values():
+            node.stop()
+
+    def owns(self, name):
+        '''Returns whether or not a port or machine name is a node's.'''
+
+        result = None is not self._split(name)[0]
+        return result
+
+    def get_ports(self):
+        ports = []
+        for node in self._nodes.values():
+            ports.extend(node.get_ports())
+        return ports
+
+    def get_machines(self):
+        machines = []
+        for node in self._nodes.values():
+            machines.extend(node.get_machines())
+        return machines
+
+    def connect(
+            self, machine_name, port_name, driver_name, profile_name,
+            persistent):
+        machine_node, machine_name = self._split(machine_name)
+        port_node, port_name = self._split(port_name)
+        if (None is not machine_node and None is not port_node
+                and machine_node is not port_node):
+            raise conveyor.error.PortMismatchException
+        node = machine_node or port_node
+        dct = node.request('connect', {
+            'machine_name': machine_name,
+            'port_name': port_name,
+            'driver_name': driver_name,
+            'profile_name': profile_name,
+            'persistent': persistent,
+        })
+        machine = node.update_machine(dct)
+        return machine
+
+    def disconnect(self, machine_name):
+        node, machine_name = self._split(machine_name)
+        node.request('disconnect', {'machine_name': machine_name})
+
+    def pause(self, machine_name):
+        node, machine_name = self._split(machine_name)
+        node.request('pause', {'machine_name': machine_name})
+
+    def unpause(self, machine_name):
+        node, machine_name = self._split(machine_name)
+        node.request('unpause', {'machine_name': machine_name})
+
+    def print(
+            self, machine_name, input_file, extruder_name,
+            gcode_processor_name, has_start_end, material_name, slicer_name,
+            slicer_settings, upload=False):
+        '''
+        Starts a print on a node and returns the job. When `upload` is true
+        the node does not share the input file; it is uploaded first.
+
+        '''
+
+        node, machine_name = self._split(machine_name)
+        if upload:
+            upload = node.upload(input_file)
+            input_file = {'upload': upload['id']}
+        dct = node.request('print', {
+            'machine_name': machine_name,
+            'input_file': input_file,
+            'extruder_name': extruder_name,
+            'gcode_processor_name': gcode_processor_name,
+            'has_start_end': has_start_end,
+            'material_name': material_name,
+            'slicer_name': slicer_name,
+            'slicer_settings': slicer_settings.todict(),
+        })
+        job = node.update_job(dct)
+        return job
+
+    def _split(self, name):
+        '''
+        Splits a node's port or machine name into the node and the name that
+        the node knows. The node is None for any other name.
+
+        '''
+
+        node = None
+        if None is not name and _SEPARATOR in name:
+            node_name, remote_name = name.split(_SEPARATOR, 1)
+            node = self._nodes.get(node_name)
+        if None is node:
+            result = None, name
+        else:
+            result = node, remote_name
+        return result
+
+
+class _RemoteInfo(object):
+    '''The port or machine information that a node sent.'''
+
+    def __init__(self, dct):
+        self.__dict__.update(dct)
+        self._dct = dct
+
+    def to_dict(self):
+        dct = dict(self._dct)
+        return dct
+
+
+class _RemotePort(object):
+    def __init__(self, dct):
+        self.name = dct['name']
+        self._info = _RemoteInfo(dct)
+
+    def get_info(self):
+        return self._info
+
+
+class _RemoteMachine(object):
+    def __init__(self, dct):
+        self.name = dct['name']
+        self._info = _RemoteInfo(dct)
+
+    def get_info(self):
+        return self._info
+
+
+class _RemoteJob(object):
+    '''
+    A node's job. It stands in for a `conveyor.job.Job` in the server's job
+    registry.
+
+    '''
+
+    def __init__(self, node, id, remote_id, type, name):
+        self.id = id
+        self.remote_id = remote_id
+        self.type = type
+        self.name = name
+        self.task = _RemoteTask(node, self)
+        self._info = None
+
+    def update(self, dct):
+        self._info = conveyor.job.JobInfo.from_dict(dct)
+        self.task.state = dct['state']
+        self.task.conclusion = dct['conclusion']
+
+    def fail(self, failure):
+        dct = self._info.to_dict()
+        dct['state'] = conveyor.task.TaskState.STOPPED
+        dct['conclusion'] = conveyor.task.TaskConclusion.FAILED
+        dct['failure'] = failure
+        self.update(dct)
+
+    def get_info(self):
+        return self._info
+
+
+class _RemoteTask(object):
+    def __init__(self, node, job):
+        self._node = node
+        self._job = job
+        self.state = conveyor.task.TaskState.PENDING
+        self.conclusion = None
+
+    def cancel(self):
+        self._node.request('canceljob', {'id': self._job.remote_id})
+
+
+class _Node(conveyor.stoppable.StoppableThread):
+    '''A connection to a node that is reopened whenever it is lost.'''
+
+    def __init__(self, server, node_name, address, retry, timeout):
+        conveyor.stoppable.StoppableThread.__init__(
+            self, name='federation_%s' % (node_name,))
+        self.daemon = True
+        self.node_name = node_name
+        self._server = server
+        self._address = address
+        self._retry = retry
+        self._timeout = timeout
+        self._log = conveyor.log.getlogger(self)
+        self._condition = threading.Condition()
+        self._stop = False
+        self._session = None
+        self._ports = {}
+        self._machines = {}
+        self._jobs = {}
+
+    def stop(self):
+        with self._condition:
+            self._stop = True
+            session = self._session
+            self._condition.notify_all()
+        if None is not session:
+            session.close()
+
+    def run(self):
+        while True:
+            with self._condition:
+                if self._stop:
+                    break
+            try:
+                session = self._connect()
+                if None is not session:
+                    self._log.info('connected to %s', self.node_name)
+                    session.wait()
+            except:
+                self._log.warning(
+                    'failed to connect to %s', self.node_name, exc_info=True)
+            finally:
+                self._lost()
+            with self._condition:
+                if not self._stop:
+                    self._condition.wait(self._retry)
+
+    def _connect(self):
+        session = conveyor.client.session.Session.connect(
+            self._address, timeout=self._timeout)
+        for method, func in (
+                ('port_attached', self._port_attached),
+                ('port_detached', self._port_detached),
+                ('machine_state_changed', self._machine_state_changed),
+                ('machine_temperature_changed',
+                    self._machine_temperature_changed),
+                ('jobadded', self._jobchanged),
+                ('jobchanged', self._jobchanged)):
+            session.addmethod(method, func)
+        with self._condition:
+            if self._stop:
+                session.close()
+                session = None
+            else:
+                self._session = session
+                stale = self._jobs
+                self._jobs = {}
+        if None is not session:
+            # NOTE: the notifications that arrive while the state is read are
+            # harmless; each one carries the whole port, machine, or job.
+            for dct in self.request('getports', {}):
+                self._port_attached(**dct)
+            for dct in self.request('getprinters', {}):
+                # NOTE: the printers without a port are the node's profiles,
+                # not machines.
+                if None is not dct.get('port_name'):
+                    machine = self.update_machine(dct)
+                    self._server._machine_state_changed(machine)
+            jobs = self.request('getjobs', {})
+            for dct in sorted(jobs.values(), key=lambda dct: dct['id']):
+                job = stale.get(dct['id'])
+                if (None is not job
+                        and conveyor.task.TaskState.STOPPED == job.task.state
+                        and conveyor.task.TaskState.STOPPED == dct['state']
+                        and dct['type'] == job.type
+                        and dct['name'] == job.name):
+                    with self._condition:
+                        self._jobs.setdefault(dct['id'], job)
+                else:
+                    self.update_job(dct)
+            for job in stale.values():
+                if conveyor.task.TaskState.STOPPED != job.task.state:
+                    job.fail('lost the connection to %s' % (self.node_name,))
+                    self._server._job_changed(job)
+        return session
+
+    def _lost(self):
+        with self._condition:
+            session = self._session
+            self._session = None
+            ports = self._ports
+            self._ports = {}
+            self._machines = {}
+        if None is not session:
+            session.close()
+            self._log.info('lost %s', self.node_name)
+        for port in ports.values():
+            self._server._port_detached(port.name)
+
+    def request(self, method, params):
+        with self._condition:
+            session = self._session
+        if None is session:
+            raise conveyor.error.NodeUnavailableException(self.node_name)
+        result = session.request(method, params).result(self._timeout)
+        return result
+
+    def upload(self, path):
+        with self._condition:
+            session = self._session
+        if None is session:
+            raise conveyor.error.NodeUnavailableException(self.node_name)
+        with open(path, 'rb') as fp:
+            result = session.upload(
+                fp, os.path.basename(path), timeout=self._timeout)
+        return result
+
+    def get_ports(self):
+        with self._condition:
+            ports = list(self._ports.values())
+        return ports
+
+    def get_machines(self):
+        with self._condition:
+            machines = list(self._machines.values())
+        return machines
+
+    def _prefix(self, dct, *fields):
+        dct = dict(dct)
+        for field in fields:
+            if None is not dct.get(field):
+                dct[field] = _SEPARATOR.join((self.node_name, dct[field]))
+        return dct
+
+    def _port_attached(self, *args, **kwargs):
+        port = _RemotePort(self._prefix(kwargs, 'name'))
+        with self._condition:
+            self._ports[kwargs['name']] = port
+        self._server._port_attached(port)
+
+    def _port_detached(self, *args, **kwargs):
+        with self._condition:
+            port = self._ports.pop(kwargs['port_name'], None)
+        if None is not port:
+            self._server._port_detached(port.name)
+
+    def update_machine(self, dct):
+        machine = _RemoteMachine(
+            self._prefix(dct, 'name', 'port_name', 'uniqueName'))
+        with self._condition:
+            self._machines[dct['name']] = machine
+        return machine
+
+    def _machine_state_changed(self, *args, **kwargs):
+        machine = self.update_machine(kwargs)
+        self._server._machine_state_changed(machine)
+
+    def _machine_temperature_changed(self, *args, **kwargs):
+        machine = self.update_machine(kwargs)
+        self._server._machine_temperature_changed(machine)
+
+    def _jobchanged(self, *args, **kwargs):
+        self.update_job(kwargs)
+
+    def update_job(self, dct):
+        '''
+        Records the state of one of the node's jobs and returns its stand-in.
+        A job the federation has not seen before gets a new job id.
+
+        '''
+
+        with self._condition:
+            job = self._jobs.get(dct['id'])
+            added = None is job
+            if added:
+                job = _RemoteJob(
+                    self, self._server._create_job_id(), dct['id'],
+                    dct['type'], dct['name'])
+                self._jobs[dct['id']] = job
+            dct = self._prefix(dct, 'machine_name', 'port_name')
+            dct['id'] = job.id
+            job.update(dct)
+        if added:
+            self._server._add_job(job)
+        if not added or conveyor.task.TaskState.STOPPED == job.task.state:
+            self._server._job_changed(job)
+        return job
+
+
+class _Daemon(object):
+    '''A stand-in for a node: a JSON-RPC peer on a local TCP port.'''
+
+    def __init__(self, port=0):
+        import socket
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', port))
+        self._socket.listen(1)
+        self.port = self._socket.getsockname()[1]
+        self.jsonrpc = None
+        self.jobs = {}
+        self.calls = []
+        self._connected = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        import conveyor.connection
+        import conveyor.jsonrpc
+        sock, addr = self._socket.accept()
+        connection = conveyor.connection.SocketConnection(sock, None)
+        self.jsonrpc = conveyor.jsonrpc.JsonRpc(connection, connection)
+        self.jsonrpc.addmethod(
+            'hello', lambda framing=None, codec=(), compression=():
+                self.jsonrpc.negotiate(framing, codec, compression))
+        self.jsonrpc.addmethod('getports', lambda: [
+            {'type': 'SERIAL', 'name': '/dev/ttyACM0', 'driver_profiles': {}}])
+        self.jsonrpc.addmethod('getprinters', lambda: [
+            {'name': 'bot', 'port_name': '/dev/ttyACM0',
+                'uniqueName': 'bot', 'state': 'IDLE'},
+            {'name': 'Replicator2', 'port_name': None,
+                'uniqueName': 'Replicator2', 'state': 'DISCONNECTED'}])
+        self.jsonrpc.addmethod('getjobs', lambda: dict(self.jobs))
+        self.jsonrpc.addmethod('print', self._print)
+        self.jsonrpc.addmethod('canceljob', self._canceljob)
+        self._connected.set()
+        self.jsonrpc.run()
+
+    def _job(self, id, state, conclusion=None):
+        job = conveyor.job.JobInfo(
+            'PRINT_JOB', id, 'bunny', state, None, conclusion, None, 'bot',
+            '/dev/ttyACM0', 's3g', 'Replicator2')
+        return job.to_dict()
+
+    def _print(self, **kwargs):
+        self.calls.append(('print', kwargs))
+        id = len(self.jobs) + 1
+        self.jobs[id] = self._job(id, conveyor.task.TaskState.RUNNING)
+        return self.jobs[id]
+
+    def _canceljob(self, id):
+        self.calls.append(('canceljob', id))
+        self.jobs[id] = self._job(
+            id, conveyor.task.TaskState.STOPPED,
+            conveyor.task.TaskConclusion.CANCELED)
+        self.jsonrpc.notify('jobchanged', self.jobs[id])
+
+    def wait(self):
+        self._connected.wait(5.0)
+
+    def close(self):
+        if None is not self.jsonrpc:
+            self.jsonrpc.stop()
+        self._socket.close()
+
+
+class _Server(object):
+    '''The parts of `conveyor.server.Server` that a federation uses.'''
+
+    def __init__(self):
+        import conveyor.jobstore
+        self.registry = conveyor.jobstore.JobRegistry(10)
+        self.notifications = []
+        self._condition = threading.Condition()
+
+    def _notify(self, *notification):
+        with self._condition:
+            self.notifications.append(notification)
+            self._condition.notify_all()
+
+    def wait(self, predicate):
+        with self._condition:
+            for i in range(50):
+                if predicate(self.notifications):
+                    break
+                self._condition.wait(0.1)
+        return predicate(self.notifications)
+
+    def _create_job_id(self):
+        return self.registry.create_job_id()
+
+    def _add_job(self, job):
+        self.registry.add(job)
+        self._notify('jobadded', job.id)
+
+    def _job_changed(self, job):
+        self.registry.changed(job)
+        self._notify('jobchanged', job.id, job.task.state)
+
+    def _port_attached(self, port):
+        self._notify('port_attached', port.name)
+
+    def _port_detached(self, port_name):
+        self._notify('port_detached', port_name)
+
+    def _machine_state_changed(self, machine):
+        self._notify('machine_state_changed', machine.name)
+
+    def _machine_temperature_changed(self, machine):
+        self._notify('machine_temperature_changed', machine.name)
+
+
+class _FederationTestCase(unittest.TestCase):
+    def setUp(self):
+        import conveyor.address
+        import conveyor.domain
+        import conveyor.event
+        import conveyor.slicer
+        # NOTE: everything that can fail comes before the threads start and
+        # each thread is stopped by a cleanup, even when setUp fails.
+        self._slicer_settings = conveyor.domain.SlicerConfiguration(
+            conveyor.slicer.Slicer.MIRACLEGRUE, '0', False, False, 0.1, 0.27,
+            2, 230, 110, 80, 100)
+        self._eventthread = conveyor.event.EventQueueThread(
+            conveyor.event.geteventqueue(), 'federation_event_thread')
+        self._eventthread.start()
+        self.addCleanup(self._eventthread.join, 5.0)
+        self.addCleanup(self._eventthread.stop)
+        self._daemons = {}
+        for name in ('a', 'b'):
+            self._daemons[name] = _Daemon()
+            self.addCleanup(self._daemons[name].close)
+        addresses = dict(
+            (name, conveyor.address.Address.address_factory(
+                'tcp:127.0.0.1:%d' % (daemon.port,)))
+            for name, daemon in self._daemons.items())
+        self._daemons['b'].jobs[1] = self._daemons['b']._job(
+            1, conveyor.task.TaskState.STOPPED,
+            conveyor.task.TaskConclusion.ENDED)
+        self._server = _Server()
+        self._federation = Federation(self._server, addresses, 0.1, 5.0)
+        self._federation.start()
+        self.addCleanup(self._federation.stop)
+
+    def _connected(self):
+        for i in range(50):
+            if (2 == len(self._federation.get_machines())
+                    and None is not self._server.registry.get_job(1)):
+                break
+            time.sleep(0.1)
+        result = 2 == len(self._federation.get_machines())
+        return result
+
+    def test_namespace(self):
+        '''Test that the nodes' ports, machines, and jobs are merged.'''
+
+        self.assertTrue(self._connected())
+        self.assertEqual(
+            ['a:/dev/ttyACM0', 'b:/dev/ttyACM0'],
+            sorted(port.name for port in self._federation.get_ports()))
+        machines = self._federation.get_machines()
+        self.assertEqual(
+            ['a:bot', 'b:bot'], sorted(machine.name for machine in machines))
+        self.assertEqual(
+            'a:/dev/ttyACM0',
+            [m for m in machines if 'a:bot' == m.name][0].get_info().port_name)
+        self.assertTrue(self._federation.owns('a:bot'))
+        self.assertFalse(self._federation.owns('c:bot'))
+        self.assertFalse(self._federation.owns('bot'))
+        info = self._server.registry.get_info(1)
+        self.assertEqual('b:bot', info['machine_name'])
+        self.assertEqual(conveyor.task.TaskState.STOPPED, info['state'])
+
+    def test_print(self):
+        '''Test that a print and its cancellation go to the owning node.'''
+
+        self.assertTrue(self._connected())
+        job = self._federation.print(
+            'b:bot', '/tmp/bunny.gcode', '0', None, True, 'PLA',
+            'miraclegrue', self._slicer_settings)
+        self.assertEqual(2, job.id)
+        self.assertEqual(2, job.remote_id)
+        self.assertEqual([], self._daemons['a'].calls)
+        method, params = self._daemons['b'].calls[0]
+        self.assertEqual('bot', params['machine_name'])
+        self.assertEqual('/tmp/bunny.gcode', params['input_file'])
+        job.task.cancel()
+        self.assertTrue(self._server.wait(
+            lambda notifications: (
+                'jobchanged', 2, conveyor.task.TaskState.STOPPED)
+                in notifications))
+        self.assertEqual(
+            conveyor.task.TaskConclusion.CANCELED,
+            self._server.registry.get_info(2)['conclusion'])
+
+    def test_lost(self):
+        '''Test that a node's ports are detached when it goes away.'''
+
+        self.assertTrue(self._connected())
+        self._daemons['a'].close()
+        self.assertTrue(self._server.wait(
+            lambda notifications:
+                ('port_detached', 'a:/dev/ttyACM0') in notifications))
+        self.assertEqual(
+            ['b:bot'],
+            [machine.name for machine in self._federation.get_machines()])
+        with self.assertRaises(conveyor.error.NodeUnavailableException):
+            self._federation.pause('a:bot')
+
+    def test_restart(self):
+        '''Test that a node's jobs are reconciled when it restarts.'''
+
+        self.assertTrue(self._connected())
+        job = self._federation.print(
+            'a:bot', '/tmp/bunny.gcode', '0', None, True, 'PLA',
+            'miraclegrue', self._slicer_settings)
+        self.assertEqual((2, 1), (job.id, job.remote_id))
+        port = self._daemons['a'].port
+        self._daemons['a'].close()
+        self.assertTrue(self._server.wait(
+            lambda notifications:
+                ('port_detached', 'a:/dev/ttyACM0') in notifications))
+        # NOTE: the restarted node runs another print of the same model
+        # under the same job id.
+        daemon = _Daemon(port)
+        self.addCleanup(daemon.close)
+        daemon.jobs[1] = daemon._job(1, conveyor.task.TaskState.RUNNING)
+        self.assertTrue(self._server.wait(
+            lambda notifications: ('jobadded', 3) in notifications))
+        self.assertTrue(self._server.wait(
+            lambda notifications: (
+                'jobchanged', 2, conveyor.task.TaskState.STOPPED)
+                in notifications))
+        info = self._server.registry.get_info(2)
+        self.assertEqual(
+            conveyor.task.TaskConclusion.FAILED, info['conclusion'])
+        self.assertEqual('lost the connection to a', info['failure'])
+        info = self._server.registry.get_info(3)
+        self.assertEqual(conveyor.task.TaskState.RUNNING, info['state'])
+        self.assertEqual('a:bot', info['machine_name'])
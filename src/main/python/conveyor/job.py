@@ -76,6 +76,11 @@ class Job(object):
         self.id = id_
         self.name = name
         self.task = None
+        # NOTE: the work of a job with a higher priority runs first and the
+        # owners (clients) of jobs share the work slots (see
+        # `conveyor.scheduler.Scheduler`).
+        self.priority = 0
+        self.owner = None
 
     def _get_machine_name(self):
         return None
@@ -0,0 +1,381 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/main/python/conveyor/jobstore.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+The conveyor service's jobs.
+
+The `JobRegistry` keeps the jobs that are running and the most recent jobs
+that stopped. Older jobs are moved to a `JobArchive` (a SQLite database; see
+conveyor/doc/storage.md), which keeps only their `conveyor.job.JobInfo`.
+
+Every change to a job gets the next number of a sequence that only goes up.
+A client that remembers the sequence number of its last query can ask for
+just the jobs that changed since then.
+
+'''
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import collections
+import sqlite3
+import threading
+
+import conveyor.error
+import conveyor.json
+import conveyor.log
+import conveyor.task
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class JobArchive(object):
+    '''The jobs that stopped long ago, in a SQLite database.'''
+
+    @classmethod
+    def create(cls, path, limit):
+        '''
+        @param path the database file (or ':memory:')
+        @param limit the number of jobs to keep (0 keeps all of them)
+        '''
+        # NOTE: the connection is used from many threads; the lock serializes
+        # them.
+        connection = sqlite3.connect(path, check_same_thread=False)
+        connection.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                sequence INTEGER NOT NULL,
+                type TEXT,
+                state TEXT,
+                machine_name TEXT,
+                info TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_sequence ON jobs (sequence);
+        ''')
+        archive = cls(connection, limit)
+        return archive
+
+    def __init__(self, connection, limit):
+        self._connection = connection
+        self._limit = limit
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def getmaximums(self):
+        '''Returns the largest job id and sequence number in the archive.'''
+
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT MAX(id), MAX(sequence) FROM jobs').fetchone()
+        result = row[0] or 0, row[1] or 0
+        return result
+
+    def add(self, infos):
+        '''Archives a list of `(sequence, JobInfo)`.'''
+
+        rows = []
+        for sequence, info in infos:
+            data = conveyor.json.dumps(info.to_dict())
+            rows.append((
+                info.id, sequence, info.type, info.state, info.machine_name,
+                data))
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+                    rows)
+                if 0 != self._limit:
+                    self._connection.execute(
+                        'DELETE FROM jobs WHERE id NOT IN'
+                        ' (SELECT id FROM jobs ORDER BY id DESC LIMIT ?)',
+                        (self._limit,))
+
+    def get(self, job_id):
+        '''Returns the `JobInfo` dictionary for a job or `None`.'''
+
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT info FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if None is row:
+            result = None
+        else:
+            result = conveyor.json.loads(row[0])
+        return result
+
+    def query(self, states, types, machine_names, since, limit):
+        '''
+        Returns the number of matching jobs and the `JobInfo` dictionaries of
+        the first `limit` of them (all of them when `limit` is `None`) in
+        order of their ids.
+
+        '''
+
+        clauses = []
+        params = []
+        for column, values in (
+                ('state', states), ('type', types),
+                ('machine_name', machine_names)):
+            if None is not values:
+                clauses.append(
+                    '%s IN (%s)' % (column, ', '.join('?' * len(values))))
+                params.extend(values)
+        if None is not since:
+            clauses.append('sequence > ?')
+            params.append(since)
+        if 0 == len(clauses):
+            where = ''
+        else:
+            where = ' WHERE ' + ' AND '.join(clauses)
+        if None is limit:
+            limit = -1
+        with self._lock:
+            total, = self._connection.execute(
+                'SELECT COUNT(*) FROM jobs' + where, params).fetchone()
+            rows = self._connection.execute(
+                'SELECT info FROM jobs' + where + ' ORDER BY id LIMIT ?',
+                params + [limit]).fetchall()
+        infos = [conveyor.json.loads(row[0]) for row in rows]
+        return total, infos
+
+
+class JobRegistry(object):
+    '''
+    The jobs in memory: all of the jobs that have not stopped and the last
+    `history` jobs that did. When a job falls out of the history it goes to
+    the archive (or it is forgotten if there is no archive).
+
+    '''
+
+    def __init__(self, history, archive=None):
+        self._history = history
+        self._archive = archive
+        self._log = conveyor.log.getlogger(self)
+        self._condition = threading.Condition()
+        self._jobs = {}
+        self._sequences = {}
+        self._stopped = collections.deque()
+        if None is archive:
+            self._job_id_counter, self._sequence = 0, 0
+        else:
+            self._job_id_counter, self._sequence = archive.getmaximums()
+
+    def close(self):
+        if None is not self._archive:
+            self._archive.close()
+
+    def create_job_id(self):
+        with self._condition:
+            self._job_id_counter += 1
+            id_ = self._job_id_counter
+        return id_
+
+    def add(self, job):
+        with self._condition:
+            self._jobs[job.id] = job
+            self._sequence += 1
+            self._sequences[job.id] = self._sequence
+
+    def changed(self, job):
+        '''
+        Records a change to a job. A job that stopped joins the history and
+        may push the oldest job in the history to the archive.
+
+        '''
+
+        with self._condition:
+            if job.id in self._jobs:
+                self._sequence += 1
+                self._sequences[job.id] = self._sequence
+                if (conveyor.task.TaskState.STOPPED == job.task.state
+                        and job.id not in self._stopped):
+                    self._stopped.append(job.id)
+                    evicted = []
+                    while self._history < len(self._stopped):
+                        job_id = self._stopped.popleft()
+                        evicted.append((
+                            self._sequences.pop(job_id),
+                            self._jobs.pop(job_id).get_info()))
+                    if None is not self._archive and 0 != len(evicted):
+                        # NOTE: the jobs are archived with the lock held so
+                        # that a query never misses them while they move.
+                        conveyor.error.guard(
+                            self._log, lambda: self._archive.add(evicted))
+
+    def get_job(self, job_id):
+        '''Returns a job in memory or `None`.'''
+
+        with self._condition:
+            job = self._jobs.get(job_id)
+        return job
+
+    def get_jobs(self):
+        with self._condition:
+            jobs = self._jobs.copy()
+        return jobs
+
+    def get_info(self, job_id):
+        '''
+        Returns the `JobInfo` dictionary for a job in memory or in the
+        archive. Raises an `UnknownJobError` for any other job.
+
+        '''
+
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if None is not job:
+                result = job.get_info().to_dict()
+            elif None is not self._archive:
+                result = self._archive.get(job_id)
+            else:
+                result = None
+        if None is result:
+            raise conveyor.error.UnknownJobError(job_id)
+        return result
+
+    def query(
+            self, states=None, types=None, machine_names=None, since=None,
+            offset=0, limit=None):
+        '''
+        Returns the current sequence number, the number of jobs that match,
+        and the `JobInfo` dictionaries of the matching jobs from `offset` to
+        `offset + limit` in order of their ids. A job matches when its state,
+        type, and machine name are in the lists that are not `None` and (if
+        `since` is not `None`) it changed after sequence number `since`.
+
+        '''
+
+        with self._condition:
+            sequence = self._sequence
+            infos = []
+            for job_id, job in self._jobs.items():
+                info = job.get_info()
+                if ((None is states or info.state in states)
+                        and (None is types or info.type in types)
+                        and (None is machine_names
+                            or info.machine_name in machine_names)
+                        and (None is since
+                            or since < self._sequences[job_id])):
+                    infos.append(info.to_dict())
+            if None is self._archive:
+                total, archived = 0, []
+            else:
+                if None is limit:
+                    archive_limit = None
+                else:
+                    archive_limit = offset + limit
+                total, archived = self._archive.query(
+                    states, types, machine_names, since, archive_limit)
+        total += len(infos)
+        infos.extend(archived)
+        infos.sort(key=lambda info: info['id'])
+        if None is limit:
+            infos = infos[offset:]
+        else:
+            infos = infos[offset:offset + limit]
+        return sequence, total, infos
+
+
+class _Job(object):
+    def __init__(self, id, type, machine_name):
+        self.id = id
+        self.type = type
+        self.machine_name = machine_name
+        self.task = conveyor.task.Task()
+
+    def get_info(self):
+        import conveyor.job
+        info = conveyor.job.JobInfo(
+            self.type, self.id, 'job-%d' % (self.id,), self.task.state, None,
+            self.task.conclusion, None, self.machine_name, None, None, None)
+        return info
+
+
+class _JobRegistryTestCase(unittest.TestCase):
+    def _create(self, history):
+        archive = JobArchive.create(':memory:', 0)
+        registry = JobRegistry(history, archive)
+        jobs = []
+        for i in range(10):
+            job = _Job(
+                registry.create_job_id(), ('SLICE_JOB', 'PRINT_JOB')[i % 2],
+                None if 0 == i % 2 else 'replicator')
+            registry.add(job)
+            jobs.append(job)
+        return archive, registry, jobs
+
+    def _stop(self, registry, job):
+        job.task.start()
+        job.task.end(None)
+        registry.changed(job)
+
+    def test_changed(self):
+        '''Test that the oldest stopped jobs move to the archive.'''
+
+        archive, registry, jobs = self._create(2)
+        for job in jobs[:5]:
+            self._stop(registry, job)
+        self.assertEqual([4, 5, 6, 7, 8, 9, 10], sorted(registry.get_jobs()))
+        self.assertEqual(3, archive.query(None, None, None, None, None)[0])
+        self.assertEqual('STOPPED', registry.get_info(1)['state'])
+        self.assertEqual('PENDING', registry.get_info(10)['state'])
+        with self.assertRaises(conveyor.error.UnknownJobError):
+            registry.get_info(11)
+        self.assertEqual((3, 13), archive.getmaximums())
+        self.assertEqual(4, JobRegistry(2, archive).create_job_id())
+
+    def test_query(self):
+        '''Test that a query covers both memory and the archive.'''
+
+        archive, registry, jobs = self._create(0)
+        for job in jobs[:6]:
+            self._stop(registry, job)
+        sequence, total, infos = registry.query()
+        self.assertEqual(16, sequence)
+        self.assertEqual(10, total)
+        self.assertEqual(list(range(1, 11)), [info['id'] for info in infos])
+        sequence, total, infos = registry.query(offset=4, limit=3)
+        self.assertEqual(10, total)
+        self.assertEqual([5, 6, 7], [info['id'] for info in infos])
+        sequence, total, infos = registry.query(
+            states=['STOPPED'], types=['PRINT_JOB'])
+        self.assertEqual([2, 4, 6], [info['id'] for info in infos])
+        sequence, total, infos = registry.query(
+            machine_names=['replicator'], since=13)
+        self.assertEqual([4, 6], [info['id'] for info in infos])
+        self._stop(registry, jobs[9])
+        sequence, total, infos = registry.query(since=16)
+        self.assertEqual(17, sequence)
+        self.assertEqual([10], [info['id'] for info in infos])
+
+    def test_limit(self):
+        '''Test that the archive keeps only the newest jobs.'''
+
+        archive = JobArchive.create(':memory:', 3)
+        registry = JobRegistry(0, archive)
+        for i in range(5):
+            job = _Job(registry.create_job_id(), 'SLICE_JOB', None)
+            registry.add(job)
+            self._stop(registry, job)
+        total, infos = archive.query(None, None, None, None, None)
+        self.assertEqual([3, 4, 5], [info['id'] for info in infos])
@@ -22,6 +22,12 @@ from __future__ import (absolute_import, print_function, unicode_literals)
 import StringIO
 import decimal
 import json
+import re
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
 
 
 # Float is an abomination.
@@ -120,6 +126,34 @@ def load(fp, *args, **kwargs):
 # validation performed by S0 and S1: S0 only accepts whitespace while S1 will
 # accept anything. This is a subtle effect. Changing the validation will merely
 # have other subtle effects. Tread carefully.
+#
+# `feed` does not run the state machine one character at a time. In the states
+# where most characters are simply copied to the buffer (S0, S1, S2, S5, S6,
+# S9, and S10) it scans ahead with a regular expression for the next character
+# that can cause a transition and copies the text before it in a single write.
+# In S1 the expression also skips over complete strings, so a typical JSON-RPC
+# message is copied with one write per bracket that closes a top-level object
+# or array. The bracket stack is maintained inline. Every other transition is
+# delegated to `_consume`, which remains the reference implementation of the
+# state machine. The two must always agree; `_JsonReaderTestCase` checks this
+# by feeding the same text through both.
+
+# The text that S1 copies without a transition: anything other than a bracket
+# or string delimiter, and complete strings. The second expression is used
+# when comments are stripped. They are written in the "unrolled loop" form so
+# that a string that does not end within the chunk fails in linear time.
+_S1_RUN = re.compile(
+    r'[^"{}\[\]]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"{}\[\]]*)*', re.DOTALL)
+_S1_RUN_COMMENTS = re.compile(
+    r'[^"{}\[\]/]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"{}\[\]/]*)*', re.DOTALL)
+
+# The characters that may cause a transition out of S0, S2, {S5,S9}, and
+# {S6,S10}, respectively.
+_S0_SPECIAL = re.compile(r'[^ \t\n\r]')
+_S2_SPECIAL = re.compile(r'["\\]')
+_LINE_COMMENT_SPECIAL = re.compile(r'[\n\r]')
+_NOT_TAB = re.compile(r'[^\t]')
+
 
 class JsonReader(object):
     '''
@@ -150,6 +184,10 @@ class JsonReader(object):
     def __init__(self, callback, strip_comments):
         self._callback = callback
         self._strip_comments = strip_comments
+        if strip_comments:
+            self._s1_run = _S1_RUN_COMMENTS
+        else:
+            self._s1_run = _S1_RUN
         self._reset()
 
     def _reset(self):
@@ -314,10 +352,106 @@ class JsonReader(object):
             self._callback(data)
 
     def feed(self, data):
-        '''Feed data to the reader.'''
+        '''
+        Feed data to the reader.
+
+        The data is scanned in runs rather than one character at a time (see
+        the notes above). The effect on the buffer, the stack, the state, and
+        the callback is exactly the same as calling `_consume` for each
+        character.
 
-        for ch in data:
-            self._consume(ch)
+        '''
+
+        i = 0
+        length = len(data)
+        while i < length:
+            state = self._state
+            if 1 == state:
+                start = i
+                stack = self._stack
+                while True:
+                    i = self._s1_run.match(data, i).end()
+                    if length == i:
+                        self._buffer.write(data[start:])
+                        break
+                    ch = data[i]
+                    i += 1
+                    if '{' == ch or '[' == ch:
+                        stack.append(ch)
+                    elif '}' == ch or ']' == ch:
+                        if 0 == len(stack):
+                            send = True
+                        else:
+                            firstch = stack.pop()
+                            if (('{' == firstch and '}' != ch)
+                                    or ('[' == firstch and ']' != ch)):
+                                send = True
+                            else:
+                                send = (0 == len(stack))
+                        if send:
+                            self._buffer.write(data[start:i])
+                            self._send()
+                            break
+                    else:
+                        # NOTE: either the start of a string that does not
+                        # end within `data` or the first '/' of a comment.
+                        self._buffer.write(data[start:i - 1])
+                        self._consume(ch)
+                        break
+            elif 2 == state:
+                match = _S2_SPECIAL.search(data, i)
+                if None is match:
+                    self._buffer.write(data[i:])
+                    break
+                else:
+                    j = match.start()
+                    if '"' == data[j]:
+                        self._buffer.write(data[i:j + 1])
+                        self._state = 1
+                        i = j + 1
+                    elif j + 1 < length:
+                        # NOTE: this writes both the backslash and the escaped
+                        # character; it is the S2 -> S3 -> S2 round trip.
+                        self._buffer.write(data[i:j + 2])
+                        i = j + 2
+                    else:
+                        self._buffer.write(data[i:j + 1])
+                        self._state = 3
+                        i = j + 1
+            elif 0 == state:
+                match = _S0_SPECIAL.search(data, i)
+                if None is match:
+                    self._buffer.write(data[i:])
+                    break
+                else:
+                    j = match.start()
+                    if i != j:
+                        self._buffer.write(data[i:j])
+                    self._consume(data[j])
+                    i = j + 1
+            elif 5 == state or 9 == state:
+                match = _LINE_COMMENT_SPECIAL.search(data, i)
+                if None is match:
+                    j = length
+                else:
+                    j = match.start()
+                if i != j:
+                    self._buffer.write(_NOT_TAB.sub(' ', data[i:j]))
+                if j < length:
+                    self._consume(data[j])
+                i = j + 1
+            elif 6 == state or 10 == state:
+                j = data.find('*', i)
+                if -1 == j:
+                    j = length
+                if i != j:
+                    self._buffer.write(' ' * (j - i))
+                if j < length:
+                    self._consume(data[j])
+                i = j + 1
+            else:
+                self._consume(data[i])
+                i += 1
 
     def feedeof(self):
         '''
@@ -327,3 +461,89 @@ class JsonReader(object):
         '''
 
         self._send()
+
+
+class _JsonReaderTestCase(unittest.TestCase):
+    _TEXTS = [
+        '{"a": 1}',
+        '  [1, 2, [3, {"b": "}]"}]]\n{"c": null}',
+        '{"s": "a \\" quote, a \\\\ backslash, and a \\u00e9"}',
+        '// leading comment\n{"a": /* inner */ 1} // trailing\n',
+        '/* block\n\tcomment ** */ [1, 2 /* x */, "/* not a comment */"]',
+        '{"a": 1} / [2]',
+        '{"a": [1}',
+        '\t\r\n  ',
+        'x{"a": 1}',
+        '{"a": "unterminated',
+        '[1] [2]\t[3]',
+        '{"a": 1}/* eof',
+        '{"a": 1}// eof',
+    ]
+
+    def _read(self, text, strip_comments, chunk_size):
+        output = []
+        reader = JsonReader(output.append, strip_comments)
+        if None is chunk_size:
+            for ch in text:
+                reader._consume(ch)
+        else:
+            for i in range(0, len(text), chunk_size):
+                reader.feed(text[i:i + chunk_size])
+        reader.feedeof()
+        return output
+
+    def test_feed(self):
+        '''
+        Test that `feed` produces exactly the same callbacks as the
+        per-character state machine for every chunking of the input.
+
+        '''
+
+        for text in self._TEXTS:
+            for strip_comments in (False, True):
+                expected = self._read(text, strip_comments, None)
+                for chunk_size in (1, 2, 3, 5, 7, len(text) or 1):
+                    output = self._read(text, strip_comments, chunk_size)
+                    self.assertEqual(
+                        expected, output,
+                        (text, strip_comments, chunk_size))
+
+    def test_feed_strip_comments(self):
+        '''Test that stripped comments preserve line and column numbers.'''
+
+        text = '{"a": 1, // one\t1\n\t"b": /* two */ 2}'
+        output = self._read(text, True, 4)
+        self.assertEqual(1, len(output))
+        self.assertEqual(
+            '{"a": 1,       \t \n\t"b":           2}', output[0])
+        self.assertEqual({'a': 1, 'b': 2}, json.loads(output[0]))
+
+    def test_feed_callback_exception(self):
+        '''
+        Test that an exception raised by the callback propagates out of `feed`
+        and leaves the reader in its initial state.
+
+        '''
+
+        output = []
+        def callback(data):
+            output.append(data)
+            if 1 == len(output):
+                raise ValueError(data)
+        reader = JsonReader(callback, False)
+        with self.assertRaises(ValueError):
+            reader.feed('[1] [2]')
+        self.assertEqual(0, reader._state)
+        self.assertEqual([], reader._stack)
+        self.assertEqual('', reader._buffer.getvalue())
+        self.assertEqual(['[1]'], output)
+        reader.feed('[3]')
+        self.assertEqual(['[1]', '[3]'], output)
+
+    def test_loads(self):
+        '''Test that `loads` strips comments.'''
+
+        self.assertEqual(
+            {'a': [1, 2]}, loads('/* x */ {"a": [1, // y\n 2]}'))
+        with self.assertRaises(ValueError):
+            loads('[1] [2]')
@@ -21,21 +21,32 @@ from __future__ import (absolute_import, print_function, unicode_literals)
 
 import StringIO
 import codecs
+import collections
 import errno
 import json
 import logging
 import inspect
 import io
 import os
+import struct
 import sys
 import threading
+import time
+import zlib
 
+import conveyor.binary
 import conveyor.event
+import conveyor.executor
 import conveyor.json
 import conveyor.log
 import conveyor.stoppable
 import conveyor.task
 
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
 
 def install(jsonrpc, obj):
     for name, value in inspect.getmembers(obj):
@@ -43,7 +54,410 @@ def install(jsonrpc, obj):
             exported_name = getattr(value, '_jsonrpc_name', None)
             if None is exported_name:
                 exported_name = name
-            jsonrpc.addmethod(exported_name, value)
+            concurrency = getattr(value, '_jsonrpc_concurrency', None)
+            timeout = getattr(value, '_jsonrpc_timeout', None)
+            jsonrpc.addmethod(exported_name, value, concurrency, timeout)
+
+
+# The framings that the server will accept during the `hello` handshake, most
+# preferred first. The default `stream` framing is never negotiated; it is what
+# every connection starts with.
+FRAMINGS = ('length', 'line',)
+
+# The codecs and compressions that may be negotiated along with a framing, most
+# preferred first. The `binary` codec requires the `length` framing.
+CODECS = ('binary', 'json',)
+COMPRESSIONS = ('zlib',)
+
+# The default for the most bytes in one message of the `length` framing.
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class _Framing(object):
+    '''
+    Splits the incoming byte stream into messages and frames the outgoing
+    messages. The callback receives each incoming message as a `str` (or
+    `unicode` for the `stream` framing).
+
+    '''
+
+    name = None
+
+    def __init__(self, callback):
+        self._callback = callback
+        self.handoff = None
+
+    def feed(self, data):
+        raise NotImplementedError
+
+    def feedeof(self):
+        raise NotImplementedError
+
+    def frame(self, data):
+        raise NotImplementedError
+
+
+class _StreamFraming(_Framing):
+    '''
+    The original wire format: an unframed stream of JSON text. The message
+    boundaries are found by running `JsonReader` over every character.
+
+    '''
+
+    name = 'stream'
+
+    def __init__(self, callback):
+        _Framing.__init__(self, callback)
+        decoder_class = codecs.getincrementaldecoder('UTF-8')
+        self._decoder = decoder_class()
+        self._jsonreader = conveyor.json.JsonReader(callback, False)
+        self.careful = False
+
+    def feed(self, data):
+        if not self.careful:
+            text = self._decoder.decode(data)
+            self._jsonreader.feed(text)
+        else:
+            # TRICKY: the peer switches framing right after the message that
+            # completes the handshake and what follows may not even be UTF-8.
+            # Feed one byte at a time so that the bytes that follow that
+            # message go to the new framing (the `handoff`) instead of the
+            # `JsonReader`.
+            for i in range(len(data)):
+                text = self._decoder.decode(data[i:i + 1])
+                self._jsonreader.feed(text)
+                if None is not self.handoff:
+                    rest = data[i + 1:]
+                    if 0 != len(rest):
+                        self.handoff.feed(rest)
+                    break
+
+    def feedeof(self):
+        self._jsonreader.feedeof()
+
+    def frame(self, data):
+        return data
+
+
+class _LineFraming(_Framing):
+    '''
+    Newline-delimited JSON. `conveyor.json.dumps` never emits a raw newline
+    (they are escaped inside strings) so a message ends at the first one. A
+    message over `maxsize` bytes is rejected as soon as that many bytes are
+    pending without a newline.
+
+    '''
+
+    name = 'line'
+
+    def __init__(self, callback, maxsize=MAX_FRAME_SIZE):
+        _Framing.__init__(self, callback)
+        self._pending = []
+        self._size = 0
+        self._maxsize = maxsize
+
+    def feed(self, data):
+        start = 0
+        while True:
+            end = data.find(b'\n', start)
+            if -1 == end:
+                if start < len(data):
+                    self._pending.append(data[start:])
+                    self._size += len(data) - start
+                    self._check()
+                break
+            else:
+                self._pending.append(data[start:end])
+                self._size += end - start
+                self._check()
+                start = end + 1
+                message = b''.join(self._pending)
+                self._pending = []
+                self._size = 0
+                if 0 != len(message.strip()):
+                    self._callback(message)
+
+    def _check(self):
+        if self._maxsize < self._size:
+            raise ValueError(
+                'frame too large: %d bytes (at most %d)'
+                % (self._size, self._maxsize))
+
+    def feedeof(self):
+        message = b''.join(self._pending)
+        self._pending = []
+        self._size = 0
+        if 0 != len(message.strip()):
+            self._callback(message)
+
+    def frame(self, data):
+        return data + b'\n'
+
+
+class _LengthFraming(_Framing):
+    '''
+    Length-prefixed messages. Each message is preceded by its length in bytes
+    as a 4-byte, big-endian, unsigned integer. A length over `maxsize` is
+    rejected as soon as its header arrives, before any of the message is
+    buffered.
+
+    '''
+
+    name = 'length'
+
+    _HEADER = struct.Struct(str('>I'))
+
+    def __init__(self, callback, maxsize=MAX_FRAME_SIZE):
+        _Framing.__init__(self, callback)
+        self._buffer = bytearray()
+        self._maxsize = maxsize
+
+    def feed(self, data):
+        self._buffer.extend(data)
+        header_size = self._HEADER.size
+        offset = 0
+        try:
+            while header_size <= len(self._buffer) - offset:
+                size, = self._HEADER.unpack_from(
+                    buffer(self._buffer), offset)
+                if self._maxsize < size:
+                    raise ValueError(
+                        'frame too large: %d bytes (at most %d)'
+                        % (size, self._maxsize))
+                start = offset + header_size
+                end = start + size
+                if len(self._buffer) < end:
+                    break
+                else:
+                    message = bytes(self._buffer[start:end])
+                    offset = end
+                    self._callback(message)
+        finally:
+            del self._buffer[:offset]
+
+    def feedeof(self):
+        if 0 != len(self._buffer):
+            self._callback(bytes(self._buffer))
+            del self._buffer[:]
+
+    def frame(self, data):
+        result = self._HEADER.pack(len(data)) + data
+        return result
+
+
+class _ZlibFraming(_Framing):
+    '''
+    Streaming zlib compression around another framing. Every outgoing message
+    is flushed with `Z_SYNC_FLUSH` so that the peer can decode it right away
+    while still sharing the compression history with earlier messages.
+
+    '''
+
+    def __init__(self, framing):
+        _Framing.__init__(self, None)
+        self._framing = framing
+        self._compressor = zlib.compressobj()
+        self._decompressor = zlib.decompressobj()
+        self.name = framing.name
+
+    def feed(self, data):
+        try:
+            data = self._decompressor.decompress(data)
+        except zlib.error as e:
+            raise ValueError(*e.args)
+        self._framing.feed(data)
+
+    def feedeof(self):
+        self._framing.feed(self._decompressor.flush())
+        self._framing.feedeof()
+
+    def frame(self, data):
+        data = self._framing.frame(data)
+        result = (self._compressor.compress(data)
+            + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        return result
+
+
+class _JsonCodec(object):
+    name = 'json'
+
+    def encode(self, message):
+        result = conveyor.json.dumps(message).encode('UTF-8')
+        return result
+
+    def decode(self, data):
+        result = json.loads(data)
+        return result
+
+
+class _BinaryCodec(object):
+    name = 'binary'
+
+    def encode(self, message):
+        result = conveyor.binary.dumps(message)
+        return result
+
+    def decode(self, data):
+        result = conveyor.binary.loads(data)
+        return result
+
+
+class Notification(object):
+    '''
+    A notification that is encoded once no matter how many connections it is
+    sent to (see `JsonRpc.sendnotification`). The encoded message is cached for
+    each codec and the framed message for each codec and framing; only
+    compressed connections frame it on their own.
+
+    '''
+
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self._encoded = {}
+        self._framed = {}
+
+    def encode(self, codec):
+        # NOTE: there is no lock. Two threads may both encode the message but
+        # they produce the same data.
+        data = self._encoded.get(codec.name)
+        if None is data:
+            message = {
+                'jsonrpc': '2.0', 'method': self.method,
+                'params': self.params}
+            data = codec.encode(message)
+            self._encoded[codec.name] = data
+        return data
+
+    def frame(self, codec, framing):
+        if isinstance(framing, _ZlibFraming):
+            data = framing.frame(self.encode(codec))
+        else:
+            cachekey = (codec.name, framing.__class__)
+            data = self._framed.get(cachekey)
+            if None is data:
+                data = framing.frame(self.encode(codec))
+                self._framed[cachekey] = data
+        return data
+
+
+def _createcodec(name):
+    if 'json' == name:
+        codec = _JsonCodec()
+    elif 'binary' == name:
+        codec = _BinaryCodec()
+    else:
+        raise ValueError(name)
+    return codec
+
+
+def _createframing(name, callback, maxframesize=MAX_FRAME_SIZE):
+    if 'stream' == name:
+        framing = _StreamFraming(callback)
+    elif 'line' == name:
+        framing = _LineFraming(callback, maxframesize)
+    elif 'length' == name:
+        framing = _LengthFraming(callback, maxframesize)
+    else:
+        raise ValueError(name)
+    return framing
+
+
+class _MethodInfo(object):
+    '''
+    The dispatch limits for a method. At most `concurrency` requests for the
+    method run at the same time (the rest wait in `waiting`) and a response is
+    sent within `timeout` seconds. Either may be None for no limit.
+
+    '''
+
+    def __init__(self, concurrency, timeout):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = collections.deque()
+
+
+class _Reply(object):
+    '''
+    The response to a request that runs on the executor. Only the first of the
+    method's response and the timeout error is passed to the callback. The
+    response is None for a notification.
+
+    '''
+
+    def __init__(self, jsonrpc, id, callback):
+        self._jsonrpc = jsonrpc
+        self._id = id
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._sent = False
+        self.timer = None
+
+    def send(self, response):
+        with self._lock:
+            sent = self._sent
+            self._sent = True
+        if not sent:
+            if None is not self.timer:
+                self.timer.cancel()
+            self._callback(response)
+
+    def expire(self):
+        response = self._jsonrpc._timedout(self._id)
+        self.send(response)
+
+
+class _Batch(object):
+    '''
+    A batch request whose elements run in parallel on the executor. The
+    responses are put back together in the order of the requests and sent as
+    one array once every element has finished or when the deadline passes. At
+    the deadline the unfinished requests get a timeout error instead.
+
+    '''
+
+    def __init__(self, jsonrpc, ids):
+        self._jsonrpc = jsonrpc
+        self._ids = ids
+        self._lock = threading.Lock()
+        self._responses = [None] * len(ids)
+        self._finished = [False] * len(ids)
+        self._remaining = len(ids)
+        self._sent = False
+        self.timer = None
+
+    def complete(self, index, response):
+        with self._lock:
+            if self._sent:
+                send = False
+            else:
+                self._responses[index] = response
+                self._finished[index] = True
+                self._remaining -= 1
+                send = 0 == self._remaining
+                self._sent = send
+        if send:
+            if None is not self.timer:
+                self.timer.cancel()
+            self._send()
+
+    def expire(self):
+        with self._lock:
+            send = not self._sent
+            self._sent = True
+            if send:
+                for index, id in enumerate(self._ids):
+                    if not self._finished[index] and None is not id:
+                        self._responses[index] = self._jsonrpc._timedout(id)
+        if send:
+            self._send()
+
+    def _send(self):
+        responses = [
+            response for response in self._responses if None is not response]
+        if 0 != len(responses):
+            self._jsonrpc._sendresponse(responses)
 
 
 class JsonRpcException(Exception):
@@ -59,26 +473,42 @@ class JsonRpc(conveyor.stoppable.StoppableInterface):
     gets entire valid JSON blocks of data to process, by buffering up data 
     into complete blocks and only passing on entirer JSON blocks 
     """
-    def __init__(self, infp, outfp):
+    def __init__(
+            self, infp, outfp, executor=None, batchtimeout=None,
+            maxframesize=MAX_FRAME_SIZE, eventqueue=None):
         """
         @param infp input file pointer must have .read() and .stop()
         @param outfp output file pointer. must have .write()
+        @param executor an optional conveyor.executor.Executor. Requests run
+            on it (instead of the thread that calls .run()) and their
+            responses are written as they complete. The elements of a batch
+            run in parallel
+        @param batchtimeout an optional deadline in seconds for the response
+            to a batch that runs on the executor
+        @param maxframesize the most bytes in one message of the `line` and
+            `length` framings; a longer message is invalid data
+        @param eventqueue an optional conveyor.event.EventQueue for the
+            tasks of outgoing requests (instead of the global one)
         """
+        self._batchtimeout = batchtimeout
+        self._block = True
+        self._codec = _JsonCodec()
         self._condition = threading.Condition()
+        self._eventqueue = eventqueue
+        self._executor = executor
         self._idcounter = 0
+        self._framing = _StreamFraming(self._jsonreadercallback)
+        self._helloid = None
         self._infp = infp # contract: .read(), .stop(), .close()
-        self._jsonreader = conveyor.json.JsonReader(
-            self._jsonreadercallback, False)
         self._log = conveyor.log.getlogger(self)
+        self._maxframesize = maxframesize
         self._methods = {}
         self._methodsinfo={}
-        self._outfp = outfp # contract: .write(str), .close()
+        self._outfp = outfp # contract: .write(str[, key]), .flush(), .close()
+        self._pendingframing = None
+        self._sendlock = threading.Lock()
         self._stopped = False
         self._tasks = {}
-        reader_class = codecs.getreader('UTF-8')
-        self._infp_reader = reader_class(self._infp)
-        writer_class = codecs.getwriter('UTF-8')
-        self._outfp_writer = writer_class(self._outfp)
 
     #
     # Common part
@@ -87,20 +517,27 @@ class JsonRpc(conveyor.stoppable.StoppableInterface):
     def _jsonreadercallback(self, indata):
         self._log.debug('indata=%r', indata)
         try:
-            parsed = json.loads(indata)
+            parsed = self._codec.decode(indata)
         except ValueError:
             response = self._parseerror()
         else:
             if isinstance(parsed, dict):
-                response = self._handleobject(parsed)
+                if None is not self._executor and self._isrequest(parsed):
+                    self._dispatch(parsed, self._sendoptional, None)
+                    response = None
+                else:
+                    response = self._handleobject(parsed)
             elif isinstance(parsed, list):
-                response = self._handlearray(parsed)
+                if None is not self._executor and 0 != len(parsed):
+                    self._dispatcharray(parsed)
+                    response = None
+                else:
+                    response = self._handlearray(parsed)
             else:
                 response = self._invalidrequest(None)
         self._log.debug('response=%r', response)
         if None is not response:
-            outdata = conveyor.json.dumps(response)
-            self._send(outdata)
+            self._sendresponse(response)
 
     def _handleobject(self, parsed):
         if not isinstance(parsed, dict):
@@ -173,6 +610,10 @@ class JsonRpc(conveyor.stoppable.StoppableInterface):
         response = self._errorresponse(id, -32600, 'invalid request')
         return response
 
+    def _timedout(self, id):
+        response = self._errorresponse(id, -32003, 'method timed out')
+        return response
+
     def _methodnotfound(self, id):
         response = self._errorresponse(id, -32601, 'method not found')
         return response
@@ -181,28 +622,126 @@ class JsonRpc(conveyor.stoppable.StoppableInterface):
         response = self._errorresponse(id, -32602, 'invalid params')
         return response
 
-    def _send(self, data):
-        self._log.debug('data=%r', data)
-        self._outfp_writer.write(data)
+    def _send(self, message, flush=False, key=None):
+        self._log.debug('message=%r', message)
+        self._write(message, flush, key)
+
+    def _sendresponse(self, response):
+        self._log.debug('response=%r', response)
+        self._write(response, True, None)
+
+    def _sendoptional(self, response):
+        if None is not response:
+            self._sendresponse(response)
+
+    def _write(self, message, flush, key):
+        # NOTE: the message is encoded outside of the lock. It is encoded again
+        # in the unlikely case that the codec changed in the meantime.
+        # Notifications cache their encoding so they are encoded and framed
+        # (once for all connections) under the lock.
+        notification = isinstance(message, Notification)
+        codec = self._codec
+        if not notification:
+            outdata = codec.encode(message)
+        with self._sendlock:
+            if notification:
+                data = message.frame(self._codec, self._framing)
+            else:
+                if codec is not self._codec:
+                    outdata = self._codec.encode(message)
+                data = self._framing.frame(outdata)
+            if None is key or isinstance(self._framing, _ZlibFraming):
+                # NOTE: compressed data depends on everything compressed
+                # before it so it can never replace queued data.
+                self._outfp.write(data)
+            else:
+                self._outfp.write(data, key)
+            if (None is not self._pendingframing and not notification
+                    and (isinstance(message, list)
+                        or self._isresponse(message))):
+                # NOTE: this is the response to `hello`; everything after it
+                # uses the negotiated framing, codec, and compression.
+                self._switchframing(*self._pendingframing)
+                self._pendingframing = None
+        if flush:
+            # NOTE: notifications may wait in a buffered writer (see
+            # `conveyor.connection.BufferedWriter`); requests and responses
+            # go out right away.
+            self._outfp.flush()
+
+    def _switchframing(self, name, codec, compression):
+        self._log.debug(
+            'name=%r, codec=%r, compression=%r', name, codec, compression)
+        framing = _createframing(
+            name, self._jsonreadercallback, self._maxframesize)
+        if 'zlib' == compression:
+            framing = _ZlibFraming(framing)
+        if None is not codec:
+            self._codec = _createcodec(codec)
+        self._framing.handoff = framing
+        self._framing = framing
+
+    def getframing(self):
+        return self._framing.name
+
+    def getcodec(self):
+        return self._codec.name
 
     def run(self):
         """ This loop will run until self._stopped is set true."""
         self._log.debug('starting')
+        valid = True
         while True:
             with self._condition:
                 stopped = self._stopped
             if self._stopped:
                 break
             else:
-                data = self._infp_reader.read()
+                data = self._infp.read()
                 if 0 == len(data):
                     break
-                else:
-                    self._jsonreader.feed(data)
-        self._jsonreader.feedeof()
+                elif not self.feed(data):
+                    valid = False
+                    break
+        if valid:
+            self.feedeof()
         self._log.debug('ending')
         self.close()
 
+    def feed(self, data, block=True):
+        """ Handles data read from the connection. This is what `run` does
+        with the data it reads; a caller that reads the connection on its own
+        (i.e., `conveyor.reactor.Reactor`) uses it instead of `run`.
+        @param block False if the caller must not wait for room in the
+            executor's queue; it should check `paused` instead
+        @return False if the data is invalid and the connection must be dropped
+        """
+        self._block = block
+        try:
+            self._framing.feed(data)
+        except ValueError:
+            # NOTE: a corrupt frame or compressed stream; there is no way to
+            # find the start of the next message.
+            self._log.error('invalid data', exc_info=True)
+            result = False
+        else:
+            result = True
+        return result
+
+    def feedeof(self):
+        self._framing.feedeof()
+
+    def paused(self, resume):
+        """ Returns whether or not the caller of `feed(data, False)` should
+        stop reading because the executor's queue is full. If so, `resume` is
+        called (on a worker thread) once it has room.
+        """
+        if None is self._executor:
+            result = False
+        else:
+            result = not self._executor.whenready(resume)
+        return result
+
     def stop(self):
         """ required as a stoppable object. """
         with self._condition:
@@ -210,12 +749,14 @@ class JsonRpc(conveyor.stoppable.StoppableInterface):
         self._infp.stop()
 
     def close(self):
+        # NOTE: close the output first so that a buffered writer can flush
+        # before the connection goes away.
         try:
-            self._infp_reader.close()
+            self._outfp.close()
         except:
             self._log.debug('handled exception', exc_info=True)
         try:
-            self._outfp_writer.close()
+            self._infp.close()
         except:
             self._log.debug('handled exception', exc_info=True)
 
@@ -226,6 +767,8 @@ class JsonRpc(conveyor.stoppable.StoppableInterface):
     def _handleresponse(self, response, id):
         self._log.debug('response=%r, id=%r', response, id)
         task = self._tasks.pop(id, None)
+        if None is not self._helloid and id == self._helloid:
+            self._hellofinished(response)
         if None is task:
             self._log.debug('ignoring response for unknown id: %r', id)
         elif self._iserrorresponse(response):
@@ -237,11 +780,64 @@ class JsonRpc(conveyor.stoppable.StoppableInterface):
         else:
             raise ValueError(response)
 
-    def notify(self, method, params):
+    def _hellofinished(self, response):
+        # NOTE: this runs on the reader thread, before any more input is fed
+        # to the current framing.
+        self._helloid = None
+        self._framing.careful = False
+        if self._issuccessresponse(response):
+            result = response['result']
+            if isinstance(result, dict):
+                name = result.get('framing')
+                codec = result.get('codec')
+                compression = result.get('compression')
+                if (name in FRAMINGS
+                        and (None is codec or codec in CODECS)
+                        and (None is compression or compression in COMPRESSIONS)):
+                    with self._sendlock:
+                        self._switchframing(name, codec, compression)
+
+    def hello(self, framings, codec_names=(), compressions=()):
+        """ Builds the task for the `hello` request that begins every
+        connection. The request offers `framings` (most preferred first) to
+        the server and the connection switches to the framing the server
+        selects as soon as the response arrives. Nothing else may be sent
+        until then. The codecs and compressions are only offered along with
+        a framing.
+        @param framings: a sequence of framing names from `FRAMINGS`
+        @param codec_names: a sequence of codec names from `CODECS`
+        @param compressions: a sequence of names from `COMPRESSIONS`
+        @return a Task object for the request
+        """
+        params = {}
+        if 0 != len(framings):
+            params['framing'] = list(framings)
+            if 0 != len(codec_names):
+                params['codec'] = list(codec_names)
+            if 0 != len(compressions):
+                params['compression'] = list(compressions)
+            self._framing.careful = True
+        id, task = self._request('hello', params)
+        if 0 != len(framings):
+            self._helloid = id
+        return task
+
+    def notify(self, method, params, key=None):
+        """ Sends a notification. A notification with a `key` may replace a
+        queued notification with the same key that has not been sent yet (see
+        `conveyor.connection.BufferedWriter`).
+        """
         self._log.debug('method=%r, params=%r', method, params)
         request = {'jsonrpc': '2.0', 'method': method, 'params': params}
-        data = conveyor.json.dumps(request)
-        self._send(data)
+        self._send(request, False, key)
+
+    def sendnotification(self, notification, key=None):
+        """ Sends a `Notification`. This is how to send the same notification
+        to many connections.
+        """
+        self._log.debug(
+            'method=%r, params=%r', notification.method, notification.params)
+        self._write(notification, False, key)
 
     def request(self, method, params):
         """ Builds a jsonrpc request task.
@@ -249,6 +845,10 @@ class JsonRpc(conveyor.stoppable.StoppableInterface):
         @param params: params for method
         @return a Task object with methods setup properly
         """
+        id, task = self._request(method, params)
+        return task
+
+    def _request(self, method, params):
         with self._condition:
             id = self._idcounter
             self._idcounter += 1
@@ -256,36 +856,128 @@ class JsonRpc(conveyor.stoppable.StoppableInterface):
         def runningevent(task):
             request = {
                 'jsonrpc': '2.0', 'method': method, 'params': params, 'id': id}
-            data = conveyor.json.dumps(request)
-            self._send(data)
+            self._send(request, True)
         def stoppedevent(task):
             if id in self._tasks.keys():
                 del self._tasks[id]
             else:
                 self._log.debug('stoppeevent fail for id=%r', id)
-        task = conveyor.task.Task()
+        task = conveyor.task.Task(self._eventqueue)
         task.runningevent.attach(runningevent)
         task.stoppedevent.attach(stoppedevent)
         self._tasks[id] = task
-        return task
+        return id, task
 
     #
     # Server part
     #
 
-    def _handlerequest(self, request, id):
+    def _dispatcharray(self, parsed):
+        ids = []
+        for subparsed in parsed:
+            if isinstance(subparsed, dict) and self._isrequest(subparsed):
+                ids.append(subparsed.get('id'))
+            else:
+                ids.append(None)
+        batch = _Batch(self, ids)
+        if None is not self._batchtimeout:
+            batch.timer = threading.Timer(self._batchtimeout, batch.expire)
+            batch.timer.daemon = True
+            batch.timer.start()
+        for index, subparsed in enumerate(parsed):
+            callback = lambda response, index=index: batch.complete(
+                index, response)
+            if isinstance(subparsed, dict) and self._isrequest(subparsed):
+                # NOTE: the response for a method that returns a task is sent
+                # on its own when the task stops, just like it is without an
+                # executor.
+                self._dispatch(subparsed, callback, self._sendresponse)
+            else:
+                callback(self._handleobject(subparsed))
+
+    def _dispatch(self, request, callback, tasksend):
+        '''
+        Runs a request on the executor (subject to the method's limits) and
+        passes the response to `callback`. When `tasksend` is None the response
+        for a method that returns a task is passed to `callback` once the task
+        stops; otherwise it is passed to `tasksend`.
+
+        '''
+        info = self._methodsinfo.get(request['method'])
+        if None is info:
+            submit = True
+        else:
+            with self._condition:
+                if (None is not info.concurrency
+                        and info.concurrency <= info.active):
+                    info.waiting.appendleft((request, callback, tasksend))
+                    submit = False
+                else:
+                    info.active += 1
+                    submit = True
+        if submit:
+            self._submit(info, request, callback, tasksend, self._block)
+
+    def _submit(self, info, request, callback, tasksend, block=True):
+        id = request.get('id')
+        reply = _Reply(self, id, callback)
+        if None is not info and None is not info.timeout and None is not id:
+            reply.timer = threading.Timer(info.timeout, reply.expire)
+            reply.timer.daemon = True
+            reply.timer.start()
+        tasks = []
+        def ontask(task):
+            # NOTE: the method's work goes on until its task stops, so that is
+            # when its slot is released.
+            if None is not info:
+                task.stoppedevent.attach(lambda task: self._finished(info))
+            tasks.append(task)
+        def func():
+            try:
+                if None is tasksend:
+                    response = self._handlerequest(
+                        request, id, reply.send, ontask)
+                    # NOTE: a None response for a request (as opposed to a
+                    # notification) means that the method returned a task.
+                    if None is not response or None is id:
+                        reply.send(response)
+                else:
+                    response = self._handlerequest(
+                        request, id, tasksend, ontask)
+                    reply.send(response)
+            finally:
+                if None is not info and 0 == len(tasks):
+                    self._finished(info)
+        self._executor.submit(func, block)
+
+    def _finished(self, info):
+        with self._condition:
+            if 0 == len(info.waiting):
+                waiting = None
+                info.active -= 1
+            else:
+                waiting = info.waiting.pop()
+        if None is not waiting:
+            request, callback, tasksend = waiting
+            # NOTE: this runs on a worker thread; it must not wait for room in
+            # the executor's queue.
+            self._submit(info, request, callback, tasksend, False)
+
+    def _handlerequest(self, request, id, send=None, ontask=None):
         self._log.debug('request=%r, id=%r', request, id)
         method = request['method']
         if method in self._methods:
             func = self._methods[method]
             if 'params' not in request:
-                response = self._invokemethod(id, func, (), {})
+                response = self._invokemethod(id, func, (), {}, send, ontask)
             else:
                 params = request['params']
                 if isinstance(params, dict):
-                    response = self._invokemethod(id, func, (), params)
+                    response = self._invokemethod(
+                        id, func, (), params, send, ontask)
                 elif isinstance(params, list):
-                    response = self._invokemethod(id, func, params, {})
+                    response = self._invokemethod(
+                        id, func, params, {}, send, ontask)
                 else:
                     response = self._invalidparams(id)
         else:
@@ -299,7 +991,14 @@ class JsonRpc(conveyor.stoppable.StoppableInterface):
             kwargs1[k] = v
         return kwargs1
 
-    def _invokemethod(self, id, func, args, kwargs):
+    def _invokemethod(self, id, func, args, kwargs, send=None, ontask=None):
+        """ Invokes a method. Returns the response or, when the method returns
+        a Task, None; the response is passed to `send` (by default
+        `_sendresponse`) when the task stops. The task is passed to the
+        optional `ontask` before it starts.
+        """
+        if None is send:
+            send = self._sendresponse
         self._log.debug(
             'id=%r, func=%r, args=%r, kwargs=%r', id, func, args, kwargs)
         response = None
@@ -336,16 +1035,446 @@ class JsonRpc(conveyor.stoppable.StoppableInterface):
                         response = self._errorresponse(id, -32002, 'task canceled', None)
                     else:
                         raise ValueError(task.conclusion)
-                    outdata = conveyor.json.dumps(response)
-                    self._send(outdata)
+                    send(response)
                 task.stoppedevent.attach(stoppedcallback)
+                if None is not ontask:
+                    ontask(task)
                 task.start()
             self._log.debug('response=%r', response)
         return response
 
-    def addmethod(self, method, func):
-        self._log.debug('method=%r, func=%r', method, func)
+    def addmethod(self, method, func, concurrency=None, timeout=None):
+        """ Adds a method. The limits only apply when the requests run on an
+        executor.
+        @param concurrency the maximum number of requests for the method
+            that may run at the same time on this connection
+        @param timeout the number of seconds after which a request for the
+            method fails with a timeout error. The method is not interrupted
+        """
+        self._log.debug(
+            'method=%r, func=%r, concurrency=%r, timeout=%r', method, func,
+            concurrency, timeout)
         self._methods[method] = func
+        if None is concurrency and None is timeout:
+            self._methodsinfo.pop(method, None)
+        else:
+            self._methodsinfo[method] = _MethodInfo(concurrency, timeout)
 
     def getmethods(self):
         return self._methods
+
+    def negotiate(self, framings, codec_names=(), compressions=()):
+        """ Server side of the `hello` handshake. Selects the most preferred
+        framing, codec, and compression that the client offered. The
+        connection switches to them right after the next response, which
+        must be the response to `hello`.
+        @param framings: the framing names offered by the client
+        @param codec_names: the codec names offered by the client
+        @param compressions: the compression names offered by the client
+        @return a dict with the selected `framing`, `codec`, and
+            `compression` (each may be None)
+        """
+        framing = self._select(FRAMINGS, framings)
+        if None is framing:
+            codec = None
+            compression = None
+        else:
+            if 'length' == framing:
+                codec = self._select(CODECS, codec_names)
+            else:
+                codec = self._select(('json',), codec_names)
+            compression = self._select(COMPRESSIONS, compressions)
+        with self._sendlock:
+            if None is framing:
+                self._pendingframing = None
+            else:
+                self._pendingframing = framing, codec, compression
+        result = {
+            'framing': framing, 'codec': codec, 'compression': compression}
+        return result
+
+    def _select(self, supported, offered):
+        result = None
+        for name in supported:
+            if name in offered:
+                result = name
+                break
+        return result
+
+
+class _FramingTestCase(unittest.TestCase):
+    _MESSAGES = [b'{"a": 1}', b'[1, 2, "\\n"]', b'{"b": "\xc3\xa9"}']
+
+    def _feed(self, framing, data, chunk_size):
+        for i in range(0, len(data), chunk_size):
+            framing.feed(data[i:i + chunk_size])
+        framing.feedeof()
+
+    def test_line(self):
+        '''Test that the line framing splits messages at any chunk size.'''
+
+        for chunk_size in (1, 2, 3, 7, 1024):
+            received = []
+            framing = _LineFraming(received.append)
+            data = b''.join(framing.frame(m) for m in self._MESSAGES)
+            self._feed(framing, data, chunk_size)
+            self.assertEqual(self._MESSAGES, received)
+
+    def test_length(self):
+        '''Test that the length framing splits messages at any chunk size.'''
+
+        for chunk_size in (1, 2, 3, 7, 1024):
+            received = []
+            framing = _LengthFraming(received.append)
+            data = b''.join(framing.frame(m) for m in self._MESSAGES)
+            self._feed(framing, data, chunk_size)
+            self.assertEqual(self._MESSAGES, received)
+
+    def test_line_ValueError(self):
+        '''Test that a line over the maximum size is rejected.'''
+
+        received = []
+        framing = _LineFraming(received.append, 8)
+        framing.feed(b'12345678\n1234')
+        self.assertEqual([b'12345678'], received)
+        with self.assertRaises(ValueError):
+            framing.feed(b'56789')
+        self.assertEqual([b'12345678'], received)
+
+    def test_length_ValueError(self):
+        '''Test that an oversized frame is rejected at its header.'''
+
+        received = []
+        framing = _LengthFraming(received.append, 8)
+        framing.feed(framing.frame(b'12345678'))
+        self.assertEqual([b'12345678'], received)
+        with self.assertRaises(ValueError):
+            framing.feed(framing._HEADER.pack(9))
+        self.assertEqual([b'12345678'], received)
+
+
+class _Pipe(object):
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        result = b''.join(self.data)
+        self.data = []
+        return result
+
+
+class _NegotiateTestCase(unittest.TestCase):
+    def _drain(self):
+        eventqueue = conveyor.event.geteventqueue()
+        while eventqueue.runiteration(False):
+            pass
+
+    def _connect(self, framings, hello, codec_names=(), compressions=()):
+        conveyor.event.geteventqueue()._clear()
+        self._clientout = _Pipe()
+        self._serverout = _Pipe()
+        self._client = JsonRpc(None, self._clientout)
+        self._server = JsonRpc(None, self._serverout)
+        self._pings = []
+        self._client.addmethod('ping', lambda: self._pings.append(None))
+        self._server.addmethod('hello', hello)
+        self._server.addmethod('echo', lambda value: value)
+        hello_task = self._client.hello(framings, codec_names, compressions)
+        hello_task.start()
+        self._drain()
+        self._server._framing.feed(self._clientout.take())
+        # NOTE: the response to `hello` and a notification arrive together.
+        self._server.notify('ping', [])
+        self._client._framing.feed(self._serverout.take())
+        self._drain()
+        return hello_task
+
+    def _echo(self, value):
+        echo_task = self._client.request('echo', [value])
+        echo_task.start()
+        self._drain()
+        self._server._framing.feed(self._clientout.take())
+        self._client._framing.feed(self._serverout.take())
+        self._drain()
+        self.assertEqual(value, echo_task.result)
+
+    def test_negotiate(self):
+        '''Test that both sides switch to the negotiated framing.'''
+
+        def hello(framing=None):
+            result = self._server.negotiate(framing)
+            return result
+        for name in FRAMINGS:
+            hello_task = self._connect((name,), hello)
+            self.assertEqual(1, len(self._pings))
+            self.assertEqual(
+                {'framing': name, 'codec': None, 'compression': None},
+                hello_task.result)
+            self.assertEqual(name, self._client.getframing())
+            self.assertEqual(name, self._server.getframing())
+            self._echo('\u00e9\n')
+
+    def test_negotiate_codec(self):
+        '''Test the codecs and compression with each framing.'''
+
+        def hello(framing=None, codec=None, compression=None):
+            result = self._server.negotiate(framing, codec, compression)
+            return result
+        for name in FRAMINGS:
+            hello_task = self._connect(
+                (name,), hello, ('binary', 'json'), ('zlib',))
+            self.assertEqual(1, len(self._pings))
+            if 'length' == name:
+                codec = 'binary'
+            else:
+                codec = 'json'
+            self.assertEqual(
+                {'framing': name, 'codec': codec, 'compression': 'zlib'},
+                hello_task.result)
+            for jsonrpc in (self._client, self._server):
+                self.assertEqual(name, jsonrpc.getframing())
+                self.assertEqual(codec, jsonrpc.getcodec())
+            for i in range(3):
+                self._echo({'\u00e9\n': [1.5, None, i]})
+
+    def test_old_server(self):
+        '''Test that a server without negotiation keeps the stream framing.'''
+
+        hello_task = self._connect(('length',), lambda: 'world')
+        self.assertEqual(
+            conveyor.task.TaskConclusion.FAILED, hello_task.conclusion)
+        self.assertEqual('stream', self._client.getframing())
+        self.assertEqual('stream', self._server.getframing())
+        hello_task = self._connect((), lambda: 'world')
+        self.assertEqual('world', hello_task.result)
+        self._echo('\u00e9\n')
+
+    def test_sendnotification(self):
+        '''Test that a notification is encoded once for every connection.'''
+
+        def hello(framing=None, codec=(), compression=()):
+            result = self._server.negotiate(framing, codec, compression)
+            return result
+        notification = Notification('ping', [])
+        for framings, codec_names, compressions in (
+                ((), (), ()), (('line',), (), ()), (('length',), (), ()),
+                (('length',), ('binary',), ()),
+                (('length',), ('binary',), ('zlib',))):
+            hello_task = self._connect(
+                framings, hello, codec_names, compressions)
+            if 0 != len(framings):
+                self.assertEqual(framings[0], hello_task.result['framing'])
+            for i in range(2):
+                self._server.sendnotification(notification)
+            self._client._framing.feed(self._serverout.take())
+            self._drain()
+            self.assertEqual(3, len(self._pings))
+        self.assertEqual(['binary', 'json'], sorted(notification._encoded))
+        self.assertEqual(4, len(notification._framed))
+
+
+class _DispatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self._executor = conveyor.executor.Executor.create(4, 16, 'test')
+        self._condition = threading.Condition()
+        self._responses = []
+        self._jsonrpc = JsonRpc(None, self)
+
+    def tearDown(self):
+        self._executor.stop()
+
+    def write(self, data):
+        with self._condition:
+            self._responses.append(json.loads(data))
+            self._condition.notify_all()
+
+    def flush(self):
+        pass
+
+    def _request(self, id, method, params=()):
+        request = {
+            'jsonrpc': '2.0', 'method': method, 'params': list(params),
+            'id': id}
+        self._jsonrpc._jsonreadercallback(conveyor.json.dumps(request))
+
+    def _wait(self, count):
+        with self._condition:
+            while len(self._responses) < count:
+                self._condition.wait(5.0)
+            result = list(self._responses)
+        return result
+
+    def test_inline(self):
+        '''Test that without an executor requests run on the caller.'''
+
+        self._jsonrpc.addmethod('echo', lambda value: value, 1, 0.01)
+        self._request(1, 'echo', ['a'])
+        self.assertEqual(
+            [{'jsonrpc': '2.0', 'result': 'a', 'id': 1}], self._responses)
+
+    def test_order(self):
+        '''Test that a fast request does not wait behind a slow one.'''
+
+        self._jsonrpc._executor = self._executor
+        event = threading.Event()
+        self._jsonrpc.addmethod('slow', lambda: event.wait(5.0))
+        self._jsonrpc.addmethod('fast', lambda: 'fast')
+        self._request(1, 'slow')
+        self._request(2, 'fast')
+        responses = self._wait(1)
+        self.assertEqual(2, responses[0]['id'])
+        event.set()
+        responses = self._wait(2)
+        self.assertEqual(1, responses[1]['id'])
+
+    def test_concurrency(self):
+        '''Test that a method never runs more often than its limit.'''
+
+        self._jsonrpc._executor = self._executor
+        lock = threading.Lock()
+        counts = [0, 0]
+        def method():
+            with lock:
+                counts[0] += 1
+                counts[1] = max(counts[0], counts[1])
+            time.sleep(0.01)
+            with lock:
+                counts[0] -= 1
+        self._jsonrpc.addmethod('method', method, concurrency=2)
+        for id in range(8):
+            self._request(id, 'method')
+        responses = self._wait(8)
+        self.assertEqual(
+            list(range(8)), sorted(response['id'] for response in responses))
+        self.assertEqual(2, counts[1])
+
+        # NOTE: a method that returns a task holds its slot until the task
+        # stops.
+        eventqueue = conveyor.event.geteventqueue()
+        eventqueue._clear()
+        tasks = []
+        def taskmethod():
+            task = conveyor.task.Task()
+            with self._condition:
+                tasks.append(task)
+                self._condition.notify_all()
+            return task
+        def waittasks(count):
+            with self._condition:
+                deadline = time.time() + 5.0
+                while len(tasks) < count and time.time() < deadline:
+                    self._condition.wait(deadline - time.time())
+            self.assertEqual(count, len(tasks))
+        self._jsonrpc.addmethod('task', taskmethod, concurrency=1)
+        self._request(8, 'task')
+        self._request(9, 'task')
+        waittasks(1)
+        time.sleep(0.05)
+        self.assertEqual(1, len(tasks))
+        tasks[0].end(8)
+        while eventqueue.runiteration(False):
+            pass
+        waittasks(2)
+        tasks[1].end(9)
+        while eventqueue.runiteration(False):
+            pass
+        responses = self._wait(10)
+        self.assertEqual(
+            [8, 9], [response['result'] for response in responses[8:]])
+
+    def test_batch(self):
+        '''Test that the elements of a batch run in parallel.'''
+
+        self._jsonrpc._executor = self._executor
+        condition = threading.Condition()
+        arrived = [0]
+        def method(value):
+            # NOTE: every call waits for the other three. They all time out
+            # unless the calls run in parallel.
+            with condition:
+                arrived[0] += 1
+                condition.notify_all()
+                deadline = time.time() + 5.0
+                while 4 != arrived[0] and time.time() < deadline:
+                    condition.wait(deadline - time.time())
+            return 4 == arrived[0] and value
+        self._jsonrpc.addmethod('method', method)
+        self._jsonrpc.addmethod('notify', lambda: None)
+        batch = [
+            {'jsonrpc': '2.0', 'method': 'method', 'params': [i], 'id': i}
+            for i in range(4)]
+        batch.insert(1, {'jsonrpc': '2.0', 'method': 'notify'})
+        batch.append({'invalid': True})
+        self._jsonrpc._jsonreadercallback(conveyor.json.dumps(batch))
+        responses = self._wait(1)
+        self.assertEqual(1, len(responses))
+        self.assertEqual(
+            [0, 1, 2, 3, None],
+            [response['id'] for response in responses[0]])
+        self.assertEqual(
+            [0, 1, 2, 3], [response['result'] for response in responses[0][:4]])
+        self.assertEqual(-32600, responses[0][4]['error']['code'])
+
+    def test_batch_timeout(self):
+        '''Test that a batch is answered at its deadline.'''
+
+        self._jsonrpc._executor = self._executor
+        self._jsonrpc._batchtimeout = 0.01
+        event = threading.Event()
+        self._jsonrpc.addmethod('slow', lambda: event.wait(5.0))
+        self._jsonrpc.addmethod('fast', lambda: 'fast')
+        batch = [
+            {'jsonrpc': '2.0', 'method': 'slow', 'id': 1},
+            {'jsonrpc': '2.0', 'method': 'fast', 'id': 2}]
+        self._jsonrpc._jsonreadercallback(conveyor.json.dumps(batch))
+        responses = self._wait(1)
+        self.assertEqual(
+            [{'jsonrpc': '2.0', 'error': {'code': -32003,
+                'message': 'method timed out'}, 'id': 1},
+            {'jsonrpc': '2.0', 'result': 'fast', 'id': 2}],
+            responses[0])
+        event.set()
+        time.sleep(0.05)
+        self.assertEqual(1, len(self._responses))
+
+    def test_timeout(self):
+        '''Test that a request fails when its method takes too long.'''
+
+        self._jsonrpc._executor = self._executor
+        event = threading.Event()
+        self._jsonrpc.addmethod(
+            'slow', lambda: event.wait(5.0), timeout=0.01)
+        self._request(1, 'slow')
+        responses = self._wait(1)
+        self.assertEqual(-32003, responses[0]['error']['code'])
+        event.set()
+        time.sleep(0.05)
+        self.assertEqual(1, len(self._responses))
+
+    def test_paused(self):
+        '''Test that a non-blocking feed pauses on a full executor.'''
+
+        executor = conveyor.executor.Executor(1)
+        self._jsonrpc._executor = executor
+        self._jsonrpc.addmethod('echo', lambda value: value)
+        resumed = threading.Event()
+        self.assertFalse(self._jsonrpc.paused(resumed.set))
+        for id in (1, 2):
+            request = {
+                'jsonrpc': '2.0', 'method': 'echo', 'params': [id], 'id': id}
+            self.assertTrue(
+                self._jsonrpc.feed(conveyor.json.dumps(request), False))
+        self.assertTrue(self._jsonrpc.paused(resumed.set))
+        thread = threading.Thread(target=executor.run)
+        thread.start()
+        self.assertTrue(resumed.wait(5.0))
+        self.assertEqual([1, 2], sorted(
+            response['result'] for response in self._wait(2)))
+        executor.stop()
+        thread.join(5.0)
@@ -88,6 +88,30 @@ class _AbstractSocketListener(Listener):
                     self._log_connection(addr)
                     connection = conveyor.connection.SocketConnection(sock, addr)
                     return connection
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def acceptpending(self):
+        """ Accepts a connection without waiting for one. This is for callers
+        that wait for the listening socket to become readable on their own.
+        @return a non-blocking (socket, address) pair or None if no connection
+            is pending
+        """
+        self._socket.setblocking(False)
+        try:
+            sock, addr = self._socket.accept()
+        except IOError as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                result = None
+            else:
+                raise
+        else:
+            sock.setblocking(False)
+            self._log_connection(addr)
+            result = sock, addr
+        return result
+
     def _log_connection(self, addr):
         raise NotImplementedError
 
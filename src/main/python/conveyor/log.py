@@ -46,6 +46,29 @@ else:
 def checklevel(level):
     return _checkLevel(level)
 
+# NOTE: Python 2 does not cache a logger's effective level; every
+# `isEnabledFor` walks the logger hierarchy. The hot paths (i.e., the event
+# queue) call `isdebug` instead, which remembers the answer until conveyor
+# configures logging again (see `resetlevels`).
+_debuglevels = {}
+
+def isdebug(logger):
+    '''Returns whether or not `logger` logs DEBUG messages (cached).'''
+
+    result = _debuglevels.get(logger.name)
+    if None is result:
+        result = logger.isEnabledFor(logging.DEBUG)
+        _debuglevels[logger.name] = result
+    return result
+
+def resetlevels():
+    '''Forgets the levels that `isdebug` cached; call it after any change
+    to the logging configuration.
+
+    '''
+
+    _debuglevels.clear()
+
 def getlogger(o):
     if not hasattr(o, '__module__'):
         name = o.__class__.__name__
@@ -114,6 +137,7 @@ def earlylogging(program, early_debugging=False): # pragma: no cover
         dct['root']['level'] = 'NOTSET'
         dct['root']['handlers'].append('log')
     logging.config.dictConfig(dct)
+    resetlevels()
 
 def getfiles():
     '''Return an iterator of the files open by the logging system.
@@ -283,8 +283,16 @@ class Machine(object):
         self._port = None
         self._state = MachineState.DISCONNECTED
         self._state_condition = threading.Condition()
-        self.state_changed = conveyor.event.Event('state_changed')
-        self.temperature_changed = conveyor.event.Event('temperature_changed')
+        # NOTE: a machine's events are delivered in order on a lane of their
+        # own (see `conveyor.event.Lane`). The temperature handlers read the
+        # latest temperatures, so a temperature change that is still waiting
+        # covers the ones after it.
+        lane = conveyor.event.getlane(('machine', name))
+        self.state_changed = conveyor.event.Event(
+            'state_changed', lane, conveyor.event.EventPriority.CONTROL)
+        self.temperature_changed = conveyor.event.Event(
+            'temperature_changed', lane,
+            conveyor.event.EventPriority.TELEMETRY, coalesce=True)
 
     def get_info(self):
         raise NotImplementedError
@@ -67,6 +67,7 @@ class AbstractMain(object):
                 if None is not self._parsed_args.level_name:
                     root = logging.getLogger()
                     root.setLevel(self._parsed_args.level_name)
+                    conveyor.log.resetlevels()
                 self._load_config()
                 self._init_logging()
                 code = self._run()
@@ -139,6 +140,7 @@ class AbstractMain(object):
             handlers.append('log')
         dct = self._get_logging_dct(filename, level, handlers)
         logging.config.dictConfig(dct)
+        conveyor.log.resetlevels()
 
     def _get_logging_dct(self, filename, level, handlers):
         dct = {
@@ -21,6 +21,8 @@
 
 from __future__ import (absolute_import, print_function, unicode_literals)
 
+import threading
+
 try:
     import unittest2 as unittest
 except ImportError:
@@ -30,16 +32,41 @@ import conveyor.event
 import conveyor.task
 import conveyor.visitor
 
-def tasksequence(job, tasklist):
+def tasksequence(job, tasklist, eventqueue=None):
     """
     @param a job object
-    @param tasklist list of Task objects to run
+    @param tasklist list of Task objects to run; an item that is itself a
+        list of Task objects runs them at the same time (see `taskparallel`)
+    @param eventqueue the event queue for the sequence's task (the global
+        event queue if `None`)
     """
+    def term(item):
+        if isinstance(item, (list, tuple)):
+            term = _TermParallel(job, item, eventqueue)
+        else:
+            term = _TermTask(item)
+        return term
     term = reduce(
-        _TermSequence, (_TermYield(_TermTask(t)) for t in tasklist))
+        _TermSequence, (_TermYield(term(item)) for item in tasklist))
     machine = _Machine.create(term)
-    task = conveyor.task.Task()
-    processhandler = _ProcessHandler(job, machine, task)
+    task = conveyor.task.Task(eventqueue)
+    # NOTE: the handler is kept alive by the task's event handlers.
+    _ProcessHandler(job, machine, task)
+    return task
+
+def taskparallel(job, tasklist, eventqueue=None):
+    """ Returns a task that starts every task in `tasklist` at once and ends
+    (with a list of their results) when all of them have ended. It fails with
+    the failure of the first of them that fails and cancels the others. Its
+    heartbeats carry the mean progress of the tasks.
+    @param a job object
+    @param tasklist list of Task objects to run
+    @param eventqueue the event queue for the task (the global event queue
+        if `None`)
+    """
+    task = conveyor.task.Task(eventqueue)
+    # NOTE: the handler is kept alive by the task's event handlers.
+    _ParallelHandler(job, tasklist, task)
     return task
 
 class _ProcessHandler(object):
@@ -91,6 +118,86 @@ class _ProcessHandler(object):
         if conveyor.task.TaskState.STOPPED != self._task.state:
             self._task.cancel()
 
+class _ParallelHandler(object):
+    def __init__(self, job, children, task):
+        self._job = job
+        self._children = list(children)
+        self._task = task
+        # NOTE: the children's events may be delivered on different lanes at
+        # the same time.
+        self._lock = threading.Lock()
+        self._results = [None] * len(self._children)
+        self._remaining = len(self._children)
+        self._task.startevent.attach(self._taskstartcallback)
+        self._task.cancelevent.attach(self._taskcancelcallback)
+
+    def _taskstartcallback(self, unused):
+        if 0 == len(self._children):
+            self._task.end([])
+        else:
+            for index, child in enumerate(self._children):
+                child.heartbeatevent.attach(self._childheartbeatcallback)
+                child.endevent.attach(
+                    lambda child, index=index: self._childendcallback(
+                        index, child))
+                child.failevent.attach(self._childfailcallback)
+                child.cancelevent.attach(self._childcancelcallback)
+            for child in self._children:
+                child.start()
+
+    def _taskcancelcallback(self, unused):
+        self._cancelchildren()
+
+    def _cancelchildren(self):
+        for child in self._children:
+            if conveyor.task.TaskState.STOPPED != child.state:
+                child.cancel()
+
+    def _childheartbeatcallback(self, unused):
+        with self._lock:
+            if conveyor.task.TaskState.RUNNING == self._task.state:
+                self._task.heartbeat(self._progress())
+
+    def _progress(self):
+        name = None
+        total = 0
+        for child in self._children:
+            if child.isended():
+                total += 100
+            elif None is not child.progress:
+                if None is name:
+                    name = child.progress.get('name')
+                total += child.progress.get('progress', 0)
+        progress = {
+            'name': name,
+            'progress': total // len(self._children),
+        }
+        return progress
+
+    def _childendcallback(self, index, child):
+        with self._lock:
+            self._results[index] = child.result
+            self._remaining -= 1
+            if (0 == self._remaining
+                    and conveyor.task.TaskState.RUNNING == self._task.state):
+                self._task.end(self._results)
+
+    def _childfailcallback(self, child):
+        with self._lock:
+            failed = conveyor.task.TaskState.RUNNING == self._task.state
+            if failed:
+                self._task.fail(child.failure)
+        if failed:
+            self._cancelchildren()
+
+    def _childcancelcallback(self, unused):
+        with self._lock:
+            canceled = conveyor.task.TaskState.RUNNING == self._task.state
+            if canceled:
+                self._task.cancel()
+        if canceled:
+            self._cancelchildren()
+
 class _Term(object):
     '''\
     An abstract term.
@@ -118,6 +225,17 @@ class _TermTask(_Term):
     def __init__(self, task):
         self.task = task
 
+class _TermParallel(_Term):
+    '''\
+    The parallel term is a literal that evaluates to a Task value that runs
+    several tasks at the same time (see `taskparallel`).
+    '''
+
+    def __init__(self, job, tasks, eventqueue):
+        self.job = job
+        self.tasks = tasks
+        self.eventqueue = eventqueue
+
 class _TermSequence(_Term):
     '''\
     The sequence term evaluates the first term, discards its value, and then
@@ -233,6 +351,14 @@ class _PhaseRefocus(_Phase, conveyor.visitor.Visitor):
         phase = _PhaseRefocusAux(new_context, new_value, new_state)
         return phase
 
+    def accept__TermParallel(self, term):
+        new_context = self.context
+        new_value = taskparallel(
+            self.term.job, self.term.tasks, self.term.eventqueue)
+        new_state = self.state
+        phase = _PhaseRefocusAux(new_context, new_value, new_state)
+        return phase
+
     def accept__TermSequence(self, term):
         new_term = self.term.term1
         new_environment = self.environment
@@ -415,6 +541,86 @@ class _Machine(object):
             else:
                 raise _UnknownPhaseException(self._phase)
 
+class _ParallelTestCase(unittest.TestCase):
+    def setUp(self):
+        self._eventqueue = conveyor.event.EventQueue()
+
+    def _runeventqueue(self):
+        while self._eventqueue.runiteration(False):
+            pass
+
+    def test_parallel(self):
+        '''Test that the tasks run at the same time and that the parallel
+        task ends with their results.'''
+
+        tasks = [conveyor.task.Task(self._eventqueue) for i in range(2)]
+        process = taskparallel(None, tasks, self._eventqueue)
+        heartbeats = []
+        process.heartbeatevent.attach(
+            lambda task: heartbeats.append(task.progress))
+        process.start()
+        self._runeventqueue()
+        self.assertTrue(all(task.isrunning() for task in tasks))
+        tasks[1].heartbeat({'name': 'slice', 'progress': 50})
+        self._runeventqueue()
+        self.assertEqual([{'name': 'slice', 'progress': 25}], heartbeats)
+        tasks[1].end(1)
+        tasks[0].end(0)
+        self._runeventqueue()
+        self.assertTrue(process.isended())
+        self.assertEqual([0, 1], process.result)
+
+    def test_fail(self):
+        '''Test that the first failure fails the parallel task and cancels
+        the other tasks.'''
+
+        tasks = [conveyor.task.Task(self._eventqueue) for i in range(3)]
+        process = taskparallel(None, tasks, self._eventqueue)
+        process.start()
+        self._runeventqueue()
+        tasks[0].end(None)
+        tasks[1].fail('failure')
+        self._runeventqueue()
+        self.assertTrue(process.isfailed())
+        self.assertEqual('failure', process.failure)
+        self.assertTrue(tasks[2].iscanceled())
+
+    def test_cancel(self):
+        '''Test that canceling the parallel task cancels its tasks.'''
+
+        tasks = [conveyor.task.Task(self._eventqueue) for i in range(2)]
+        process = taskparallel(None, tasks, self._eventqueue)
+        process.start()
+        self._runeventqueue()
+        process.cancel()
+        self._runeventqueue()
+        self.assertTrue(all(task.iscanceled() for task in tasks))
+
+    def test_tasksequence(self):
+        '''Test a list of tasks in a sequence.'''
+
+        started = []
+        def task(name):
+            def runningcallback(task):
+                started.append(name)
+                if 'c' == name:
+                    task.end(None)
+            task = conveyor.task.Task(self._eventqueue)
+            task.runningevent.attach(runningcallback)
+            return task
+        a, b, c = task('a'), task('b'), task('c')
+        process = tasksequence(None, [[a, b], c], self._eventqueue)
+        process.start()
+        self._runeventqueue()
+        self.assertEqual(['a', 'b'], sorted(started))
+        a.end(None)
+        self._runeventqueue()
+        self.assertEqual(2, len(started))
+        b.end(None)
+        self._runeventqueue()
+        self.assertEqual('c', started[-1])
+        self.assertTrue(process.isended())
+
 class _ProcessTaskTestCase(unittest.TestCase):
     def _runeventqueue(self, eventqueue):
         while eventqueue.runiteration(False):
@@ -0,0 +1,566 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/main/python/conveyor/reactor.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A single-threaded `epoll` loop that owns a listening socket and every client
+socket accepted from it (Linux only).
+
+The threaded service uses a thread to accept connections, a thread to read
+each client's socket, and a thread to write to it. The reactor does all of
+that on one thread with non-blocking sockets. Whatever the clients ask for is
+handed off to a worker pool by the protocol (i.e., a `JsonRpc` with an
+executor); the reactor itself never runs a request, nor waits for room in the
+pool's queue. A client whose requests find the queue full is not read again
+until there is room.
+
+'''
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import errno
+import fcntl
+import os
+import select
+import socket
+import threading
+import time
+
+import conveyor.connection
+import conveyor.error
+import conveyor.listener
+import conveyor.log
+import conveyor.stoppable
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+# The most bytes read from a client socket at once.
+_READ_SIZE = 64 * 1024
+
+
+def available(listener):
+    '''Returns whether or not a reactor can serve a listener.'''
+
+    result = (hasattr(select, 'epoll')
+        and isinstance(listener, conveyor.listener._AbstractSocketListener))
+    return result
+
+
+def _setnonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class _ReactorConnection(conveyor.connection.Connection):
+    '''
+    A client socket owned by a reactor. The reactor reads it; `stop` drops the
+    client right away and `close` lets the reactor send whatever is queued in
+    the client's `_ReactorWriter` first.
+
+    '''
+
+    def __init__(self, reactor, sock, address):
+        conveyor.connection.Connection.__init__(self)
+        self._reactor = reactor
+        self._socket = sock
+        self._fileno = sock.fileno()
+        self._address = address
+        self._stopped = False
+
+    def getaddress(self):
+        return self._address
+
+    def fileno(self):
+        return self._fileno
+
+    def read(self):
+        raise NotImplementedError
+
+    def write(self, data):
+        raise NotImplementedError
+
+    def stop(self):
+        self._stopped = True
+        self._reactor.wake(self._fileno)
+
+    def close(self):
+        self._reactor.wake(self._fileno)
+
+
+class _ReactorWriter(conveyor.connection.BufferedWriter):
+    '''
+    A `BufferedWriter` without a thread of its own. The reactor takes the
+    queued data when it is due and sends it when the socket is writable.
+
+    '''
+
+    def __init__(self, reactor, connection, window, limit, stalltimeout):
+        conveyor.connection.BufferedWriter.__init__(
+            self, connection, window, limit, stalltimeout)
+        self._reactor = reactor
+        self._fileno = connection.fileno()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._wake()
+
+    def _wake(self):
+        self._reactor.wake(self._fileno)
+
+    def _poll(self, now):
+        '''
+        Returns the data to send now (or `None`) and the time at which there
+        will be data to send (or `None`).
+
+        '''
+
+        data = None
+        deadline = None
+        with self._condition:
+            if not self._writing and 0 != len(self._chunks):
+                deadline = self._since + self._window
+                if self._urgent or self._closed or deadline <= now:
+                    data = self._take()
+                    deadline = None
+        return data, deadline
+
+    def _drained(self):
+        '''Returns whether or not the writer is closed and has sent it all.'''
+
+        with self._condition:
+            result = (self._failed or (self._closed and not self._writing
+                and 0 == len(self._chunks)))
+        return result
+
+
+class _Entry(object):
+    def __init__(self, connection, writer):
+        self.connection = connection
+        self.writer = writer
+        self.protocol = None
+        self.reading = True
+        self.paused = False
+        self.outbound = None
+        self.events = select.EPOLLIN
+        self.closing = None
+
+
+class Reactor(conveyor.stoppable.StoppableInterface):
+    '''
+    The loop in `run` accepts connections from the listener and calls
+    `accept(connection, writer)` for each one. It returns the connection's
+    protocol: an object with `feed(data)` (which returns `False` when the data
+    is invalid and must never block), `paused(resume)` (which returns `True`
+    when the protocol cannot take more data yet, in which case it calls
+    `resume()` from any thread once it can), `feedeof()`, and `lost()` (called
+    exactly once, after which the protocol should close the writer and
+    connection).
+
+    '''
+
+    @classmethod
+    def create(cls, listener, window, limit, stalltimeout):
+        '''
+        @param listener a listener for which `available` returns `True`
+        @param window the `BufferedWriter` window for each client
+        @param limit the `BufferedWriter` limit for each client
+        @param stalltimeout the `BufferedWriter` stall timeout for each client
+        '''
+        readfd, writefd = os.pipe()
+        _setnonblocking(readfd)
+        _setnonblocking(writefd)
+        reactor = cls(listener, window, limit, stalltimeout, readfd, writefd)
+        return reactor
+
+    def __init__(self, listener, window, limit, stalltimeout, readfd, writefd):
+        conveyor.stoppable.StoppableInterface.__init__(self)
+        self._listener = listener
+        self._window = window
+        self._limit = limit
+        self._stalltimeout = stalltimeout
+        self._readfd = readfd
+        self._writefd = writefd
+        self._log = conveyor.log.getlogger(self)
+        self._epoll = select.epoll()
+        self._entries = {}
+        self._deadlines = {}
+        self._lock = threading.Lock()
+        self._woken = set()
+        self._resumed = set()
+        self._signaled = False
+        self._stop = False
+
+    def wake(self, fd):
+        '''
+        Asks the reactor thread to look at a client: its writer has data or
+        its connection was stopped or closed. It may be called from any thread.
+
+        '''
+
+        with self._lock:
+            self._woken.add(fd)
+            if not self._signaled:
+                self._signal()
+
+    def resume(self, fd):
+        '''
+        Asks the reactor thread to read a paused client again. It may be
+        called from any thread.
+
+        '''
+
+        with self._lock:
+            self._resumed.add(fd)
+            if not self._signaled:
+                self._signal()
+
+    def stop(self):
+        with self._lock:
+            self._stop = True
+            if not self._signaled:
+                self._signal()
+
+    def _signal(self):
+        self._signaled = True
+        try:
+            os.write(self._writefd, b'x')
+        except OSError as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def run(self, accept):
+        self._epoll.register(self._readfd, select.EPOLLIN)
+        self._epoll.register(self._listener.fileno(), select.EPOLLIN)
+        try:
+            while not self._stop:
+                try:
+                    events = self._epoll.poll(self._gettimeout())
+                except IOError as e:
+                    if errno.EINTR == e.args[0]:
+                        continue
+                    else:
+                        raise
+                for fd, event in events:
+                    if self._readfd == fd:
+                        self._drainpipe()
+                    elif self._listener.fileno() == fd:
+                        self._accept(accept)
+                    else:
+                        entry = self._entries.get(fd)
+                        if None is not entry:
+                            if event & select.EPOLLOUT:
+                                self._send(fd, entry)
+                            if event & (select.EPOLLIN | select.EPOLLHUP
+                                    | select.EPOLLERR):
+                                self._read(fd, entry)
+                self._service()
+        finally:
+            for fd, entry in list(self._entries.items()):
+                self._drop(fd, entry)
+            self._epoll.close()
+            os.close(self._readfd)
+            os.close(self._writefd)
+        return 0
+
+    def _gettimeout(self):
+        if 0 == len(self._deadlines):
+            timeout = -1
+        else:
+            timeout = max(0.0, min(self._deadlines.values()) - time.time())
+        return timeout
+
+    def _drainpipe(self):
+        with self._lock:
+            self._signaled = False
+            try:
+                while os.read(self._readfd, 4096):
+                    pass
+            except OSError as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def _accept(self, accept):
+        while True:
+            pair = self._listener.acceptpending()
+            if None is pair:
+                break
+            else:
+                sock, address = pair
+                connection = _ReactorConnection(self, sock, address)
+                writer = _ReactorWriter(
+                    self, connection, self._window, self._limit,
+                    self._stalltimeout)
+                entry = _Entry(connection, writer)
+                fd = sock.fileno()
+                self._entries[fd] = entry
+                self._epoll.register(fd, entry.events)
+                entry.protocol = accept(connection, writer)
+
+    def _read(self, fd, entry):
+        if entry.reading:
+            try:
+                data = entry.connection._socket.recv(_READ_SIZE)
+            except IOError as e:
+                if e.args[0] in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK):
+                    data = None
+                else:
+                    self._log.debug('handled exception', exc_info=True)
+                    data = b''
+            if None is data:
+                pass
+            elif 0 == len(data):
+                conveyor.error.guard(self._log, entry.protocol.feedeof)
+                self._lost(fd, entry)
+            elif not entry.protocol.feed(data):
+                self._lost(fd, entry)
+            elif entry.protocol.paused(lambda: self.resume(fd)):
+                # NOTE: a hang up or error is still reported while the client
+                # is paused; the socket is then read regardless.
+                entry.paused = True
+                self._setevents(fd, entry, entry.events & ~select.EPOLLIN)
+
+    def _lost(self, fd, entry):
+        # NOTE: the client is done sending but the writer may still have
+        # data for it. The socket is closed once the writer drains.
+        entry.reading = False
+        entry.closing = time.time() + self._stalltimeout
+        self._setevents(fd, entry, entry.events & ~select.EPOLLIN)
+        conveyor.error.guard(self._log, entry.protocol.lost)
+        self.wake(fd)
+
+    def _drop(self, fd, entry):
+        if entry.reading:
+            entry.reading = False
+            conveyor.error.guard(self._log, entry.protocol.lost)
+        del self._entries[fd]
+        self._deadlines.pop(fd, None)
+        try:
+            self._epoll.unregister(fd)
+        except IOError:
+            self._log.debug('handled exception', exc_info=True)
+        if None is not entry.outbound:
+            entry.outbound = None
+            entry.writer._written(True)
+        try:
+            entry.connection._socket.close()
+        except IOError:
+            self._log.debug('handled exception', exc_info=True)
+
+    def _setevents(self, fd, entry, events):
+        if events != entry.events:
+            entry.events = events
+            self._epoll.modify(fd, events)
+
+    def _service(self):
+        with self._lock:
+            woken = self._woken
+            self._woken = set()
+            resumed = self._resumed
+            self._resumed = set()
+        for fd in resumed:
+            entry = self._entries.get(fd)
+            if None is not entry and entry.paused:
+                entry.paused = False
+                if entry.reading:
+                    self._setevents(fd, entry, entry.events | select.EPOLLIN)
+        now = time.time()
+        for fd, deadline in self._deadlines.items():
+            if deadline <= now:
+                woken.add(fd)
+        for fd in woken:
+            entry = self._entries.get(fd)
+            if None is not entry:
+                if entry.connection._stopped:
+                    self._drop(fd, entry)
+                else:
+                    self._deadlines.pop(fd, None)
+                    if None is entry.outbound:
+                        self._send(fd, entry)
+                    if fd in self._entries and None is entry.outbound:
+                        if not entry.reading and entry.writer._drained():
+                            self._drop(fd, entry)
+                        elif None is not entry.closing and now > entry.closing:
+                            self._log.warning(
+                                'dropping client: queued data not sent')
+                            self._drop(fd, entry)
+
+    def _send(self, fd, entry):
+        '''Sends as much as the socket takes without blocking.'''
+
+        while True:
+            if None is entry.outbound:
+                data, deadline = entry.writer._poll(time.time())
+                if None is not deadline:
+                    self._deadlines[fd] = deadline
+                if None is data:
+                    self._setevents(fd, entry, entry.events & ~select.EPOLLOUT)
+                    break
+                else:
+                    entry.outbound = memoryview(data)
+            try:
+                sent = entry.connection._socket.send(entry.outbound)
+            except IOError as e:
+                if e.args[0] in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._setevents(fd, entry, entry.events | select.EPOLLOUT)
+                    break
+                else:
+                    self._log.debug('handled exception', exc_info=True)
+                    self._drop(fd, entry)
+                    break
+            else:
+                if sent < len(entry.outbound):
+                    entry.outbound = entry.outbound[sent:]
+                    entry.writer._sent()
+                else:
+                    entry.outbound = None
+                    entry.writer._written(False)
+
+
+class _EchoProtocol(object):
+    def __init__(self, connection, writer):
+        self.connection = connection
+        self.writer = writer
+        self.lostevent = threading.Event()
+        self.hold = False
+        self.resume = None
+
+    def feed(self, data):
+        if b'!' in data:
+            result = False
+        else:
+            self.writer.write(data)
+            if b'.' in data:
+                self.writer.flush()
+            result = True
+        return result
+
+    def paused(self, resume):
+        if self.hold:
+            self.hold = False
+            self.resume = resume
+            result = True
+        else:
+            result = False
+        return result
+
+    def feedeof(self):
+        pass
+
+    def lost(self):
+        self.writer.close()
+        self.connection.close()
+        self.lostevent.set()
+
+
+class _ReactorTestCase(unittest.TestCase):
+    def setUp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(32)
+        self._address = sock.getsockname()
+        listener = conveyor.listener.TcpListener(sock)
+        self._reactor = Reactor.create(listener, 60.0, 1024 * 1024, 60.0)
+        self._protocols = []
+        def accept(connection, writer):
+            protocol = _EchoProtocol(connection, writer)
+            self._protocols.append(protocol)
+            return protocol
+        self._thread = threading.Thread(
+            target=self._reactor.run, args=(accept,))
+        self._thread.start()
+
+    def tearDown(self):
+        self._reactor.stop()
+        self._thread.join(5.0)
+        self.assertFalse(self._thread.is_alive())
+
+    def _connect(self):
+        sock = socket.create_connection(self._address)
+        sock.settimeout(5.0)
+        return sock
+
+    def _recv(self, sock, size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if 0 == len(chunk):
+                break
+            data += chunk
+        return data
+
+    def test_echo(self):
+        '''Test that the reactor serves many clients at once.'''
+
+        socks = [self._connect() for i in range(20)]
+        for i, sock in enumerate(socks):
+            sock.sendall(b'%d,' % (i,))
+            sock.sendall(b'.')
+        for i, sock in enumerate(socks):
+            expected = b'%d,.' % (i,)
+            self.assertEqual(expected, self._recv(sock, len(expected)))
+            sock.close()
+
+    def test_close(self):
+        '''Test that queued data is sent before the socket is closed.'''
+
+        sock = self._connect()
+        sock.sendall(b'queued')
+        sock.shutdown(socket.SHUT_WR)
+        self.assertEqual(b'queued', self._recv(sock, 100))
+        sock.close()
+
+    def test_stop(self):
+        '''Test that a stopped connection is dropped right away.'''
+
+        sock = self._connect()
+        sock.sendall(b'x.')
+        self.assertEqual(b'x.', self._recv(sock, 2))
+        self._protocols[0].connection.stop()
+        self.assertTrue(self._protocols[0].lostevent.wait(5.0))
+        self.assertEqual(b'', sock.recv(100))
+        sock.close()
+
+    def test_paused(self):
+        '''Test that a paused client is not read until it is resumed.'''
+
+        sock = self._connect()
+        sock.sendall(b'a.')
+        self.assertEqual(b'a.', self._recv(sock, 2))
+        self._protocols[0].hold = True
+        sock.sendall(b'b.')
+        self.assertEqual(b'b.', self._recv(sock, 2))
+        sock.sendall(b'c.')
+        sock.settimeout(0.2)
+        self.assertRaises(socket.timeout, sock.recv, 100)
+        sock.settimeout(5.0)
+        self._protocols[0].resume()
+        self.assertEqual(b'c.', self._recv(sock, 2))
+        sock.close()
+
+    def test_invalid(self):
+        '''Test that invalid data drops the client.'''
+
+        sock = self._connect()
+        sock.sendall(b'!')
+        self.assertEqual(b'', self._recv(sock, 100))
+        sock.close()
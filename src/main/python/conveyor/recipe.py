@@ -40,10 +40,20 @@ import conveyor.util
 
 
 class RecipeManager(object):
-    def __init__(self, config, server, spool):
+    def __init__(self, config, server, spool, eventqueue=None):
+        """
+        @param server an object with `queue_work(work, pool, job)` that runs
+            the print-to-file, g-code processing and verification on another
+            thread and `queue_slice(task, work, request, job)` that runs the
+            slicer (`work`) on another thread or hands the `SliceRequest` to a
+            slicing worker
+        @param eventqueue the event queue for the recipes' tasks (the global
+            event queue if `None`)
+        """
         self._config = config
         self._server = server
         self._spool = spool
+        self._eventqueue = eventqueue
         self._log = conveyor.log.getlogger(self)
 
     def get_recipe(self, job):
@@ -64,7 +74,9 @@ class RecipeManager(object):
         elif not os.path.isfile(job.input_file):
             raise conveyor.error.NotFileException(job.input_file)
         else:
-            recipe = _GcodeRecipe(self._server, self._config, job, self._spool, job.input_file)
+            recipe = _GcodeRecipe(
+                self._server, self._config, job, self._spool, job.input_file,
+                self._eventqueue)
         return recipe
 
     def _get_recipe_stl(self, job):
@@ -73,7 +85,9 @@ class RecipeManager(object):
         elif not os.path.isfile(job.input_file):
             raise conveyor.error.NotFileException(job.input_file)
         else:
-            recipe = _StlRecipe(self._server, self._config, job, self._spool, job.input_file)
+            recipe = _StlRecipe(
+                self._server, self._config, job, self._spool, job.input_file,
+                self._eventqueue)
             return recipe
 
     def _get_recipe_thing(self, job):
@@ -101,29 +115,70 @@ class RecipeManager(object):
                 stl_1_path = os.path.join(thing_dir, 'UNIFIED_MESH_HACK_1.stl')
                 if os.path.exists(stl_0_path) and os.path.exists(stl_1_path):
                     recipe = _DualThingRecipe(
-                        self._server, self._config, job, self._spool, stl_0_path, stl_1_path)
+                        self._server, self._config, job, self._spool,
+                        stl_0_path, stl_1_path, self._eventqueue)
                     pass
                 elif os.path.exists(stl_0_path):
                     recipe = _SingleThingRecipe(
-                        self._server, self._config, job, self._spool, stl_0_path)
+                        self._server, self._config, job, self._spool, stl_0_path,
+                        self._eventqueue)
                 elif os.path.exists(stl_1_path):
                     recipe = _SingleThingRecipe(
-                        self._server, self._config, job, self._spool, stl_1_path)
+                        self._server, self._config, job, self._spool, stl_1_path,
+                        self._eventqueue)
                 else:
                     raise InvalidThingException(job.input_file)
                 return recipe
 
 
+class SliceRequest(object):
+    '''The slicer stage of a recipe: everything a slicer needs.'''
+
+    def __init__(
+            self, slicer_name, profile, input_path, output_path,
+            add_start_end, slicer_settings, material_name, dualstrusion):
+        self.slicer_name = slicer_name
+        self.profile = profile
+        self.input_path = input_path
+        self.output_path = output_path
+        self.add_start_end = add_start_end
+        self.slicer_settings = slicer_settings
+        self.material_name = material_name
+        self.dualstrusion = dualstrusion
+
+    def create_slicer(self, config, task):
+        if conveyor.slicer.Slicer.MIRACLEGRUE == self.slicer_name:
+            exe = config.get('miracle_grue', 'exe')
+            profile_dir = config.get('miracle_grue', 'profile_dir')
+            slicer = conveyor.slicer.miraclegrue.MiracleGrueSlicer(
+                self.profile, self.input_path, self.output_path,
+                self.add_start_end, self.slicer_settings, self.material_name,
+                self.dualstrusion, task, exe, profile_dir)
+        elif conveyor.slicer.Slicer.SKEINFORGE == self.slicer_name:
+            file_ = config.get('skeinforge', 'file')
+            profile_dir = config.get('skeinforge', 'profile_dir')
+            skeinforge_profile = config.get('skeinforge', 'profile')
+            profile_file = os.path.join(profile_dir, skeinforge_profile)
+            slicer = conveyor.slicer.skeinforge.SkeinforgeSlicer(
+                self.profile, self.input_path, self.output_path,
+                self.add_start_end, self.slicer_settings, self.material_name,
+                self.dualstrusion, task, file_, profile_file)
+        else:
+            raise ValueError(self.slicer_name)
+        return slicer
+
+
 # TODO: re-order the constructor arguments so they match the rest of the
 # system.
 
 class Recipe(object):
-    def __init__(self, server, config, job, spool):
+    def __init__(self, server, config, job, spool, eventqueue=None):
         self._config = config
         self._log = conveyor.log.getlogger(self)
         self._job = job
         self._server = server
         self._spool = spool
+        self._eventqueue = eventqueue
 
     def getgcodeprocessors(self, profile):
         gcodeprocessors = self._job.gcode_processor_name
@@ -143,43 +198,31 @@ class Recipe(object):
 
     def _slicertask(self, profile, input_path, output_path, add_start_end,
             dualstrusion, slicer_settings):
-        if conveyor.slicer.Slicer.MIRACLEGRUE == self._job.slicer_name:
-            exe = self._config.get('miracle_grue', 'exe')
-            profile_dir = self._config.get('miracle_grue', 'profile_dir')
-            def running_callback(task):
-                try:
-                    def work():
-                        slicer = conveyor.slicer.miraclegrue.MiracleGrueSlicer(
-                            profile, input_path, output_path, add_start_end,
-                            slicer_settings, self._job.material_name,
-                            dualstrusion, task, exe, profile_dir)
-                        slicer.slice()
-                    self._server.queue_work(work)
-                except Exception as e:
-                    self._log.exception('unhandled exception; failed to queue slice')
-                    failure = conveyor.util.exception_to_failure(e)
-                    task.fail(failure)
-        elif conveyor.slicer.Slicer.SKEINFORGE == self._job.slicer_name:
-            file_ = self._config.get('skeinforge', 'file')
-            profile_dir = self._config.get('skeinforge', 'profile_dir')
-            skeinforge_profile = self._config.get('skeinforge', 'profile')
-            profile_file = os.path.join(profile_dir, skeinforge_profile)
-            def running_callback(task):
-                try:
-                    def work():
-                        slicer = conveyor.slicer.skeinforge.SkeinforgeSlicer(
-                            profile, input_path, output_path, add_start_end,
-                            slicer_settings, self._job.material_name,
-                            dualstrusion, task, file_, profile_file)
-                        slicer.slice()
-                    self._server.queue_work(work)
-                except Exception as e:
-                    self._log.exception('unhandled exception; failed to queue slice')
-                    failure = conveyor.util.exception_to_failure(e)
-                    task.fail(failure)
-        else:
+        if self._job.slicer_name not in (
+                conveyor.slicer.Slicer.MIRACLEGRUE,
+                conveyor.slicer.Slicer.SKEINFORGE):
             raise ValueError(self._job.slicer_name)
-        task = conveyor.task.Task()
+        request = SliceRequest(
+            self._job.slicer_name, profile, input_path, output_path,
+            add_start_end, slicer_settings, self._job.material_name,
+            dualstrusion)
+        def running_callback(task):
+            try:
+                def work():
+                    try:
+                        slicer = request.create_slicer(self._config, task)
+                    except Exception as e:
+                        self._log.exception('unhandled exception; failed to create slicer')
+                        failure = conveyor.util.exception_to_failure(e)
+                        task.fail(failure)
+                    else:
+                        slicer.slice()
+                self._server.queue_slice(task, work, request, self._job)
+            except Exception as e:
+                self._log.exception('unhandled exception; failed to queue slice')
+                failure = conveyor.util.exception_to_failure(e)
+                task.fail(failure)
+        task = conveyor.task.Task(self._eventqueue)
         task.runningevent.attach(running_callback)
         return task
 
@@ -188,22 +231,24 @@ class Recipe(object):
         gcodeprocessor_list = self.getgcodeprocessors(profile._s3g_profile)
         gcodeprocessors = list(factory.get_processors(gcodeprocessor_list, profile._s3g_profile))
         def runningcallback(task):
-            self._log.info('processing gcode %s -> %s', inputpath, outputpath)
-            try:
-                with open(inputpath) as f:
-                    output = list(f)
-                    for gcodeprocessor in gcodeprocessors:
-                        output = gcodeprocessor.process_gcode(output)
-                with open(outputpath, 'w') as f:
-                    for line in output:
-                        f.write(line)
-            except Exception as e:
-                self._log.exception('unhandled exception; gcode processing failed')
-                failure = conveyor.util.exception_to_failure(e)
-                task.fail(failure)
-            else:
-                task.end(None)
-        task = conveyor.task.Task()
+            def work():
+                self._log.info('processing gcode %s -> %s', inputpath, outputpath)
+                try:
+                    with open(inputpath) as f:
+                        output = list(f)
+                        for gcodeprocessor in gcodeprocessors:
+                            output = gcodeprocessor.process_gcode(output)
+                    with open(outputpath, 'w') as f:
+                        for line in output:
+                            f.write(line)
+                except Exception as e:
+                    self._log.exception('unhandled exception; gcode processing failed')
+                    failure = conveyor.util.exception_to_failure(e)
+                    task.fail(failure)
+                else:
+                    task.end(None)
+            self._server.queue_work(work, 'io', self._job)
+        task = conveyor.task.Task(self._eventqueue)
         task.runningevent.attach(runningcallback)
         return task
 
@@ -227,7 +272,7 @@ class Recipe(object):
                 task.fail(failure)
             else:
                 task.end(None)
-        task = conveyor.task.Task()
+        task = conveyor.task.Task(self._eventqueue)
         task.runningevent.attach(runningcallback)
         return task
 
@@ -242,7 +287,7 @@ class Recipe(object):
                 task.fail(failure)
             else:
                 task.end(None)
-        task = conveyor.task.Task()
+        task = conveyor.task.Task(self._eventqueue)
         task.runningevent.attach(runningcallback)
         return task
 
@@ -254,7 +299,7 @@ class Recipe(object):
                 self._job.slicer_settings.extruder_temperature,
                 self._job.slicer_settings.platform_temperature,
                 self._job.material_name, self._job.name, task,)
-        task = conveyor.task.Task()
+        task = conveyor.task.Task(self._eventqueue)
         task.runningevent.attach(runningcallback)
         return task
 
@@ -268,22 +313,22 @@ class Recipe(object):
                         self._job.slicer_settings.extruder_temperature,
                         self._job.slicer_settings.platform_temperature,
                         self._job.material_name, self._job.name, task)
-                self._server.queue_work(work)
+                self._server.queue_work(work, 'io', self._job)
             except Exception as e:
                 self._log.exception('unhandled exception; failed to queue print-to-file')
                 failure = conveyor.util.exception_to_failure(e)
                 task.fail(failure)
-        task = conveyor.task.Task()
+        task = conveyor.task.Task(self._eventqueue)
         task.runningevent.attach(runningcallback)
         return task
 
     @staticmethod
-    def verifys3gtask(s3gpath):
+    def verifys3gtask(s3gpath, eventqueue=None):
         """
         This function is static so it can be accessed by server/__init__.py when 
         executing the verifys3g command.
         """
-        task = conveyor.task.Task()
+        task = conveyor.task.Task(eventqueue)
 
         def update(percent):
             percent = min(percent, 100)
@@ -311,7 +356,7 @@ class Recipe(object):
         return task
 
     def verifygcodetask(self, gcodepath, profile, slicer_settings, material_name, dualstrusion):
-        task = conveyor.task.Task()
+        task = conveyor.task.Task(self._eventqueue)
         def update(percent):
             percent = min(percent, 100) 
             progress = {
@@ -322,29 +367,31 @@ class Recipe(object):
             if progress != task.progress:
                 task.heartbeat(progress)
         def runningcallback(task):
-            self._log.info('verifying g-code file %s', gcodepath)
-            try:
-                parser = makerbot_driver.Gcode.GcodeParser()
-                parser.state.values['build_name'] = "VALIDATION"
-                parser.state.profile = profile._s3g_profile
-                parser.s3g = mock.Mock()
-                extruders = [e.strip() for e in slicer_settings.extruder.split(',')]
-                gcode_scaffold = profile.get_gcode_scaffold(
-                    extruders,
-                    slicer_settings.extruder_temperature,
-                    slicer_settings.platform_temperature,
-                    material_name)
-                parser.environment.update(gcode_scaffold.variables)
-                with open(gcodepath) as f:
-                    for line in f:
-                        parser.execute_line(line)
-                        update(parser.state.percentage)
-            except Exception as e:
-                self._log.exception('unhandled exception; g-code verification failed')
-                failure = conveyor.util.exception_to_failure(e)
-                task.fail(failure)
-            else:
-                task.end(True)
+            def work():
+                self._log.info('verifying g-code file %s', gcodepath)
+                try:
+                    parser = makerbot_driver.Gcode.GcodeParser()
+                    parser.state.values['build_name'] = "VALIDATION"
+                    parser.state.profile = profile._s3g_profile
+                    parser.s3g = mock.Mock()
+                    extruders = [e.strip() for e in slicer_settings.extruder.split(',')]
+                    gcode_scaffold = profile.get_gcode_scaffold(
+                        extruders,
+                        slicer_settings.extruder_temperature,
+                        slicer_settings.platform_temperature,
+                        material_name)
+                    parser.environment.update(gcode_scaffold.variables)
+                    with open(gcodepath) as f:
+                        for line in f:
+                            parser.execute_line(line)
+                            update(parser.state.percentage)
+                except Exception as e:
+                    self._log.exception('unhandled exception; g-code verification failed')
+                    failure = conveyor.util.exception_to_failure(e)
+                    task.fail(failure)
+                else:
+                    task.end(True)
+            self._server.queue_work(work, 'io', self._job)
         task.runningevent.attach(runningcallback)
         return task
 
@@ -375,7 +422,7 @@ class Recipe(object):
                 task.fail(failure)
             else:
                 task.end(None)
-        task = conveyor.task.Task()
+        task = conveyor.task.Task(self._eventqueue)
         task.runningevent.attach(running_callback)
         return task
 
@@ -390,8 +437,8 @@ class Recipe(object):
 
 
 class _GcodeRecipe(Recipe):
-    def __init__(self, server, config, job, spool, gcodepath):
-        Recipe.__init__(self, server, config, job, spool)
+    def __init__(self, server, config, job, spool, gcodepath, eventqueue=None):
+        Recipe.__init__(self, server, config, job, spool, eventqueue)
         self._gcodepath = gcodepath
 
     def print(self):
@@ -416,7 +463,8 @@ class _GcodeRecipe(Recipe):
         printtask = self._printtask(self._job.machine, outputpath, False)
         tasks.append(printtask)
 
-        process = conveyor.process.tasksequence(self._job, tasks)
+        process = conveyor.process.tasksequence(
+            self._job, tasks, self._eventqueue)
         return process
 
 
@@ -440,18 +488,19 @@ class _GcodeRecipe(Recipe):
         print_to_filetask = self._print_to_filetask(start_end_path, self._job.output_file)
         tasks.append(print_to_filetask)
 
-        tasks.append(self.verifys3gtask(self._job.output_file))
+        tasks.append(self.verifys3gtask(self._job.output_file, self._eventqueue))
 
         def process_endcallback(task):
             os.unlink(start_end_path)
-        process = conveyor.process.tasksequence(self._job, tasks)
+        process = conveyor.process.tasksequence(
+            self._job, tasks, self._eventqueue)
         process.endevent.attach(process_endcallback)
         return process
 
 
 class _StlRecipe(Recipe):
-    def __init__(self, server, config, job, spool, stlpath):
-        Recipe.__init__(self, server, config, job, spool)
+    def __init__(self, server, config, job, spool, stlpath, eventqueue=None):
+        Recipe.__init__(self, server, config, job, spool, eventqueue)
         self._stlpath = stlpath
 
     def print(self):
@@ -498,7 +547,8 @@ class _StlRecipe(Recipe):
             os.unlink(gcodepath)
             if gcodepath != processed_gcodepath:
                 os.unlink(processed_gcodepath)
-        process = conveyor.process.tasksequence(self._job, tasks)
+        process = conveyor.process.tasksequence(
+            self._job, tasks, self._eventqueue)
         process.endevent.attach(process_endcallback)
         return process
 
@@ -541,13 +591,14 @@ class _StlRecipe(Recipe):
         print_to_filetask = self._print_to_filetask(start_end_path, self._job.output_file)
         tasks.append(print_to_filetask)
 
-        tasks.append(self.verifys3gtask(self._job.output_file))
+        tasks.append(self.verifys3gtask(self._job.output_file, self._eventqueue))
 
         def process_endcallback(task):
             os.unlink(gcodepath)
             if gcodepath != processed_gcodepath:
                 os.unlink(processed_gcodepath)
-        process = conveyor.process.tasksequence(self._job, tasks)
+        process = conveyor.process.tasksequence(
+            self._job, tasks, self._eventqueue)
         process.endevent.attach(process_endcallback)
         return process
 
@@ -584,7 +635,8 @@ class _StlRecipe(Recipe):
             if gcodepath != self._job.output_file:
                 os.unlink(gcodepath)
 
-        process = conveyor.process.tasksequence(self._job, tasks)
+        process = conveyor.process.tasksequence(
+            self._job, tasks, self._eventqueue)
         process.endevent.attach(process_endcallback)
         return process
 
@@ -594,32 +646,37 @@ class _ThingRecipe(Recipe):
 
 
 class _SingleThingRecipe(_ThingRecipe):
-    def __init__(self, server, config, job, spool, stl_path):
-        _ThingRecipe.__init__(self, server, config, job, spool)
+    def __init__(self, server, config, job, spool, stl_path, eventqueue=None):
+        _ThingRecipe.__init__(self, server, config, job, spool, eventqueue)
         self._stl_path = stl_path
 
     def print(self):
         stlrecipe = _StlRecipe(
-            self._server, self._config, self._job, self._spool, self._stl_path)
+            self._server, self._config, self._job, self._spool, self._stl_path,
+            self._eventqueue)
         process = stlrecipe.print()
         return process
 
     def print_to_file(self):
         stlrecipe = _StlRecipe(
-            self._server, self._config, self._job, self._spool, self._stl_path)
+            self._server, self._config, self._job, self._spool, self._stl_path,
+            self._eventqueue)
         process = stlrecipe.print_to_file()
         return process
 
     def slice(self):
         stlrecipe = _StlRecipe(
-            self._server, self._config, self._job, self._spool, self._stl_path)
+            self._server, self._config, self._job, self._spool, self._stl_path,
+            self._eventqueue)
         process = stlrecipe.slice()
         return process
 
 
 class _DualThingRecipe(_ThingRecipe):
-    def __init__(self, server, config, job, spool, stl_0_path, stl_1_path):
-        _ThingRecipe.__init__(self, server, config, job, spool)
+    def __init__(
+            self, server, config, job, spool, stl_0_path, stl_1_path,
+            eventqueue=None):
+        _ThingRecipe.__init__(self, server, config, job, spool, eventqueue)
         self._stl_0_path = stl_0_path
         self._stl_1_path = stl_1_path
 
@@ -638,13 +695,13 @@ class _DualThingRecipe(_ThingRecipe):
         settings_0.extruder = '0'
         slice_0_task = self._slicertask(
             self._job.profile, self._stl_0_path, gcode_0_path, False, True, settings_0)
-        tasks.append(slice_0_task)
 
         settings_1 = conveyor.domain.SlicerConfiguration.fromdict(self._job.slicer_settings.todict())
         settings_1.extruder = '1'
         slice_1_task = self._slicertask(
             self._job.profile, self._stl_1_path, gcode_1_path, False, True, settings_1)
-        tasks.append(slice_1_task)
+        # NOTE: the extruders are sliced at the same time.
+        tasks.append([slice_0_task, slice_1_task])
 
         #Combine for dualstrusion
         with tempfile.NamedTemporaryFile(suffix='.gcode', delete=True) as f:
@@ -686,9 +743,10 @@ class _DualThingRecipe(_ThingRecipe):
         print_to_filetask = self._print_to_filetask(start_end_path, self._job.output_file)
         tasks.append(print_to_filetask)
 
-        tasks.append(self.verifys3gtask(self._job.output_file))
+        tasks.append(self.verifys3gtask(self._job.output_file, self._eventqueue))
 
-        process = conveyor.process.tasksequence(self._job, tasks)
+        process = conveyor.process.tasksequence(
+            self._job, tasks, self._eventqueue)
         def process_endcallback(task):
             for path in [gcode_0_path, gcode_1_path, processed_gcodepath, tmp_dual_path, fixed_dual_path]:
                 os.unlink(path)
@@ -709,14 +767,14 @@ class _DualThingRecipe(_ThingRecipe):
         slice_0_task = self._slicertask(
             self._job.profile, self._stl_0_path, gcode_0_path, False, True,
             settings_0)
-        tasks.append(slice_0_task)
 
         settings_1 = conveyor.domain.SlicerConfiguration.fromdict(self._job.slicer_settings.todict())
         settings_1.extruder = '1'
         slice_1_task = self._slicertask(
             self._job.profile, self._stl_1_path, gcode_1_path, False, True,
             settings_1)
-        tasks.append(slice_1_task)
+        # NOTE: the extruders are sliced at the same time.
+        tasks.append([slice_0_task, slice_1_task])
 
         #Combine for dualstrusion
         with tempfile.NamedTemporaryFile(suffix='.gcode') as f:
@@ -743,7 +801,8 @@ class _DualThingRecipe(_ThingRecipe):
             self._job.add_start_end, True, fixed_dual_path, self._job.output_file)
         tasks.append(add_start_end_task)
 
-        process = conveyor.process.tasksequence(self._job, tasks)
+        process = conveyor.process.tasksequence(
+            self._job, tasks, self._eventqueue)
         def process_endcallback(task):
             for path in [gcode_0_path, gcode_1_path, dualstrusion_path, dual_path, tmp_dual_path, fixed_dual_path]:
                 os.unlink(path)
@@ -766,14 +825,14 @@ class _DualThingRecipe(_ThingRecipe):
         slice_0_task = self._slicertask(
             profile, self._stl_0_path, gcode_0_path, False, True,
             settings_0)
-        tasks.append(slice_0_task)
 
         settings_1 = conveyor.domain.SlicerConfiguration.fromdict(self._job.slicer_settings.todict())
         settings_1.extruder = '1'
         slice_1_task = self._slicertask(
             profile, self._stl_1_path, gcode_1_path, False, True,
             settings_1)
-        tasks.append(slice_1_task)
+        # NOTE: the extruders are sliced at the same time.
+        tasks.append([slice_0_task, slice_1_task])
 
         #Combine for dualstrusion
         with tempfile.NamedTemporaryFile(suffix='.gcode') as f:
@@ -815,7 +874,8 @@ class _DualThingRecipe(_ThingRecipe):
         printtask = self._printtask(self._job.machine, outputpath, True)
         tasks.append(printtask)
 
-        process = conveyor.process.tasksequence(self._job, tasks)
+        process = conveyor.process.tasksequence(
+            self._job, tasks, self._eventqueue)
         def process_endcallback(task):
             for path in [gcode_0_path, gcode_1_path, dualstrusion_path, processed_gcodepath, tmp_dual_path, fixed_dual_path]:
                 os.unlink(path)
@@ -0,0 +1,384 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/main/python/conveyor/scheduler.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import collections
+import multiprocessing
+import threading
+import time
+
+import conveyor.error
+import conveyor.log
+import conveyor.stoppable
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+def cpu_count():
+    '''Returns the number of CPUs (1 when it cannot be determined).'''
+
+    try:
+        count = multiprocessing.cpu_count()
+    except NotImplementedError:
+        count = 1
+    return count
+
+
+class Scheduler(conveyor.stoppable.StoppableInterface):
+    '''
+    Runs work on pools of worker threads ("slots") by the kind of resource
+    the work needs (i.e., "slicer" or "io"). A free slot runs the waiting
+    work of its pool:
+
+        1. with the highest priority,
+        2. from the owner (i.e., a client) with the least of its work running
+           in the pool,
+        3. from the owner that started work the longest time ago,
+        4. in the order it was submitted.
+
+    Work with a key (i.e., a machine name) does not start while the work of
+    another job (or without a job) with the same key runs, in any pool. The
+    work of one job (i.e., the two slices of a dual-extrusion print) shares
+    its key.
+
+    '''
+
+    @classmethod
+    def create(cls, pools, name):
+        '''
+        @param pools the number of slots of each pool by name
+        @param name the prefix of the thread names
+        '''
+
+        scheduler = cls(pools)
+        for pool, slots in sorted(pools.items()):
+            for i in range(slots):
+                thread = threading.Thread(
+                    target=scheduler.run, args=(pool,),
+                    name='%s-%s-%d' % (name, pool, i))
+                thread.daemon = True
+                thread.start()
+                scheduler._threads.append(thread)
+        return scheduler
+
+    def __init__(self, pools):
+        conveyor.stoppable.StoppableInterface.__init__(self)
+        self._condition = threading.Condition()
+        self._log = conveyor.log.getlogger(self)
+        self._pools = dict(pools)
+        self._queued = dict((pool, []) for pool in self._pools)
+        self._running = dict((pool, []) for pool in self._pools)
+        # NOTE: the number of running items of each job by key.
+        self._keys = collections.defaultdict(collections.Counter)
+        self._served = {}
+        self._counter = 0
+        self._stop = False
+        self._threads = []
+
+    def submit(
+            self, func, pool, name=None, priority=0, owner=None, key=None,
+            job_id=None):
+        '''
+        Queues `func` to run on a slot of `pool`.
+        @param name what the work is called in `get_queue`
+        @param priority work with a higher priority runs first
+        @param owner whoever the work is for; owners share the slots fairly
+        @param key work with the same key never runs at the same time
+        @param job_id the job whose priority the work has (see
+            `set_priority`)
+        @return the id of the work
+        '''
+
+        if pool not in self._pools:
+            raise ValueError(pool)
+        with self._condition:
+            self._counter += 1
+            work = _Work(
+                self._counter, func, pool, name, priority, owner, key,
+                job_id)
+            self._queued[pool].append(work)
+            self._condition.notify_all()
+        return work.id
+
+    def set_priority(self, job_id, priority):
+        '''Changes the priority of the waiting work of a job.'''
+
+        with self._condition:
+            for queued in self._queued.values():
+                for work in queued:
+                    if job_id == work.job_id:
+                        work.priority = priority
+
+    def get_queue(self):
+        '''
+        Returns the slots of each pool and its running and waiting work (in
+        the order it would run if no more work came).
+
+        '''
+
+        now = time.time()
+        with self._condition:
+            pools = {}
+            for pool, slots in self._pools.items():
+                queued = sorted(self._queued[pool], key=self._rank(pool))
+                pools[pool] = {
+                    'slots': slots,
+                    'running': [
+                        work.todict(now) for work in self._running[pool]],
+                    'queued': [work.todict(now) for work in queued],
+                }
+        return pools
+
+    def run(self, pool):
+        '''Runs the work of `pool` on the current thread until stopped.'''
+
+        while True:
+            with self._condition:
+                work = None
+                while not self._stop:
+                    work = self._take(pool)
+                    if None is not work:
+                        break
+                    self._condition.wait()
+                if self._stop:
+                    break
+            conveyor.error.guard(self._log, work.func)
+            with self._condition:
+                self._running[pool].remove(work)
+                if None is not work.key:
+                    holders = self._keys[work.key]
+                    holders[work.job_id] -= 1
+                    if 0 == holders[work.job_id]:
+                        del holders[work.job_id]
+                    if 0 == len(holders):
+                        del self._keys[work.key]
+                if not self._owns(work.owner):
+                    self._served.pop(work.owner, None)
+                # NOTE: work of any pool may have waited for the key.
+                self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+
+    def _rank(self, pool):
+        counts = collections.Counter(
+            work.owner for work in self._running[pool])
+        def rank(work):
+            return (
+                -work.priority, counts[work.owner],
+                self._served.get(work.owner, 0), work.id)
+        return rank
+
+    def _take(self, pool):
+        rank = self._rank(pool)
+        work = None
+        for candidate in self._queued[pool]:
+            if not self._blocked(candidate):
+                if None is work or rank(candidate) < rank(work):
+                    work = candidate
+        if None is not work:
+            self._queued[pool].remove(work)
+            self._running[pool].append(work)
+            if None is not work.key:
+                self._keys[work.key][work.job_id] += 1
+            self._served[work.owner] = work.id
+            work.started = time.time()
+        return work
+
+    def _blocked(self, work):
+        if None is work.key or work.key not in self._keys:
+            blocked = False
+        else:
+            # NOTE: work without a job never shares its key.
+            holders = self._keys[work.key]
+            blocked = (None is work.job_id
+                or any(job_id != work.job_id for job_id in holders))
+        return blocked
+
+    def _owns(self, owner):
+        for works in self._queued.values() + self._running.values():
+            for work in works:
+                if owner == work.owner:
+                    return True
+        return False
+
+
+class _Work(object):
+    def __init__(self, id, func, pool, name, priority, owner, key, job_id):
+        self.id = id
+        self.func = func
+        self.pool = pool
+        self.name = name
+        self.priority = priority
+        self.owner = owner
+        self.key = key
+        self.job_id = job_id
+        self.submitted = time.time()
+        self.started = None
+
+    def todict(self, now):
+        if None is self.started:
+            waited = now - self.submitted
+            ran = None
+        else:
+            waited = self.started - self.submitted
+            ran = now - self.started
+        dct = {
+            'id': self.id,
+            'name': self.name,
+            'priority': self.priority,
+            'owner': self.owner,
+            'key': self.key,
+            'job_id': self.job_id,
+            'waited': waited,
+            'ran': ran,
+        }
+        return dct
+
+
+class _SchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self._condition = threading.Condition()
+        self._order = []
+        self._gates = {}
+
+    def _work(self, name, gate=False):
+        if gate:
+            self._gates[name] = threading.Event()
+        def func():
+            with self._condition:
+                self._order.append(name)
+                self._condition.notify_all()
+            if gate:
+                self._gates[name].wait(5.0)
+        return func
+
+    def _wait(self, count):
+        with self._condition:
+            for i in range(50):
+                if count <= len(self._order):
+                    break
+                self._condition.wait(0.1)
+
+    def test_priority(self):
+        '''Test that waiting work runs by priority, then in order.'''
+
+        scheduler = Scheduler.create({'io': 1}, 'test')
+        scheduler.submit(self._work('busy', True), 'io')
+        self._wait(1)
+        scheduler.submit(self._work('low'), 'io', priority=0)
+        scheduler.submit(self._work('high'), 'io', priority=1)
+        scheduler.submit(self._work('low2'), 'io', priority=0, job_id=3)
+        scheduler.set_priority(3, 2)
+        self._gates['busy'].set()
+        self._wait(4)
+        scheduler.stop()
+        self.assertEqual(['busy', 'low2', 'high', 'low'], self._order)
+
+    def test_fair(self):
+        '''Test that an owner with a lot of waiting work takes turns with
+        the others.'''
+
+        scheduler = Scheduler.create({'io': 1}, 'test')
+        scheduler.submit(self._work('a1', True), 'io', owner='a')
+        self._wait(1)
+        for name in ('a2', 'a3'):
+            scheduler.submit(self._work(name), 'io', owner='a')
+        scheduler.submit(self._work('b1'), 'io', owner='b')
+        self._gates['a1'].set()
+        self._wait(4)
+        scheduler.stop()
+        self.assertEqual(['a1', 'b1', 'a2', 'a3'], self._order)
+
+    def test_key(self):
+        '''Test that work with the same key does not run at the same time,
+        in any pool, and that other work does.'''
+
+        scheduler = Scheduler.create({'io': 2, 'slicer': 1}, 'test')
+        scheduler.submit(
+            self._work('m1', True), 'io', name='m1', key='machine')
+        self._wait(1)
+        scheduler.submit(
+            self._work('m2'), 'slicer', name='m2', key='machine')
+        scheduler.submit(self._work('other'), 'io')
+        self._wait(2)
+        self.assertEqual(['m1', 'other'], self._order)
+        queue = scheduler.get_queue()
+        self.assertEqual(2, queue['io']['slots'])
+        self.assertEqual(
+            ['m1'], [work['name'] for work in queue['io']['running']])
+        self.assertEqual(
+            ['m2'], [work['name'] for work in queue['slicer']['queued']])
+        self._gates['m1'].set()
+        self._wait(3)
+        scheduler.stop()
+        self.assertEqual(['m1', 'other', 'm2'], self._order)
+
+    def test_key_job(self):
+        '''Test that the work of one job shares its key (i.e., the two
+        slices of a dual-extrusion print run at the same time) while another
+        job with the key waits.'''
+
+        scheduler = Scheduler.create({'slicer': 3}, 'test')
+        for name in ('slice0', 'slice1'):
+            scheduler.submit(
+                self._work(name, True), 'slicer', name=name,
+                key=('machine', 'm'), job_id=1)
+        scheduler.submit(
+            self._work('other'), 'slicer', name='other',
+            key=('machine', 'm'), job_id=2)
+        self._wait(2)
+        queue = scheduler.get_queue()
+        self.assertEqual(
+            ['slice0', 'slice1'],
+            sorted(work['name'] for work in queue['slicer']['running']))
+        self.assertEqual(
+            ['other'],
+            [work['name'] for work in queue['slicer']['queued']])
+        self._gates['slice0'].set()
+        self._gates['slice1'].set()
+        self._wait(3)
+        scheduler.stop()
+        self.assertEqual('other', self._order[-1])
+
+    def test_submit_Exception(self):
+        '''Test that an exception does not kill the slot.'''
+
+        scheduler = Scheduler.create({'io': 1}, 'test')
+        def fail():
+            raise Exception('failure')
+        scheduler.submit(fail, 'io')
+        scheduler.submit(self._work('after'), 'io')
+        self._wait(1)
+        scheduler.stop()
+        self.assertEqual(['after'], self._order)
+
+    def test_submit_unknown(self):
+        '''Test that work for an unknown pool is refused.'''
+
+        scheduler = Scheduler({'io': 1})
+        with self.assertRaises(ValueError):
+            scheduler.submit(self._work('work'), 'gpu')
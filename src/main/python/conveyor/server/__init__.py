@@ -19,24 +19,79 @@
 
 from __future__ import (absolute_import, print_function, unicode_literals)
 
+import base64
+import binascii
 import collections
 import logging
 import os.path
 import threading
+import time
 
 import conveyor.connection
+import conveyor.event
+import conveyor.executor
+import conveyor.federation
 import conveyor.job
+import conveyor.jobstore
 import conveyor.jsonrpc
+import conveyor.listener
 import conveyor.log
+import conveyor.reactor
 import conveyor.recipe
+import conveyor.scheduler
 import conveyor.slicer
 import conveyor.slicer.miraclegrue
 import conveyor.slicer.skeinforge
 import conveyor.stoppable
+import conveyor.upload
 import conveyor.util
+import conveyor.worker
 
 from conveyor.decorator import jsonrpc
 
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+# The number of requests that may wait for a dispatch thread (per thread).
+_DISPATCH_QUEUE_SIZE = 16
+
+# The number of dispatch threads in reactor mode when none are configured.
+_REACTOR_DISPATCH_THREADS = 4
+
+# The notifications that a client may subscribe to.
+_NOTIFICATIONS = (
+    'port_attached', 'port_detached', 'machine_state_changed',
+    'machine_temperature_changed', 'jobadded', 'jobchanged')
+
+# The notifications that carry the state of a machine.
+_MACHINE_NOTIFICATIONS = (
+    'machine_state_changed', 'machine_temperature_changed')
+
+
+def _create_executor(config, reactor):
+    '''
+    Returns the executor that runs the clients' requests, or `None` when each
+    client runs its requests one at a time on its own thread. That is the
+    default (server.dispatch_threads is 0) outside of reactor mode; the
+    elements of a batch then run one after another too.
+
+    '''
+
+    dispatch_threads = config.get('server', 'dispatch_threads')
+    if reactor and 0 == dispatch_threads:
+        # NOTE: the reactor thread must never run a request.
+        dispatch_threads = _REACTOR_DISPATCH_THREADS
+    if 0 == dispatch_threads:
+        executor = None
+    else:
+        executor = conveyor.executor.Executor.create(
+            dispatch_threads, dispatch_threads * _DISPATCH_QUEUE_SIZE,
+            'dispatch_thread')
+    return executor
+
 
 class Server(conveyor.stoppable.StoppableInterface):
     def __init__(
@@ -54,61 +109,152 @@ class Server(conveyor.stoppable.StoppableInterface):
         self._log = conveyor.log.getlogger(self)
         self._clients = set()
         self._clients_condition = threading.Condition()
-        self._queue = collections.deque()
-        self._queue_condition = threading.Condition()
-        self._job_id_counter = 0
-        self._jobs = {}
-        self._jobs_condition = threading.Condition()
+        slicer_slots = self._config.get('server', 'slicer_slots')
+        if 0 == slicer_slots:
+            slicer_slots = conveyor.scheduler.cpu_count()
+        self._scheduler = conveyor.scheduler.Scheduler.create({
+            'slicer': slicer_slots,
+            'io': self._config.get('server', 'io_slots'),
+        }, 'work')
+        job_archive_file = self._config.get('server', 'job_archive_file')
+        if '' == job_archive_file:
+            job_archive = None
+        else:
+            job_archive = conveyor.jobstore.JobArchive.create(
+                job_archive_file,
+                self._config.get('server', 'job_archive_limit'))
+        self._job_registry = conveyor.jobstore.JobRegistry(
+            self._config.get('server', 'job_history'), job_archive)
+        self._uploads = conveyor.upload.UploadManager.create(
+            self._config.get('server', 'upload_directory'),
+            self._config.get('server', 'upload_limit'),
+            self._config.get('server', 'upload_chunk_limit'),
+            self._config.get('server', 'upload_timeout'))
         self._print_queued = set()
         self._print_queued_condition = threading.Condition()
+        self._coalescer = _Coalescer.create(
+            self._config.get('server', 'notification_interval'))
+        self._temperature_deadband = self._config.get(
+            'server', 'temperature_deadband')
+        self._temperatures = {}
+        self._snapshots = _Snapshots()
+        self._reactor = None
+        self._federation = conveyor.federation.Federation.create(
+            self._config, self)
+        self._workers = conveyor.worker.WorkerPool.create(self._config)
+        self._slice_worker = conveyor.worker.SliceWorker.create(
+            self._config, self._driver_manager, self._uploads)
         self._port_manager.port_attached.attach(self._port_attached)
         self._port_manager.port_detached.attach(self._port_detached)
 
     def stop(self):
         self._stop = True
-        with self._queue_condition:
-            self._queue_condition.notify_all()
+        self._coalescer.stop()
+        self._federation.stop()
+        self._workers.stop()
+        if None is not self._reactor:
+            self._reactor.stop()
+        self._scheduler.stop()
 
     def run(self):
-        work_thread = threading.Thread(target=self._work_queue_target)
-        work_thread.start()
+        reactor = (self._config.get('server', 'reactor')
+            and conveyor.reactor.available(self._listener))
+        executor = _create_executor(self._config, reactor)
+        batch_timeout = self._config.get('server', 'batch_timeout')
+        if 0 >= batch_timeout:
+            batch_timeout = None
+        coalesce_window = self._config.get('server', 'coalesce_window')
+        if 0 > coalesce_window:
+            coalesce_window = 0.0
+        outbound_limit = self._config.get('server', 'outbound_limit')
+        max_frame_size = self._config.get('server', 'max_frame_size')
+        stall_timeout = self._config.get('server', 'stall_timeout')
+        remote = isinstance(self._listener, conveyor.listener.TcpListener)
+        self._federation.start()
         try:
-            while not self._stop:
-                connection = self._listener.accept()
-                if None is not connection:
-                    jsonrpc = conveyor.jsonrpc.JsonRpc(connection, connection)
-                    client = _Client(self._config, self, jsonrpc)
-                    client.start()
+            if reactor:
+                self._reactor = conveyor.reactor.Reactor.create(
+                    self._listener, coalesce_window, outbound_limit,
+                    stall_timeout)
+                def accept(connection, writer):
+                    jsonrpc = conveyor.jsonrpc.JsonRpc(
+                        connection, writer, executor, batch_timeout,
+                        max_frame_size)
+                    client = _Client(
+                        self._config, self, jsonrpc, remote, writer)
+                    client.attach()
+                    return client
+                if not self._stop:
+                    self._reactor.run(accept)
+            else:
+                self._accept_clients(
+                    executor, batch_timeout, coalesce_window, outbound_limit,
+                    max_frame_size, stall_timeout, remote)
         finally:
-            work_thread.join(1)
+            if None is not executor:
+                executor.stop()
+            self._job_registry.close()
+            self._slice_worker.stop()
+            self._uploads.close()
         return 0
 
-    def queue_work(self, work):
-        with self._queue_condition:
-            self._queue.appendleft(work)
-            self._queue_condition.notify_all()
-
-    def _work_queue_target(self):
+    def _accept_clients(
+            self, executor, batch_timeout, coalesce_window, outbound_limit,
+            max_frame_size, stall_timeout, remote):
         while not self._stop:
-            def func():
-                with self._queue_condition:
-                    if 0 == len(self._queue):
-                        self._queue_condition.wait()
-                    if 0 == len(self._queue):
-                        work = None
-                    else:
-                        work = self._queue.pop()
-                if None is not work:
-                    work()
-            conveyor.error.guard(self._log, func)
+            connection = self._listener.accept()
+            if None is not connection:
+                # NOTE: the writer queues everything sent to the client so that
+                # a slow client never blocks the threads that send it
+                # notifications.
+                writer = conveyor.connection.BufferedWriter.create(
+                    connection, coalesce_window, outbound_limit,
+                    stall_timeout)
+                jsonrpc = conveyor.jsonrpc.JsonRpc(
+                    connection, writer, executor, batch_timeout,
+                    max_frame_size)
+                client = _Client(self._config, self, jsonrpc, remote, writer)
+                client.start()
+
+    def queue_work(self, work, pool='io', job=None):
+        '''
+        Queues `work` on a slot of the scheduler's `pool` ("slicer" or "io").
+        The work of a job has the job's priority and owner, and the jobs that
+        print on the same machine run their work one job at a time (the work
+        of one job, i.e., two slices, still runs at the same time).
+
+        '''
+
+        if None is job:
+            self._scheduler.submit(work, pool)
+        else:
+            machine = getattr(job, 'machine', None)
+            if None is machine:
+                key = None
+            else:
+                key = ('machine', machine.name)
+            self._scheduler.submit(
+                work, pool, job.name, job.priority, job.owner, key, job.id)
+
+    def queue_slice(self, task, work, request, job=None):
+        '''
+        Hands a slice to a slicing worker or, when none is free, queues the
+        slicer (`work`) on a slicer slot.
+
+        '''
+
+        self._workers.slice(
+            task, request, lambda: self.queue_work(work, 'slicer', job))
 
     def _port_attached(self, port):
+        self._snapshots.invalidate('ports', 'printers')
         with self._clients_condition:
             clients = self._clients.copy()
         port_info = port.get_info()
         _Client.port_attached(clients, port_info)
 
     def _port_detached(self, port_name):
+        self._snapshots.invalidate('ports', 'printers')
         with self._clients_condition:
             clients = self._clients.copy()
         _Client.port_detached(clients, port_name)
@@ -117,16 +263,27 @@ class Server(conveyor.stoppable.StoppableInterface):
         pass # TODO
 
     def _machine_state_changed(self, machine):
+        self._snapshots.invalidate('printers')
         with self._clients_condition:
             clients = self._clients.copy()
         machine_info = machine.get_info()
         _Client.machine_state_changed(clients, machine_info)
 
     def _machine_temperature_changed(self, machine):
-        with self._clients_condition:
-            clients = self._clients.copy()
-        machine_info = machine.get_info()
-        _Client.machine_temperature_changed(clients, machine_info)
+        def func():
+            with self._clients_condition:
+                clients = self._clients.copy()
+            machine_info = machine.get_info()
+            self._temperatures[machine.name] = machine_info.temperature
+            self._snapshots.invalidate('printers')
+            _Client.machine_temperature_changed(clients, machine_info)
+        # NOTE: changes smaller than the dead-band (i.e., the sensor noise
+        # while a heater holds its temperature) are not sent at all.
+        delta = _temperature_delta(
+            self._temperatures.get(machine.name),
+            machine.get_info().temperature)
+        if None is delta or self._temperature_deadband <= delta:
+            self._coalescer.post(('temperature', machine.name), func)
 
     def _add_client(self, client):
         with self._clients_condition:
@@ -142,18 +299,21 @@ class Server(conveyor.stoppable.StoppableInterface):
             self._clients.remove(client)
 
     def _add_job(self, job):
-        with self._jobs_condition:
-            self._jobs[job.id] = job
+        self._job_registry.add(job)
         with self._clients_condition:
             clients = self._clients.copy()
         job_info = job.get_info()
         _Client.job_added(clients, job_info)
 
     def _job_changed(self, job):
-        job_info = job.get_info()
-        with self._clients_condition:
-            clients = self._clients.copy()
-        _Client.job_changed(clients, job_info)
+        self._job_registry.changed(job)
+        def func():
+            job_info = job.get_info()
+            with self._clients_condition:
+                clients = self._clients.copy()
+            _Client.job_changed(clients, job_info)
+        final = conveyor.task.TaskState.STOPPED == job.task.state
+        self._coalescer.post(('job', job.id), func, final)
 
     def _find_port_by_port_name(self, port_name):
         if None is not port_name:
@@ -220,11 +380,7 @@ class Server(conveyor.stoppable.StoppableInterface):
                 port = self._find_port_by_machine_name(machine_name)
                 driver = self._find_driver(port, driver_name)
                 profile = self._find_profile(port, driver, profile_name)
-                machine = self._machine_manager.new_machine(
-                    port, driver, profile)
-                machine.state_changed.attach(self._machine_state_changed)
-                machine.temperature_changed.attach(
-                    self._machine_temperature_changed)
+                machine = self._new_machine(port, driver, profile)
             else:
                 if None is port_name:
                     port = self._find_port_by_machine_name(machine_name)
@@ -256,18 +412,22 @@ class Server(conveyor.stoppable.StoppableInterface):
                 try:
                     machine = self._machine_manager.get_machine(machine_name)
                 except conveyor.error.UnknownMachineError:
-                    machine = self._machine_manager.new_machine(
-                        port, driver, profile)
-                    machine.state_changed.attach(self._machine_state_changed)
-                    machine.temperature_changed.attach(
-                        self._machine_temperature_changed)
+                    machine = self._new_machine(port, driver, profile)
                 else:
                     machine.set_port(port)
                     port.set_machine(machine)
         return machine
 
+    def _new_machine(self, port, driver, profile):
+        machine = self._machine_manager.new_machine(port, driver, profile)
+        machine.state_changed.attach(self._machine_state_changed)
+        machine.temperature_changed.attach(self._machine_temperature_changed)
+        self._snapshots.invalidate('printers')
+        return machine
+
     def get_ports(self):
-        ports = self._port_manager.get_ports()
+        ports = list(self._port_manager.get_ports())
+        ports.extend(self._federation.get_ports())
         return ports
 
     def get_drivers(self):
@@ -289,12 +449,30 @@ class Server(conveyor.stoppable.StoppableInterface):
         return profile
 
     def get_machines(self):
-        machines = self._machine_manager.get_machines()
+        machines = list(self._machine_manager.get_machines())
+        machines.extend(self._federation.get_machines())
         return machines
 
+    def get_snapshot(self, kind, arg, build):
+        '''
+        Returns the version and the cached result of `build()` for a listing
+        (see `_Snapshots`).
+
+        '''
+
+        snapshot = self._snapshots.get(kind, arg, build)
+        return snapshot
+
     def connect(
             self, client, machine_name, port_name, driver_name, profile_name,
             persistent):
+        if (self._federation.owns(machine_name)
+                or self._federation.owns(port_name)):
+            # NOTE: the node that owns the machine keeps it connected.
+            machine = self._federation.connect(
+                machine_name, port_name, driver_name, profile_name,
+                persistent)
+            return machine
         machine = self._find_machine(
             machine_name, port_name, driver_name, profile_name)
         if conveyor.machine.MachineState.DISCONNECTED == machine.get_state():
@@ -304,105 +482,254 @@ class Server(conveyor.stoppable.StoppableInterface):
         return machine
 
     def disconnect(self, machine_name):
-        machine = self._find_machine(machine_name, None, None, None)
-        machine.disconnect()
+        if self._federation.owns(machine_name):
+            self._federation.disconnect(machine_name)
+        else:
+            machine = self._find_machine(machine_name, None, None, None)
+            machine.disconnect()
 
     def print(
             self, machine_name, input_file, extruder_name,
             gcode_processor_name, has_start_end, material_name, slicer_name,
-            slicer_settings):
+            slicer_settings, upload_id=None, owner=None, priority=0):
+        if self._federation.owns(machine_name):
+            job = self._federation_print(
+                machine_name, input_file, extruder_name,
+                gcode_processor_name, has_start_end, material_name,
+                slicer_name, slicer_settings, upload_id)
+            return job
         job_id = self._create_job_id()
-        job_name = self._get_job_name(input_file)
         machine = self._find_machine(machine_name, None, None, None)
         if self._is_print_queued(machine) or not machine.is_idle():
             raise conveyor.error.PrintQueuedException
         else:
-            job = conveyor.job.PrintJob(
-                job_id, job_name, machine, input_file, extruder_name,
-                gcode_processor_name, has_start_end, material_name, slicer_name,
-                slicer_settings)
-            recipe_manager = conveyor.recipe.RecipeManager(
-                self._config, self, self._spool)
-            recipe = recipe_manager.get_recipe(job)
-            job.task = recipe.print()
+            input_file = self._claim_upload(upload_id, input_file)
+            try:
+                job_name = self._get_job_name(input_file)
+                job = conveyor.job.PrintJob(
+                    job_id, job_name, machine, input_file, extruder_name,
+                    gcode_processor_name, has_start_end, material_name,
+                    slicer_name, slicer_settings)
+                job.owner = owner
+                job.priority = priority
+                recipe_manager = conveyor.recipe.RecipeManager(
+                    self._config, self, self._spool,
+                    conveyor.event.getlane(('job', job_id)))
+                recipe = recipe_manager.get_recipe(job)
+                job.task = recipe.print()
+            except:
+                self._unclaim_upload(upload_id)
+                raise
             self._attach_job_callbacks(job)
             self._attach_print_queued_callbacks(machine, job)
+            self._attach_upload_callbacks(job, upload_id)
             job.task.start()
             return job
 
+    def _federation_print(
+            self, machine_name, input_file, extruder_name,
+            gcode_processor_name, has_start_end, material_name, slicer_name,
+            slicer_settings, upload_id):
+        '''
+        Starts a print on a federated conveyor service. A file that was
+        uploaded here is uploaded to the node in turn.
+
+        '''
+
+        input_file = self._claim_upload(upload_id, input_file)
+        try:
+            job = self._federation.print(
+                machine_name, input_file, extruder_name,
+                gcode_processor_name, has_start_end, material_name,
+                slicer_name, slicer_settings, None is not upload_id)
+        except:
+            self._unclaim_upload(upload_id)
+            raise
+        if None is not upload_id:
+            self._uploads.release(upload_id)
+        return job
+
     def pause(self, machine_name):
-        machine = self._find_machine(machine_name, None, None, None)
-        machine.pause()
+        if self._federation.owns(machine_name):
+            self._federation.pause(machine_name)
+        else:
+            machine = self._find_machine(machine_name, None, None, None)
+            machine.pause()
 
     def unpause(self, machine_name):
-        machine = self._find_machine(machine_name, None, None, None)
-        machine.unpause()
+        if self._federation.owns(machine_name):
+            self._federation.unpause(machine_name)
+        else:
+            machine = self._find_machine(machine_name, None, None, None)
+            machine.unpause()
 
     def print_to_file(
             self, driver_name, profile_name, input_file, output_file,
             extruder_name, file_type, gcode_processor_name, has_start_end,
-            material_name, slicer_name, slicer_settings):
+            material_name, slicer_name, slicer_settings, upload_id=None,
+            owner=None, priority=0):
         job_id = self._create_job_id()
         job_name = self._get_job_name(output_file)
-        driver = self._driver_manager.get_driver(driver_name)
-        profile = driver.get_profile(profile_name)
-        job = conveyor.job.PrintToFileJob(
-            job_id, job_name, driver, profile, input_file, output_file,
-            extruder_name, file_type, gcode_processor_name, has_start_end,
-            material_name, slicer_name, slicer_settings)
-        recipe_manager = conveyor.recipe.RecipeManager(
-            self._config, self, self._spool)
-        recipe = recipe_manager.get_recipe(job)
-        job.task = recipe.print_to_file()
+        input_file = self._claim_upload(upload_id, input_file)
+        try:
+            driver = self._driver_manager.get_driver(driver_name)
+            profile = driver.get_profile(profile_name)
+            job = conveyor.job.PrintToFileJob(
+                job_id, job_name, driver, profile, input_file, output_file,
+                extruder_name, file_type, gcode_processor_name, has_start_end,
+                material_name, slicer_name, slicer_settings)
+            job.owner = owner
+            job.priority = priority
+            recipe_manager = conveyor.recipe.RecipeManager(
+                self._config, self, self._spool,
+                conveyor.event.getlane(('job', job_id)))
+            recipe = recipe_manager.get_recipe(job)
+            job.task = recipe.print_to_file()
+        except:
+            self._unclaim_upload(upload_id)
+            raise
         self._attach_job_callbacks(job)
+        self._attach_upload_callbacks(job, upload_id)
         job.task.start()
         return job
 
     def slice(
             self, driver_name, profile_name, input_file, output_file,
             add_start_end, extruder_name, gcode_processor_name, material_name,
-            slicer_name, slicer_settings):
+            slicer_name, slicer_settings, upload_id=None, owner=None,
+            priority=0):
         job_id = self._create_job_id()
         job_name = self._get_job_name(output_file)
-        driver = self._driver_manager.get_driver(driver_name)
-        profile = driver.get_profile(profile_name)
-        job = conveyor.job.SliceJob(
-            job_id, job_name, driver, profile, input_file, output_file,
-            add_start_end, extruder_name, gcode_processor_name,
-            material_name, slicer_name, slicer_settings)
-        recipe_manager = conveyor.recipe.RecipeManager(
-            self._config, self, self._spool)
-        recipe = recipe_manager.get_recipe(job)
-        job.task = recipe.slice()
+        input_file = self._claim_upload(upload_id, input_file)
+        try:
+            driver = self._driver_manager.get_driver(driver_name)
+            profile = driver.get_profile(profile_name)
+            job = conveyor.job.SliceJob(
+                job_id, job_name, driver, profile, input_file, output_file,
+                add_start_end, extruder_name, gcode_processor_name,
+                material_name, slicer_name, slicer_settings)
+            job.owner = owner
+            job.priority = priority
+            recipe_manager = conveyor.recipe.RecipeManager(
+                self._config, self, self._spool,
+                conveyor.event.getlane(('job', job_id)))
+            recipe = recipe_manager.get_recipe(job)
+            job.task = recipe.slice()
+        except:
+            self._unclaim_upload(upload_id)
+            raise
         self._attach_job_callbacks(job)
+        self._attach_upload_callbacks(job, upload_id)
         job.task.start()
         return job
 
     def get_jobs(self, client):
-        with self._jobs_condition:
-            jobs = self._jobs.copy()
+        jobs = self._job_registry.get_jobs()
         return jobs
 
     def get_job(self, job_id):
-        with self._jobs_condition:
-            try:
-                job = self._jobs[job_id]
-            except KeyError:
-                raise conveyor.error.UnknownJobError(job_id)
-            else:
-                return job
+        job = self._job_registry.get_job(job_id)
+        if None is job:
+            raise conveyor.error.UnknownJobError(job_id)
+        else:
+            return job
+
+    def get_job_info(self, job_id):
+        info = self._job_registry.get_info(job_id)
+        return info
+
+    def query_jobs(self, states, types, machine_names, since, offset, limit):
+        result = self._job_registry.query(
+            states, types, machine_names, since, offset, limit)
+        return result
 
     def cancel_job(self, job_id):
-        job = self.get_job(job_id)
-        if conveyor.task.TaskState.STOPPED != job.task.state:
+        job = self._job_registry.get_job(job_id)
+        if None is job:
+            # NOTE: a job that is no longer in memory stopped long ago.
+            self._job_registry.get_info(job_id)
+        elif conveyor.task.TaskState.STOPPED != job.task.state:
             job.task.cancel()
 
+    def set_job_priority(self, job_id, priority):
+        job = self.get_job(job_id)
+        job.priority = priority
+        self._scheduler.set_priority(job_id, priority)
+
+    def get_work_queue(self):
+        queue = self._scheduler.get_queue()
+        return queue
+
     def _create_job_id(self):
-        with self._jobs_condition:
-            self._job_id_counter += 1
-            id_ = self._job_id_counter
+        id_ = self._job_registry.create_job_id()
         return id_
 
+    def begin_upload(self, name, size, sha256):
+        upload = self._uploads.begin(name, size, sha256)
+        return upload
+
+    def write_upload(self, upload_id, offset, data):
+        offset = self._uploads.write(upload_id, offset, data)
+        return offset
+
+    def get_upload(self, upload_id):
+        upload = self._uploads.get(upload_id)
+        return upload
+
+    def finish_upload(self, upload_id):
+        dct = self._uploads.finish(upload_id)
+        return dct
+
+    def cancel_upload(self, upload_id):
+        self._uploads.cancel(upload_id)
+
+    def get_worker_load(self):
+        load = self._slice_worker.get_load()
+        return load
+
+    def get_event_stats(self):
+        stats = conveyor.event.getstats()
+        return stats
+
+    def worker_slice(
+            self, upload_id, driver_name, profile_name, add_start_end,
+            slicer_name, slicer_settings, material_name, dualstrusion,
+            progress):
+        task = self._slice_worker.slice(
+            upload_id, driver_name, profile_name, add_start_end, slicer_name,
+            slicer_settings, material_name, dualstrusion, progress)
+        return task
+
+    def read_slice(self, upload_id, offset, length):
+        data = self._slice_worker.read(upload_id, offset, length)
+        return data
+
+    def cancel_slice(self, upload_id):
+        self._slice_worker.cancel(upload_id)
+
+    def release_slice(self, upload_id):
+        self._slice_worker.release(upload_id)
+
+    def get_upload_chunk_limit(self):
+        return self._uploads.chunk_limit
+
+    def _claim_upload(self, upload_id, input_file):
+        if None is upload_id:
+            path = input_file
+        else:
+            path = self._uploads.claim(upload_id)
+        return path
+
+    def _unclaim_upload(self, upload_id):
+        if None is not upload_id:
+            self._uploads.unclaim(upload_id)
+
+    def _attach_upload_callbacks(self, job, upload_id):
+        if None is not upload_id:
+            def stopped_callback(task):
+                self._uploads.release(upload_id)
+            job.task.stoppedevent.attach(stopped_callback)
+
     def _get_job_name(self, p):
         root, ext = os.path.splitext(p)
         job_name = os.path.basename(root)
@@ -497,6 +824,236 @@ class Server(conveyor.stoppable.StoppableInterface):
         return task
 
 
+class _Coalescer(object):
+    '''
+    Rate limits the notifications for each job or machine. A notification is
+    sent right away unless one was sent for the same key within the last
+    `interval` seconds; then it waits and any notifications posted for the key
+    in the meantime collapse into the one that is eventually sent. The
+    notification function runs when the notification is sent so it always
+    sends the latest state.
+
+    '''
+
+    @classmethod
+    def create(cls, interval):
+        coalescer = cls(interval)
+        thread = threading.Thread(
+            target=coalescer._coalescer, name='coalescer')
+        thread.daemon = True
+        thread.start()
+        coalescer._thread = thread
+        return coalescer
+
+    def __init__(self, interval):
+        self._interval = interval
+        self._condition = threading.Condition()
+        self._log = conveyor.log.getlogger(self)
+        self._sent = {}
+        self._pending = {}
+        self._stop = False
+        self._thread = None
+
+    def post(self, key, func, final=False):
+        '''
+        Send the notification for `key` by calling `func`. A `final`
+        notification (i.e., a job stopped) is sent right away and replaces any
+        pending notification for the key.
+
+        '''
+
+        # NOTE: notifications are sent with the lock held so that a pending
+        # notification can never overtake a newer one for the same key.
+        # Sending only queues the data for each client so it does not block.
+        with self._condition:
+            now = time.time()
+            if final:
+                self._pending.pop(key, None)
+                self._sent.pop(key, None)
+                self._send(func)
+            elif key in self._pending:
+                self._pending[key] = func
+            else:
+                sent = self._sent.get(key)
+                if None is sent or self._interval <= now - sent:
+                    self._sent[key] = now
+                    self._send(func)
+                else:
+                    self._pending[key] = func
+                    self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._stop = True
+            self._condition.notify_all()
+        if (None is not self._thread
+                and threading.current_thread() is not self._thread):
+            self._thread.join(1)
+
+    def _send(self, func):
+        conveyor.error.guard(self._log, func)
+
+    def _coalescer(self):
+        with self._condition:
+            while not self._stop:
+                now = time.time()
+                deadline = None
+                for key in list(self._pending):
+                    due = self._sent[key] + self._interval
+                    if now >= due:
+                        func = self._pending.pop(key)
+                        self._sent[key] = now
+                        self._send(func)
+                    elif None is deadline or deadline > due:
+                        deadline = due
+                for key, sent in list(self._sent.items()):
+                    if (key not in self._pending
+                            and self._interval <= now - sent):
+                        del self._sent[key]
+                if None is not deadline:
+                    self._condition.wait(deadline - now)
+                elif 0 != len(self._sent):
+                    self._condition.wait(self._interval)
+                else:
+                    self._condition.wait()
+
+
+class _Snapshots(object):
+    '''
+    Versioned, ready-to-send results for the requests that list printers,
+    ports, drivers, and profiles. A result is built on first use and kept
+    until the server invalidates its kind: the ports when a port is attached
+    or detached, the printers when a port or machine changes. The drivers and
+    profiles are loaded when the service starts and never change.
+
+    Each snapshot has a version that changes whenever it is invalidated. A
+    client that passes the version it last saw gets a "not modified" reply
+    instead of the whole listing.
+
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # NOTE: the versions count up from the clock so that a version from
+        # before a restart is never mistaken for a current one.
+        self._counter = int(time.time() * 1000)
+        self._versions = {}
+        self._snapshots = {}
+
+    def get(self, kind, arg, build):
+        '''Returns the version and the result for `(kind, arg)`.'''
+
+        key = kind, arg
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if None is snapshot:
+                version = self._versions.get(key)
+                if None is version:
+                    version = self._nextversion()
+                    self._versions[key] = version
+        if None is snapshot:
+            # NOTE: the result is built without the lock. It is only kept if
+            # the snapshot was not invalidated in the meantime.
+            snapshot = version, build()
+            with self._lock:
+                if version == self._versions.get(key):
+                    self._snapshots[key] = snapshot
+        return snapshot
+
+    def invalidate(self, *kinds):
+        with self._lock:
+            for key in list(self._versions):
+                if key[0] in kinds:
+                    self._versions[key] = self._nextversion()
+                    self._snapshots.pop(key, None)
+
+    def _nextversion(self):
+        self._counter += 1
+        return self._counter
+
+
+def _snapshot_result(snapshot, version):
+    '''
+    Returns the reply for a listing request: the listing itself when the
+    client did not pass a version, otherwise an object with the current
+    version and, unless it is the client's version, the listing.
+
+    '''
+
+    current, value = snapshot
+    if None is version:
+        result = value
+    elif current == version:
+        result = {'version': current, 'modified': False}
+    else:
+        result = {'version': current, 'modified': True, 'result': value}
+    return result
+
+
+def _matches(subscription, notification, job_id, machine_name):
+    for value, values in (
+            (notification, subscription['notifications']),
+            (job_id, subscription['job_ids']),
+            (machine_name, subscription['machine_names'])):
+        if None is not values and value not in values:
+            result = False
+            break
+    else:
+        result = True
+    return result
+
+
+def _input_file(input_file):
+    '''
+    Splits the `input_file` parameter of `print`, `print_to_file`, and `slice`
+    into a path and an upload id. It is either a path on the conveyor
+    service's filesystem or `{"upload": id}` for a finished upload.
+
+    '''
+
+    if isinstance(input_file, dict):
+        upload_id = input_file.get('upload')
+        if not isinstance(upload_id, (int, long)):
+            raise conveyor.jsonrpc.JsonRpcException(
+                -32602, 'invalid params', None)
+        result = None, upload_id
+    elif isinstance(input_file, basestring):
+        result = input_file, None
+    else:
+        raise conveyor.jsonrpc.JsonRpcException(
+            -32602, 'invalid params', None)
+    return result
+
+
+def _temperature_delta(old, new):
+    '''
+    Returns the largest difference between the readings in two temperature
+    dictionaries or `None` when they do not have the same sensors.
+
+    '''
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        if set(old) != set(new):
+            delta = None
+        else:
+            delta = 0
+            for key in old:
+                d = _temperature_delta(old[key], new[key])
+                if None is d:
+                    delta = None
+                    break
+                else:
+                    delta = max(delta, d)
+    elif (isinstance(old, (int, long, float))
+            and isinstance(new, (int, long, float))):
+        delta = abs(new - old)
+    elif old == new:
+        delta = 0
+    else:
+        delta = None
+    return delta
+
+
 class _Client(conveyor.stoppable.StoppableThread):
     '''
     This is the `Server`'s notion of a client. One `_Client` is allocated for
@@ -504,70 +1061,314 @@ class _Client(conveyor.stoppable.StoppableThread):
 
     '''
 
-    def __init__(self, config, server, jsonrpc):
+    def __init__(self, config, server, jsonrpc, remote, writer):
         conveyor.stoppable.StoppableThread.__init__(self)
         self._config = config
         self._server = server
         self._jsonrpc = jsonrpc
+        self._remote = remote
+        self._writer = writer
         self._log = conveyor.log.getlogger(self)
+        self._subscription_counter = 0
+        self._subscriptions = None # None means every notification
+        self._subscriptions_lock = threading.Lock()
+        self._delta = False
+        self._baselines = {}
+        self._delta_lock = threading.Lock()
 
     def stop(self):
         self._jsonrpc.stop()
 
+    def wants(self, notification, job_id=None, machine_name=None):
+        '''
+        Returns whether or not the client subscribed to a notification about
+        a job and/or machine.
+
+        '''
+
+        # NOTE: the subscriptions are replaced, never modified, so they can be
+        # read without the lock.
+        subscriptions = self._subscriptions
+        if None is subscriptions:
+            result = True
+        else:
+            for subscription in subscriptions.values():
+                if _matches(subscription, notification, job_id, machine_name):
+                    result = True
+                    break
+            else:
+                result = False
+        return result
+
     def run(self):
         def func():
-            conveyor.jsonrpc.install(self._jsonrpc, self)
-            self._server._add_client(self)
+            self.attach()
             try:
                 self._jsonrpc.run()
             finally:
-                self._server._remove_client(self)
+                self.detach()
         conveyor.error.guard(self._log, func)
 
+    def attach(self):
+        conveyor.jsonrpc.install(self._jsonrpc, self)
+        self._server._add_client(self)
+
+    def detach(self):
+        self._server._remove_client(self)
+        self._log.debug('write stats: %r', self._writer.getstats())
+
+    # NOTE: in reactor mode there is no client thread. The reactor calls
+    # `feed`, `feedeof`, and `lost` instead (see `conveyor.reactor.Reactor`).
+
+    def feed(self, data):
+        result = self._jsonrpc.feed(data, False)
+        return result
+
+    def paused(self, resume):
+        result = self._jsonrpc.paused(resume)
+        return result
+
+    def feedeof(self):
+        self._jsonrpc.feedeof()
+
+    def lost(self):
+        try:
+            self.detach()
+        finally:
+            self._jsonrpc.close()
+
+    def _notify_state(self, notification, field, final=False):
+        '''
+        Sends a notification that carries the state of a job or machine. In
+        delta mode only the fields that changed since the last notification
+        about the same job or machine are sent, along with a version number.
+        `field` names the field that identifies the job or machine; it is
+        always sent.
+
+        '''
+
+        method = notification.method
+        params = notification.params
+        key = (method, params[field])
+        with self._delta_lock:
+            if not self._delta:
+                self._jsonrpc.sendnotification(notification, key)
+            else:
+                baseline = self._baselines.get(key)
+                if None is baseline:
+                    version = 1
+                    delta = dict(params)
+                    delta['full'] = True
+                else:
+                    version = baseline[0] + 1
+                    old = baseline[2]
+                    delta = dict(
+                        (k, v) for k, v in params.items()
+                        if k not in old or v != old[k])
+                    delta[field] = params[field]
+                delta['version'] = version
+                if final:
+                    self._baselines.pop(key, None)
+                else:
+                    self._baselines[key] = (version, field, params)
+                # NOTE: deltas must not replace one another in the outbound
+                # queue so they are sent without a key.
+                self._jsonrpc.notify(method, delta)
+
+    def _drop_machine(self, machine_name=None, port_name=None):
+        '''
+        Forgets the delta baselines of a machine that disconnected (by name)
+        or whose port went away (by port name). The next notification about
+        it carries all of its fields again.
+
+        '''
+
+        with self._delta_lock:
+            for key, baseline in list(self._baselines.items()):
+                params = baseline[2]
+                if key[0] in _MACHINE_NOTIFICATIONS and (
+                        (None is not machine_name and machine_name == key[1])
+                        or (None is not port_name
+                            and port_name == params.get('port_name'))):
+                    del self._baselines[key]
+
+    # NOTE: each broadcast encodes its notification once for all of the
+    # clients (see `conveyor.jsonrpc.Notification`).
+
     @staticmethod
     def port_attached(clients, port_info):
-        params = port_info.to_dict()
+        notification = conveyor.jsonrpc.Notification(
+            'port_attached', port_info.to_dict())
         for client in clients:
-            client._jsonrpc.notify('port_attached', params)
+            if client.wants('port_attached'):
+                client._jsonrpc.sendnotification(notification)
 
     @staticmethod
     def port_detached(clients, port_name):
-        params = {'port_name': port_name}
+        notification = conveyor.jsonrpc.Notification(
+            'port_detached', {'port_name': port_name})
         for client in clients:
-            client._jsonrpc.notify('port_detached', params)
+            if client.wants('port_detached'):
+                client._jsonrpc.sendnotification(notification)
+            client._drop_machine(port_name=port_name)
 
     @staticmethod
     def machine_state_changed(clients, machine_info):
-        params = machine_info.to_dict()
+        notification = conveyor.jsonrpc.Notification(
+            'machine_state_changed', machine_info.to_dict())
+        disconnected = (
+            conveyor.machine.MachineState.DISCONNECTED == machine_info.state)
         for client in clients:
-            client._jsonrpc.notify('machine_state_changed', params)
+            if client.wants('machine_state_changed', None, machine_info.name):
+                client._notify_state(notification, 'name')
+            if disconnected:
+                client._drop_machine(machine_info.name)
 
     @staticmethod
     def machine_temperature_changed(clients, machine_info):
-        params = machine_info.to_dict()
+        notification = conveyor.jsonrpc.Notification(
+            'machine_temperature_changed', machine_info.to_dict())
         for client in clients:
-            client._jsonrpc.notify('machine_temperature_changed', params)
+            if client.wants(
+                    'machine_temperature_changed', None, machine_info.name):
+                client._notify_state(notification, 'name')
 
     @staticmethod
     def job_added(clients, job_info):
-        params = job_info.to_dict()
+        notification = conveyor.jsonrpc.Notification(
+            'jobadded', job_info.to_dict())
         for client in clients:
-            client._jsonrpc.notify('jobadded', params)
+            if client.wants('jobadded', job_info.id, job_info.machine_name):
+                client._jsonrpc.sendnotification(notification)
 
     @staticmethod
     def job_changed(clients, job_info):
-        params = job_info.to_dict()
+        notification = conveyor.jsonrpc.Notification(
+            'jobchanged', job_info.to_dict())
+        final = conveyor.task.TaskState.STOPPED == job_info.state
         for client in clients:
-            client._jsonrpc.notify('jobchanged', params)
+            if client.wants('jobchanged', job_info.id, job_info.machine_name):
+                client._notify_state(notification, 'id', final)
 
     @jsonrpc()
-    def hello(self):
+    def hello(self, framing=None, codec=None, compression=None):
         '''
         This is the first method any client must invoke after connecting to the
         conveyor service.
 
+        A client may offer lists of framings, codecs, and compressions. The
+        service selects one of each and the connection switches to them
+        immediately after this response. Codecs and compression are only
+        selected for TCP clients; local clients keep plain JSON.
+
         '''
-        return 'world'
+        if None is framing:
+            result = 'world'
+        else:
+            for value in (framing, codec, compression):
+                if None is not value and not isinstance(value, list):
+                    raise conveyor.jsonrpc.JsonRpcException(
+                        -32602, 'invalid params', None)
+            if not self._remote or None is codec:
+                codec = ()
+            if not self._remote or None is compression:
+                compression = ()
+            result = self._jsonrpc.negotiate(framing, codec, compression)
+            result['hello'] = 'world'
+        return result
+
+    @jsonrpc()
+    def subscribe(self, notifications=None, job_ids=None, machine_names=None):
+        '''
+        Limits the notifications sent to the client. A client receives every
+        notification until it subscribes; after that it receives only the
+        notifications that match one of its subscriptions.
+
+        A subscription matches a notification when the notification is one of
+        `notifications`, is about one of the jobs in `job_ids`, and is about
+        one of the machines in `machine_names`. An omitted list matches
+        everything. Returns a subscription id for `unsubscribe`.
+
+        '''
+
+        for value in (notifications, job_ids, machine_names):
+            if None is not value and not isinstance(value, list):
+                raise conveyor.jsonrpc.JsonRpcException(
+                    -32602, 'invalid params', None)
+        if None is not notifications:
+            for notification in notifications:
+                if notification not in _NOTIFICATIONS:
+                    raise conveyor.jsonrpc.JsonRpcException(
+                        -32602, 'invalid params', notification)
+        subscription = {}
+        for name, value in (
+                ('notifications', notifications), ('job_ids', job_ids),
+                ('machine_names', machine_names)):
+            if None is not value:
+                value = frozenset(value)
+            subscription[name] = value
+        with self._subscriptions_lock:
+            self._subscription_counter += 1
+            id = self._subscription_counter
+            subscriptions = {}
+            if None is not self._subscriptions:
+                subscriptions.update(self._subscriptions)
+            subscriptions[id] = subscription
+            self._subscriptions = subscriptions
+        return id
+
+    @jsonrpc()
+    def unsubscribe(self, id):
+        '''
+        Removes a subscription. A client that removes all of its subscriptions
+        receives no notifications.
+
+        '''
+
+        with self._subscriptions_lock:
+            if None is self._subscriptions or id not in self._subscriptions:
+                raise conveyor.jsonrpc.JsonRpcException(
+                    -32602, 'invalid params', id)
+            subscriptions = dict(self._subscriptions)
+            del subscriptions[id]
+            self._subscriptions = subscriptions
+        return None
+
+    @jsonrpc()
+    def enabledelta(self):
+        '''
+        Switches the jobchanged, machine_state_changed, and
+        machine_temperature_changed notifications to delta mode. The first
+        notification about a job or machine carries all of its fields and
+        `"full": true`; the ones after it carry only the fields that changed.
+        Each one has a version number that goes up by one; a client that sees
+        a gap should call `resync`.
+
+        '''
+
+        with self._delta_lock:
+            self._delta = True
+            self._baselines.clear()
+        return True
+
+    @jsonrpc()
+    def resync(self):
+        '''
+        Sends the full state of every job and machine that the client was
+        notified about (in delta mode).
+
+        '''
+
+        with self._delta_lock:
+            for key, (version, field, params) in self._baselines.items():
+                method = key[0]
+                version += 1
+                self._baselines[key] = (version, field, params)
+                full = dict(params)
+                full['full'] = True
+                full['version'] = version
+                self._jsonrpc.notify(method, full)
+        return None
 
     @jsonrpc()
     def dir(self):
@@ -586,7 +1387,12 @@ class _Client(conveyor.stoppable.StoppableThread):
         return result
 
     @jsonrpc()
-    def getports(self):
+    def getports(self, version=None):
+        snapshot = self._server.get_snapshot('ports', None, self._getports)
+        result = _snapshot_result(snapshot, version)
+        return result
+
+    def _getports(self):
         result = []
         for port in self._server.get_ports():
             dct = port.get_info().to_dict()
@@ -594,7 +1400,13 @@ class _Client(conveyor.stoppable.StoppableThread):
         return result
 
     @jsonrpc()
-    def get_drivers(self):
+    def get_drivers(self, version=None):
+        snapshot = self._server.get_snapshot(
+            'drivers', None, self._get_drivers)
+        result = _snapshot_result(snapshot, version)
+        return result
+
+    def _get_drivers(self):
         result = []
         for driver in self._server.get_drivers():
             dct = driver.get_info().to_dict()
@@ -608,7 +1420,14 @@ class _Client(conveyor.stoppable.StoppableThread):
         return result
 
     @jsonrpc()
-    def get_profiles(self, driver_name):
+    def get_profiles(self, driver_name, version=None):
+        snapshot = self._server.get_snapshot(
+            'profiles', driver_name,
+            lambda: self._get_profiles(driver_name))
+        result = _snapshot_result(snapshot, version)
+        return result
+
+    def _get_profiles(self, driver_name):
         result = []
         for profile in self._server.get_profiles(driver_name):
             dct = profile.get_info().to_dict()
@@ -621,7 +1440,7 @@ class _Client(conveyor.stoppable.StoppableThread):
         result = profile.get_info().to_dict()
         return result
 
-    @jsonrpc()
+    @jsonrpc(concurrency=1)
     def connect(
             self, machine_name, port_name, driver_name, profile_name,
             persistent):
@@ -640,13 +1459,17 @@ class _Client(conveyor.stoppable.StoppableThread):
     def print(
             self, machine_name, input_file, extruder_name,
             gcode_processor_name, has_start_end, material_name, slicer_name,
-            slicer_settings):
+            slicer_settings, priority=0):
+        if not isinstance(priority, (int, long)):
+            raise conveyor.jsonrpc.JsonRpcException(
+                -32602, 'invalid params', None)
         slicer_settings = conveyor.domain.SlicerConfiguration.fromdict(
             slicer_settings)
+        input_file, upload_id = _input_file(input_file)
         job = self._server.print(
             machine_name, input_file, extruder_name,
             gcode_processor_name, has_start_end, material_name, slicer_name,
-            slicer_settings)
+            slicer_settings, upload_id, self, priority)
         dct = job.get_info().to_dict()
         return dct
 
@@ -661,7 +1484,13 @@ class _Client(conveyor.stoppable.StoppableThread):
         return None
 
     @jsonrpc()
-    def getprinters(self):
+    def getprinters(self, version=None):
+        snapshot = self._server.get_snapshot(
+            'printers', None, self._getprinters)
+        result = _snapshot_result(snapshot, version)
+        return result
+
+    def _getprinters(self):
         result = []
         for machine in self._server.get_machines():
             dct = machine.get_info().to_dict()
@@ -694,13 +1523,18 @@ class _Client(conveyor.stoppable.StoppableThread):
     def print_to_file(
             self, driver_name, profile_name, input_file, output_file,
             extruder_name, file_type, gcode_processor_name, has_start_end,
-            material_name, slicer_name, slicer_settings):
+            material_name, slicer_name, slicer_settings, priority=0):
+        if not isinstance(priority, (int, long)):
+            raise conveyor.jsonrpc.JsonRpcException(
+                -32602, 'invalid params', None)
         slicer_settings = conveyor.domain.SlicerConfiguration.fromdict(
             slicer_settings)
+        input_file, upload_id = _input_file(input_file)
         job = self._server.print_to_file(
             driver_name, profile_name, input_file, output_file,
             extruder_name, file_type, gcode_processor_name, has_start_end,
-            material_name, slicer_name, slicer_settings)
+            material_name, slicer_name, slicer_settings, upload_id, self,
+            priority)
         dct = job.get_info().to_dict()
         return dct
 
@@ -708,28 +1542,58 @@ class _Client(conveyor.stoppable.StoppableThread):
     def slice(
             self, driver_name, profile_name, input_file, output_file,
             add_start_end, extruder_name, gcode_processor_name,
-            material_name, slicer_name, slicer_settings):
+            material_name, slicer_name, slicer_settings, priority=0):
+        if not isinstance(priority, (int, long)):
+            raise conveyor.jsonrpc.JsonRpcException(
+                -32602, 'invalid params', None)
         slicer_settings = conveyor.domain.SlicerConfiguration.fromdict(
             slicer_settings)
+        input_file, upload_id = _input_file(input_file)
         job = self._server.slice(
             driver_name, profile_name, input_file, output_file, add_start_end,
             extruder_name, gcode_processor_name, material_name, slicer_name,
-            slicer_settings)
+            slicer_settings, upload_id, self, priority)
         dct = job.get_info().to_dict()
         return dct
 
     @jsonrpc()
-    def getjobs(self):
-        jobs = self._server.get_jobs(self)
-        result = {}
-        for job_id in jobs:
-            result[job_id] = jobs[job_id].get_info().to_dict()
+    def getjobs(
+            self, states=None, types=None, machine_names=None, since=None,
+            offset=None, limit=None):
+        '''
+        Without parameters, returns every job in memory by id. With any
+        parameter, returns a page of the jobs (in memory and archived) that
+        match, the number of jobs that match, and the current sequence number
+        (for a later query with `since`).
+
+        '''
+
+        if (None is states and None is types and None is machine_names
+                and None is since and None is offset and None is limit):
+            jobs = self._server.get_jobs(self)
+            result = {}
+            for job_id in jobs:
+                result[job_id] = jobs[job_id].get_info().to_dict()
+        else:
+            for value in (states, types, machine_names):
+                if None is not value and not isinstance(value, list):
+                    raise conveyor.jsonrpc.JsonRpcException(
+                        -32602, 'invalid params', None)
+            for value in (since, offset, limit):
+                if None is not value and (
+                        not isinstance(value, (int, long)) or 0 > value):
+                    raise conveyor.jsonrpc.JsonRpcException(
+                        -32602, 'invalid params', None)
+            if None is offset:
+                offset = 0
+            sequence, total, jobs = self._server.query_jobs(
+                states, types, machine_names, since, offset, limit)
+            result = {'sequence': sequence, 'total': total, 'jobs': jobs}
         return result
 
     @jsonrpc()
     def getjob(self, id):
-        job = self._server.get_job(id)
-        result = job.to_dict()
+        result = self._server.get_job_info(id)
         return result
 
     @jsonrpc()
@@ -737,6 +1601,159 @@ class _Client(conveyor.stoppable.StoppableThread):
         self._server.cancel_job(id)
         return None
 
+    @jsonrpc()
+    def setjobpriority(self, id, priority):
+        '''
+        Changes the priority of a job. Its work that is waiting for a slot
+        runs before the work of jobs with a lower priority.
+
+        '''
+
+        if (not isinstance(id, (int, long))
+                or not isinstance(priority, (int, long))):
+            raise conveyor.jsonrpc.JsonRpcException(
+                -32602, 'invalid params', None)
+        self._server.set_job_priority(id, priority)
+        return None
+
+    @jsonrpc()
+    def getworkqueue(self):
+        '''
+        Returns the slots of each of the server's work pools ("slicer" and
+        "io") and the work that runs and waits in them. "mine" tells whether
+        the work is for one of this client's jobs.
+
+        '''
+
+        queue = self._server.get_work_queue()
+        for pool in queue.values():
+            for work in pool['running'] + pool['queued']:
+                work['mine'] = self is work.pop('owner')
+        return queue
+
+    @jsonrpc()
+    def beginupload(self, name, size=None, sha256=None):
+        if (not isinstance(name, basestring)
+                or (None is not size and (
+                    not isinstance(size, (int, long)) or 0 > size))
+                or (None is not sha256 and not isinstance(sha256, basestring))):
+            raise conveyor.jsonrpc.JsonRpcException(
+                -32602, 'invalid params', None)
+        upload = self._server.begin_upload(name, size, sha256)
+        result = self._upload_result(upload.to_dict())
+        return result
+
+    @jsonrpc(concurrency=1)
+    def uploadchunk(self, id, offset, data):
+        '''
+        Writes a chunk (base64) of an upload. The chunks of one connection are
+        written one at a time in the order they arrive.
+
+        '''
+
+        if not isinstance(offset, (int, long)) or 0 > offset:
+            raise conveyor.jsonrpc.JsonRpcException(
+                -32602, 'invalid params', None)
+        try:
+            data = base64.b64decode(data)
+        except (TypeError, binascii.Error):
+            raise conveyor.jsonrpc.JsonRpcException(
+                -32602, 'invalid params', None)
+        offset = self._server.write_upload(id, offset, data)
+        result = {'id': id, 'offset': offset}
+        return result
+
+    @jsonrpc()
+    def getupload(self, id):
+        upload = self._server.get_upload(id)
+        result = self._upload_result(upload.to_dict())
+        return result
+
+    @jsonrpc()
+    def finishupload(self, id):
+        result = self._upload_result(self._server.finish_upload(id))
+        return result
+
+    @jsonrpc()
+    def cancelupload(self, id):
+        self._server.cancel_upload(id)
+        return None
+
+    def _upload_result(self, dct):
+        chunk_limit = self._server.get_upload_chunk_limit()
+        dct['chunk_limit'] = chunk_limit
+        dct['window'] = chunk_limit * self._config.get(
+            'server', 'upload_window')
+        return dct
+
+    @jsonrpc()
+    def getworker(self):
+        '''
+        Returns how many models this conveyor service slices at once for
+        other conveyor services ("slots") and how many it is slicing.
+
+        '''
+
+        result = self._server.get_worker_load()
+        return result
+
+    @jsonrpc()
+    def geteventqueue(self):
+        '''
+        Returns the depth and latency (in seconds) of the server's event queue
+        for each event priority and for each job's and machine's lane.
+
+        '''
+
+        result = self._server.get_event_stats()
+        return result
+
+    @jsonrpc()
+    def workerslice(
+            self, id, driver_name, profile_name, add_start_end, slicer_name,
+            slicer_settings, material_name, dualstrusion):
+        '''
+        Slices a finished upload for another conveyor service. The progress is
+        sent to this client in `sliceprogress` notifications and the result
+        is the size and SHA-256 of the G-code, which is read with `readslice`.
+
+        '''
+
+        if not isinstance(id, (int, long)):
+            raise conveyor.jsonrpc.JsonRpcException(
+                -32602, 'invalid params', None)
+        slicer_settings = conveyor.domain.SlicerConfiguration.fromdict(
+            slicer_settings)
+        def progress(upload_id, progress):
+            self._jsonrpc.notify(
+                'sliceprogress', {'id': upload_id, 'progress': progress})
+        task = self._server.worker_slice(
+            id, driver_name, profile_name, add_start_end, slicer_name,
+            slicer_settings, material_name, dualstrusion, progress)
+        return task
+
+    @jsonrpc()
+    def readslice(self, id, offset, length):
+        '''Returns a chunk (base64) of the G-code of a `workerslice`.'''
+
+        for value in (id, offset, length):
+            if not isinstance(value, (int, long)) or 0 > value:
+                raise conveyor.jsonrpc.JsonRpcException(
+                    -32602, 'invalid params', None)
+        data = self._server.read_slice(id, offset, length)
+        result = base64.b64encode(data)
+        return result
+
+    @jsonrpc()
+    def cancelslice(self, id):
+        self._server.cancel_slice(id)
+        return None
+
+    @jsonrpc()
+    def releaseslice(self, id):
+        self._server.release_slice(id)
+        return None
+
     @jsonrpc()
     def getuploadablemachines(self, driver_name):
         task = self._server.get_uploadable_machines(driver_name)
@@ -800,3 +1817,285 @@ class ConnectionManager(object):
 
     def job_changed(self, job):
         pass
+
+
+class _CoalescerTestCase(unittest.TestCase):
+    def _wait(self, condition, sent, count):
+        with condition:
+            deadline = time.time() + 5.0
+            while len(sent) < count and time.time() < deadline:
+                condition.wait(deadline - time.time())
+
+    def test_post(self):
+        '''Test that notifications for a key collapse into the latest one.'''
+
+        coalescer = _Coalescer.create(0.1)
+        condition = threading.Condition()
+        sent = []
+        def func(key, value):
+            with condition:
+                sent.append((key, value))
+                condition.notify_all()
+        for i in range(10):
+            coalescer.post('a', lambda i=i: func('a', i))
+            coalescer.post('b', lambda i=i: func('b', i))
+        self.assertEqual([('a', 0), ('b', 0)], sent)
+        self._wait(condition, sent, 4)
+        coalescer.stop()
+        self.assertEqual(
+            [('a', 0), ('a', 9), ('b', 0), ('b', 9)], sorted(sent))
+
+    def test_post_final(self):
+        '''Test that a final notification is sent right away.'''
+
+        coalescer = _Coalescer.create(60.0)
+        sent = []
+        coalescer.post('a', lambda: sent.append(1))
+        coalescer.post('a', lambda: sent.append(2))
+        coalescer.post('a', lambda: sent.append(3), True)
+        coalescer.post('a', lambda: sent.append(4))
+        coalescer.stop()
+        self.assertEqual([1, 3, 4], sent)
+
+    def test__temperature_delta(self):
+        old = {'tools': {0: 200, 1: 210}, 'heated_platforms': {0: 100}}
+        new = {'tools': {0: 201.5, 1: 209}, 'heated_platforms': {0: 100}}
+        self.assertEqual(1.5, _temperature_delta(old, new))
+        self.assertEqual(0, _temperature_delta(old, old))
+        self.assertIsNone(_temperature_delta(None, new))
+        self.assertIsNone(_temperature_delta(old, {'tools': {0: 200}}))
+
+
+class _SnapshotsTestCase(unittest.TestCase):
+    def test_get(self):
+        '''Test that a snapshot is built once until it is invalidated.'''
+
+        snapshots = _Snapshots()
+        builds = []
+        def build():
+            builds.append(1)
+            return [len(builds)]
+        version1, value = snapshots.get('printers', None, build)
+        self.assertEqual([1], value)
+        self.assertEqual(
+            (version1, [1]), snapshots.get('printers', None, build))
+        snapshots.invalidate('ports')
+        self.assertEqual(
+            (version1, [1]), snapshots.get('printers', None, build))
+        snapshots.invalidate('ports', 'printers')
+        version2, value = snapshots.get('printers', None, build)
+        self.assertNotEqual(version1, version2)
+        self.assertEqual([2], value)
+
+    def test_get_invalidated(self):
+        '''Test that a snapshot invalidated while it is built is not kept.'''
+
+        snapshots = _Snapshots()
+        def build():
+            snapshots.invalidate('profiles')
+            return []
+        version1, value = snapshots.get('profiles', 's3g', build)
+        version2, value = snapshots.get('profiles', 's3g', lambda: [1])
+        self.assertNotEqual(version1, version2)
+        self.assertEqual([1], value)
+
+    def test__snapshot_result(self):
+        self.assertEqual([1], _snapshot_result((5, [1]), None))
+        self.assertEqual(
+            {'version': 5, 'modified': False},
+            _snapshot_result((5, [1]), 5))
+        self.assertEqual(
+            {'version': 5, 'modified': True, 'result': [1]},
+            _snapshot_result((5, [1]), 0))
+
+
+class _SubscriptionTestCase(unittest.TestCase):
+    def test_wants(self):
+        '''Test that a client only wants what it subscribed to.'''
+
+        client = _Client(None, None, None, False, None)
+        self.assertTrue(client.wants('port_attached'))
+        id1 = client.subscribe(['jobchanged'], [1, 2])
+        id2 = client.subscribe(None, None, ['replicator'])
+        self.assertFalse(client.wants('port_attached'))
+        self.assertTrue(client.wants('jobchanged', 1, None))
+        self.assertFalse(client.wants('jobchanged', 3, None))
+        self.assertFalse(client.wants('jobadded', 1, None))
+        self.assertTrue(client.wants('jobadded', 3, 'replicator'))
+        self.assertTrue(
+            client.wants('machine_state_changed', None, 'replicator'))
+        client.unsubscribe(id2)
+        self.assertFalse(client.wants('jobadded', 3, 'replicator'))
+        client.unsubscribe(id1)
+        self.assertFalse(client.wants('jobchanged', 1, None))
+
+    def test_subscribe_JsonRpcException(self):
+        client = _Client(None, None, None, False, None)
+        with self.assertRaises(conveyor.jsonrpc.JsonRpcException):
+            client.subscribe(['nothing'])
+        with self.assertRaises(conveyor.jsonrpc.JsonRpcException):
+            client.subscribe('jobchanged')
+        with self.assertRaises(conveyor.jsonrpc.JsonRpcException):
+            client.unsubscribe(1)
+
+
+class _BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        import conveyor.config
+        self._config = conveyor.config.Config(
+            'test', conveyor.config.convert('test', {}))
+
+    def test_default(self):
+        '''
+        Test that with the default configuration a batch runs in order on the
+        client's thread and is answered with one array.
+
+        '''
+
+        import json
+        executor = _create_executor(self._config, False)
+        self.assertIsNone(executor)
+        responses = []
+        class Writer(object):
+            def write(self, data, key=None):
+                responses.append(json.loads(data))
+            def flush(self):
+                pass
+        jsonrpc = conveyor.jsonrpc.JsonRpc(None, Writer(), executor)
+        calls = []
+        def echo(value):
+            calls.append((value, threading.current_thread()))
+            return value
+        jsonrpc.addmethod('echo', echo)
+        batch = [
+            {'jsonrpc': '2.0', 'method': 'echo', 'params': [i], 'id': i}
+            for i in range(3)]
+        jsonrpc._jsonreadercallback(json.dumps(batch))
+        self.assertEqual(
+            [[{'jsonrpc': '2.0', 'result': i, 'id': i} for i in range(3)]],
+            responses)
+        self.assertEqual(
+            [(i, threading.current_thread()) for i in range(3)], calls)
+
+    def test_reactor(self):
+        '''Test that reactor mode always has dispatch threads.'''
+
+        executor = _create_executor(self._config, True)
+        try:
+            self.assertEqual(_REACTOR_DISPATCH_THREADS, len(executor._threads))
+        finally:
+            executor.stop()
+
+
+class _LaneTestCase(unittest.TestCase):
+    class _PortManager(object):
+        def __init__(self):
+            self.port_attached = conveyor.event.Event('port_attached')
+            self.port_detached = conveyor.event.Event('port_detached')
+
+    def test_thing(self):
+        '''Test that the tasks of a thing job are created on its lane.'''
+
+        import conveyor.config
+        import conveyor.domain
+        import conveyor.embed
+        import shutil
+        import stat
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        input_file = os.path.join(directory, 'bunny.thing')
+        with open(input_file, 'w') as fp:
+            fp.write('G1 X0 Y0 Z0\n')
+        # NOTE: a stand-in for unified_mesh_hack that extracts one mesh.
+        exe = os.path.join(directory, 'unified_mesh_hack')
+        with open(exe, 'w') as fp:
+            fp.write('#!/bin/sh\ncp "$1" "$2/UNIFIED_MESH_HACK_0.stl"\n')
+        os.chmod(exe, stat.S_IRWXU)
+        config = conveyor.config.Config('test', conveyor.config.convert(
+            'test', {'server': {'unified_mesh_hack_exe': exe}}))
+        server = Server(
+            config, conveyor.embed._DriverManager(), self._PortManager(),
+            None, None, None, None)
+        self.addCleanup(conveyor.event.geteventqueue()._clear)
+        self.addCleanup(server._uploads.close)
+        self.addCleanup(server.stop)
+        slicer_settings = conveyor.domain.SlicerConfiguration(
+            conveyor.slicer.Slicer.MIRACLEGRUE, '0', False, False, 0.1, 0.27,
+            2, 230, 110, 80, 100)
+        job = server.slice(
+            's3g', 'Replicator2', input_file,
+            os.path.join(directory, 'bunny.gcode'), True, '0', None, 'PLA',
+            conveyor.slicer.Slicer.MIRACLEGRUE, slicer_settings)
+        self.assertIs(
+            conveyor.event.getlane(('job', job.id)), job.task._eventqueue)
+
+
+class _DeltaTestCase(unittest.TestCase):
+    class _JsonRpc(object):
+        def __init__(self):
+            self.notifications = []
+
+        def notify(self, method, params, key=None):
+            self.notifications.append((method, params))
+
+        def sendnotification(self, notification, key=None):
+            self.notify(notification.method, notification.params, key)
+
+    @staticmethod
+    def _notification(params):
+        notification = conveyor.jsonrpc.Notification('jobchanged', params)
+        return notification
+
+    def test__notify_state(self):
+        '''Test that only the changed fields are sent in delta mode.'''
+
+        jsonrpc = _DeltaTestCase._JsonRpc()
+        client = _Client(None, None, jsonrpc, False, None)
+        job = {'id': 1, 'state': 'RUNNING', 'progress': 10, 'name': 'a'}
+        client._notify_state(self._notification(job), 'id')
+        self.assertEqual(('jobchanged', job), jsonrpc.notifications[-1])
+        self.assertTrue(client.enabledelta())
+        client._notify_state(self._notification(job), 'id')
+        full = dict(job, full=True, version=1)
+        self.assertEqual(('jobchanged', full), jsonrpc.notifications[-1])
+        client._notify_state(self._notification(dict(job, progress=20)), 'id')
+        self.assertEqual(
+            ('jobchanged', {'id': 1, 'progress': 20, 'version': 2}),
+            jsonrpc.notifications[-1])
+        client.resync()
+        full = dict(job, progress=20, full=True, version=3)
+        self.assertEqual(('jobchanged', full), jsonrpc.notifications[-1])
+        stopped = dict(job, progress=20, state='STOPPED')
+        client._notify_state(self._notification(stopped), 'id', True)
+        self.assertEqual(
+            ('jobchanged', {'id': 1, 'state': 'STOPPED', 'version': 4}),
+            jsonrpc.notifications[-1])
+        count = len(jsonrpc.notifications)
+        client.resync()
+        self.assertEqual(count, len(jsonrpc.notifications))
+
+    def test__drop_machine(self):
+        '''Test that a machine's baselines go when it does.'''
+
+        jsonrpc = _DeltaTestCase._JsonRpc()
+        client = _Client(None, None, jsonrpc, False, None)
+        client.enabledelta()
+        def machine(name, port_name, state):
+            info = conveyor.machine.MachineInfo(
+                name, port_name, 'driver', 'profile', state)
+            return info
+        idle = conveyor.machine.MachineState.IDLE
+        _Client.machine_state_changed([client], machine('a', 'p1', idle))
+        _Client.machine_temperature_changed([client], machine('a', 'p1', idle))
+        _Client.machine_state_changed([client], machine('b', 'p2', idle))
+        self.assertEqual(3, len(client._baselines))
+        _Client.port_detached([client], 'p1')
+        self.assertEqual(
+            [('machine_state_changed', 'b')], list(client._baselines))
+        _Client.machine_state_changed(
+            [client], machine(
+                'b', 'p2', conveyor.machine.MachineState.DISCONNECTED))
+        self.assertEqual({}, client._baselines)
+        _Client.machine_state_changed([client], machine('a', 'p1', idle))
+        self.assertTrue(jsonrpc.notifications[-1][1]['full'])
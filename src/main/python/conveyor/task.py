@@ -19,6 +19,8 @@
 
 from __future__ import (absolute_import, print_function, unicode_literals)
 
+import threading
+
 try:
     import unittest2 as unittest
 except ImportError:
@@ -48,10 +50,37 @@ class IllegalTransitionException(Exception):
         self.event = event
 
 
+# NOTE: a task's events are created when something first looks them up (i.e.,
+# to attach a handler) and a transition does not fire an event that was never
+# created. Most of the tasks in a job's recipe are only watched by the process
+# that runs them.
+_eventlock = threading.Lock()
+
+def _taskevent(slot, name, priority, coalesce=False):
+    def fget(self):
+        event = getattr(self, slot)
+        if None is event:
+            with _eventlock:
+                event = getattr(self, slot)
+                if None is event:
+                    event = conveyor.event.Event(
+                        name, self._lane(), priority, coalesce)
+                    setattr(self, slot, event)
+        return event
+    return property(fget)
+
+
 class Task(object):
     """ Class for managing an ongoing task, including starting, stopping, 
         hearbeat (updates) and related tools.       
     """
+
+    __slots__ = (
+        'state', 'conclusion', 'name', 'data', 'progress', 'result',
+        'failure', '_eventqueue', '_startevent', '_heartbeatevent',
+        '_endevent', '_failevent', '_cancelevent', '_runningevent',
+        '_stoppedevent')
+
     def __init__(self, eventqueue=None):
         self.state = TaskState.PENDING
         self.conclusion = None
@@ -62,55 +91,86 @@ class Task(object):
         self.result = None   # data from 'end'
         self.failure = None  # data from 'fail'
 
-        # Event events (edge-ish events)
-        self.startevent = conveyor.event.Event('Task.startevent', eventqueue)
-        self.heartbeatevent = conveyor.event.Event(
-            'Task.heartbeatevent', eventqueue)
-        self.endevent = conveyor.event.Event('Task.endevent', eventqueue)
-        self.failevent = conveyor.event.Event('Task.failevent', eventqueue)
-        self.cancelevent = conveyor.event.Event('Task.cancelevent', eventqueue)
+        self._eventqueue = eventqueue
+        self._startevent = None
+        self._heartbeatevent = None
+        self._endevent = None
+        self._failevent = None
+        self._cancelevent = None
+        self._runningevent = None
+        self._stoppedevent = None
 
-        # State events (level-ish events)
-        self.runningevent = conveyor.event.Event(
-            'Task.runningevent', eventqueue)
-        self.stoppedevent = conveyor.event.Event(
-            'Task.stoppedevent', eventqueue)
+    # Event events (edge-ish events)
+    startevent = _taskevent(
+        '_startevent', 'Task.startevent',
+        conveyor.event.EventPriority.CONTROL)
+    # NOTE: a heartbeat that is still waiting covers the ones after it since
+    # its handlers read the latest progress.
+    heartbeatevent = _taskevent(
+        '_heartbeatevent', 'Task.heartbeatevent',
+        conveyor.event.EventPriority.TELEMETRY, coalesce=True)
+    endevent = _taskevent(
+        '_endevent', 'Task.endevent', conveyor.event.EventPriority.CONTROL)
+    failevent = _taskevent(
+        '_failevent', 'Task.failevent', conveyor.event.EventPriority.CONTROL)
+    cancelevent = _taskevent(
+        '_cancelevent', 'Task.cancelevent',
+        conveyor.event.EventPriority.CONTROL)
 
+    # State events (level-ish events)
+    runningevent = _taskevent(
+        '_runningevent', 'Task.runningevent',
+        conveyor.event.EventPriority.CONTROL)
+    stoppedevent = _taskevent(
+        '_stoppedevent', 'Task.stoppedevent',
+        conveyor.event.EventPriority.CONTROL)
+
+    def _lane(self):
+        # NOTE: a task's events have different priorities, so a task that
+        # does not share a lane (see `conveyor.event.Lane`) gets one of its
+        # own to keep them in order.
+        if not isinstance(self._eventqueue, conveyor.event.Lane):
+            self._eventqueue = conveyor.event.Lane('Task', self._eventqueue)
+        return self._eventqueue
+
+    def _fire(self, event):
+        if None is not event:
+            event(self)
 
     def _transition(self, event, data):
         if TaskState.PENDING == self.state:
             if TaskEvent.START == event:
                 self.state = TaskState.RUNNING
-                self.startevent(self)
-                self.runningevent(self)
+                self._fire(self._startevent)
+                self._fire(self._runningevent)
             elif TaskEvent.CANCEL == event:
                 self.state = TaskState.STOPPED
                 self.conclusion = TaskConclusion.CANCELED
-                self.cancelevent(self)
-                self.stoppedevent(self)
+                self._fire(self._cancelevent)
+                self._fire(self._stoppedevent)
             else:
                 raise IllegalTransitionException(self.state, event)
         elif TaskState.RUNNING == self.state:
             if TaskEvent.HEARTBEAT == event:
                 self.progress = data
-                self.heartbeatevent(self)
+                self._fire(self._heartbeatevent)
             elif TaskEvent.END == event:
                 self.state = TaskState.STOPPED
                 self.conclusion = TaskConclusion.ENDED
                 self.result = data
-                self.endevent(self)
-                self.stoppedevent(self)
+                self._fire(self._endevent)
+                self._fire(self._stoppedevent)
             elif TaskEvent.FAIL == event:
                 self.state = TaskState.STOPPED
                 self.conclusion = TaskConclusion.FAILED
                 self.failure = data
-                self.failevent(self)
-                self.stoppedevent(self)
+                self._fire(self._failevent)
+                self._fire(self._stoppedevent)
             elif TaskEvent.CANCEL == event:
                 self.state = TaskState.STOPPED
                 self.conclusion = TaskConclusion.CANCELED
-                self.cancelevent(self)
-                self.stoppedevent(self)
+                self._fire(self._cancelevent)
+                self._fire(self._stoppedevent)
             else:
                 raise IllegalTransitionException(self.state, event)
         elif TaskState.STOPPED == self.state:
@@ -175,3 +235,43 @@ class Task(object):
         return canceled
 
 
+
+class _TaskTestCase(unittest.TestCase):
+    def test_events(self):
+        '''Test that a task's events are delivered in order.'''
+
+        eventqueue = conveyor.event.EventQueue()
+        task = Task(eventqueue)
+        delivered = []
+        for name in ('startevent', 'runningevent', 'heartbeatevent',
+                'endevent', 'stoppedevent'):
+            getattr(task, name).attach(
+                lambda task, name=name: delivered.append(name))
+        task.start()
+        task.heartbeat({'name': 'task', 'progress': 50})
+        task.end(None)
+        while eventqueue.runiteration(False):
+            pass
+        self.assertEqual(
+            ['startevent', 'runningevent', 'heartbeatevent', 'endevent',
+                'stoppedevent'],
+            delivered)
+
+    def test_lazy(self):
+        '''Test that a task only creates the events that are looked up.'''
+
+        eventqueue = conveyor.event.EventQueue()
+        task = Task(eventqueue)
+        callback = conveyor.event.Callback()
+        task.stoppedevent.attach(callback)
+        task.start()
+        for i in range(10):
+            task.heartbeat({'name': 'task', 'progress': i})
+        task.end(None)
+        self.assertIsNone(task._heartbeatevent)
+        self.assertIsNone(task._endevent)
+        self.assertIs(task._stoppedevent, task.stoppedevent)
+        self.assertTrue(eventqueue.runiteration(False))
+        self.assertFalse(eventqueue.runiteration(False))
+        self.assertTrue(callback.delivered)
+        self.assertEqual((task,), callback.args)
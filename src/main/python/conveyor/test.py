@@ -27,6 +27,8 @@ try:
 except ImportError:
     import unittest
 
+import conveyor.log
+
 class ListHandler(logging.Handler):
     list = []
 
@@ -63,6 +65,7 @@ def listlogging(level):
         'disable_existing_loggers': False
     }
     logging.config.dictConfig(dct)
+    conveyor.log.resetlevels()
 
 class _ListHandlerTestCase(unittest.TestCase):
     def setUp(self):
@@ -0,0 +1,370 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/main/python/conveyor/upload.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Files that clients upload to the conveyor service.
+
+A client begins an upload, sends the file in chunks, and finishes the upload.
+Each chunk names the offset where it goes and the chunks must arrive in
+order; a chunk for any other offset is rejected with the offset the upload
+expects next. That is also how an interrupted upload is resumed (possibly
+over another connection): the client asks for the upload's offset and sends
+the rest of the file from there.
+
+The chunks are written straight into a scratch directory while a SHA-256 of
+the content is computed. Finishing an upload checks the size and hash the
+client declared. A job then claims the finished upload instead of naming a
+file on the service's filesystem, and the file is removed when the job stops.
+Uploads that are idle for too long are removed too.
+
+'''
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import hashlib
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+
+import conveyor.error
+import conveyor.log
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+class UploadState(object):
+    RECEIVING = 'RECEIVING'
+    FINISHED = 'FINISHED'
+    CLAIMED = 'CLAIMED'
+
+
+class Upload(object):
+    def __init__(self, id, name, path, size, sha256):
+        self.id = id
+        self.name = name
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.state = UploadState.RECEIVING
+        self.offset = 0
+        self.touched = time.time()
+        self.lock = threading.Lock()
+        self._hash = hashlib.sha256()
+        self._fp = open(path, 'wb')
+
+    def write(self, data):
+        self._fp.write(data)
+        self._hash.update(data)
+        self.offset += len(data)
+
+    def close(self):
+        if not self._fp.closed:
+            self._fp.close()
+
+    def hexdigest(self):
+        result = self._hash.hexdigest()
+        return result
+
+    def to_dict(self):
+        dct = {
+            'id': self.id,
+            'name': self.name,
+            'state': self.state,
+            'offset': self.offset,
+            'size': self.size,
+        }
+        if UploadState.RECEIVING != self.state:
+            dct['sha256'] = self.hexdigest()
+        return dct
+
+
+class UploadManager(object):
+    @classmethod
+    def create(cls, directory, limit, chunk_limit, timeout):
+        '''
+        @param directory the scratch directory; by default a new temporary
+            directory that is removed by `close`
+        @param limit the maximum number of bytes in an upload
+        @param chunk_limit the maximum number of bytes in a chunk
+        @param timeout the number of seconds after which an idle upload (that
+            no job has claimed) is removed
+        '''
+        if '' == directory:
+            directory = tempfile.mkdtemp(prefix='conveyor-upload-')
+            owned = True
+        else:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            owned = False
+        manager = cls(directory, owned, limit, chunk_limit, timeout)
+        return manager
+
+    def __init__(self, directory, owned, limit, chunk_limit, timeout):
+        self._directory = directory
+        self._owned = owned
+        self._limit = limit
+        self.chunk_limit = chunk_limit
+        self._timeout = timeout
+        self._log = conveyor.log.getlogger(self)
+        self._lock = threading.Lock()
+        self._uploads = {}
+        self._upload_id_counter = 0
+
+    def close(self):
+        with self._lock:
+            uploads = list(self._uploads.values())
+            self._uploads.clear()
+        for upload in uploads:
+            self._remove(upload)
+        if self._owned:
+            shutil.rmtree(self._directory, True)
+
+    def begin(self, name, size=None, sha256=None):
+        '''Starts a new upload of a file called `name` and returns it.'''
+
+        if None is not size and self._limit < size:
+            raise conveyor.error.UploadLimitException(None, self._limit)
+        self.expire()
+        basename = os.path.basename(name)
+        if '' == basename:
+            basename = 'upload'
+        with self._lock:
+            self._upload_id_counter += 1
+            upload_id = self._upload_id_counter
+        directory = os.path.join(self._directory, unicode(upload_id))
+        os.mkdir(directory)
+        path = os.path.join(directory, basename)
+        upload = Upload(upload_id, basename, path, size, sha256)
+        with self._lock:
+            self._uploads[upload_id] = upload
+        self._log.info('upload %d started: %s', upload_id, basename)
+        return upload
+
+    def get(self, upload_id):
+        with self._lock:
+            upload = self._uploads.get(upload_id)
+        if None is upload:
+            raise conveyor.error.UnknownUploadError(upload_id)
+        return upload
+
+    def write(self, upload_id, offset, data):
+        '''
+        Writes a chunk at `offset` and returns the offset of the next chunk.
+        Raises an `UploadOffsetException` with the expected offset when
+        `offset` is not where the last chunk ended.
+
+        '''
+
+        if self.chunk_limit < len(data):
+            raise conveyor.error.UploadLimitException(
+                upload_id, self.chunk_limit)
+        upload = self.get(upload_id)
+        with upload.lock:
+            self._check_state(upload, UploadState.RECEIVING)
+            if upload.offset != offset:
+                raise conveyor.error.UploadOffsetException(
+                    upload_id, offset, upload.offset)
+            if self._limit < upload.offset + len(data):
+                raise conveyor.error.UploadLimitException(
+                    upload_id, self._limit)
+            upload.write(data)
+            upload.touched = time.time()
+            result = upload.offset
+        return result
+
+    def finish(self, upload_id):
+        '''
+        Closes an upload's file once the last chunk is written and checks its
+        size and hash. An upload that fails the check is removed.
+
+        '''
+
+        upload = self.get(upload_id)
+        mismatch = False
+        with upload.lock:
+            if UploadState.RECEIVING == upload.state:
+                upload.close()
+                sha256 = upload.hexdigest()
+                if ((None is not upload.size and upload.size != upload.offset)
+                        or (None is not upload.sha256
+                            and upload.sha256.lower() != sha256)):
+                    mismatch = True
+                else:
+                    upload.state = UploadState.FINISHED
+                    upload.touched = time.time()
+                    self._log.info(
+                        'upload %d finished: %d bytes, sha256 %s', upload_id,
+                        upload.offset, sha256)
+            dct = upload.to_dict()
+        if mismatch:
+            self.release(upload_id)
+            raise conveyor.error.UploadMismatchException(
+                upload_id, upload.offset, sha256)
+        return dct
+
+    def cancel(self, upload_id):
+        with self._lock:
+            upload = self._uploads.pop(upload_id, None)
+        if None is upload:
+            raise conveyor.error.UnknownUploadError(upload_id)
+        self._remove(upload)
+
+    def claim(self, upload_id):
+        '''
+        Hands a finished upload to a job and returns the path of its file. The
+        job must `release` it when it stops (or `unclaim` it if it never
+        starts).
+
+        '''
+
+        upload = self.get(upload_id)
+        with upload.lock:
+            self._check_state(upload, UploadState.FINISHED)
+            upload.state = UploadState.CLAIMED
+        return upload.path
+
+    def unclaim(self, upload_id):
+        upload = self.get(upload_id)
+        with upload.lock:
+            upload.state = UploadState.FINISHED
+            upload.touched = time.time()
+
+    def release(self, upload_id):
+        '''Removes an upload once the job that claimed it stops.'''
+
+        with self._lock:
+            upload = self._uploads.pop(upload_id, None)
+        if None is not upload:
+            self._remove(upload)
+
+    def expire(self, now=None):
+        '''Removes the uploads that are idle for longer than the timeout.'''
+
+        if None is now:
+            now = time.time()
+        expired = []
+        with self._lock:
+            for upload_id, upload in list(self._uploads.items()):
+                if (UploadState.CLAIMED != upload.state
+                        and self._timeout < now - upload.touched):
+                    expired.append(self._uploads.pop(upload_id))
+        for upload in expired:
+            self._log.info('upload %d expired', upload.id)
+            self._remove(upload)
+
+    def _check_state(self, upload, state):
+        if state != upload.state:
+            raise conveyor.error.UploadStateException(upload.id, upload.state)
+
+    def _remove(self, upload):
+        with upload.lock:
+            upload.close()
+        shutil.rmtree(os.path.dirname(upload.path), True)
+
+
+class _UploadManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        self._manager = UploadManager.create('', 1024, 16, 60.0)
+
+    def tearDown(self):
+        directory = self._manager._directory
+        self._manager.close()
+        self.assertFalse(os.path.exists(directory))
+
+    def _upload(self, data, chunk_size):
+        upload = self._manager.begin(
+            '/some/where/bunny.stl', len(data),
+            hashlib.sha256(data).hexdigest())
+        for offset in range(0, len(data), chunk_size):
+            self._manager.write(
+                upload.id, offset, data[offset:offset + chunk_size])
+        return upload
+
+    def test_finish(self):
+        '''Test that an upload's file has the content of its chunks.'''
+
+        data = b'solid bunny\n' * 10
+        upload = self._upload(data, 16)
+        self.assertEqual('bunny.stl', os.path.basename(upload.path))
+        dct = self._manager.finish(upload.id)
+        self.assertEqual(UploadState.FINISHED, dct['state'])
+        self.assertEqual(len(data), dct['offset'])
+        self.assertEqual(hashlib.sha256(data).hexdigest(), dct['sha256'])
+        path = self._manager.claim(upload.id)
+        with open(path, 'rb') as fp:
+            self.assertEqual(data, fp.read())
+        with self.assertRaises(conveyor.error.UploadStateException):
+            self._manager.claim(upload.id)
+        self._manager.release(upload.id)
+        self.assertFalse(os.path.exists(path))
+        with self.assertRaises(conveyor.error.UnknownUploadError):
+            self._manager.get(upload.id)
+
+    def test_write_UploadOffsetException(self):
+        '''Test that a chunk out of order reports where to resume.'''
+
+        upload = self._manager.begin('bunny.stl')
+        self.assertEqual(8, self._manager.write(upload.id, 0, b'x' * 8))
+        with self.assertRaises(conveyor.error.UploadOffsetException) as cm:
+            self._manager.write(upload.id, 16, b'x' * 8)
+        self.assertEqual(8, cm.exception.expected)
+        self.assertEqual(16, self._manager.write(upload.id, 8, b'x' * 8))
+
+    def test_write_UploadLimitException(self):
+        '''Test that the chunk and upload limits are enforced.'''
+
+        with self.assertRaises(conveyor.error.UploadLimitException):
+            self._manager.begin('bunny.stl', 1025)
+        upload = self._manager.begin('bunny.stl')
+        with self.assertRaises(conveyor.error.UploadLimitException):
+            self._manager.write(upload.id, 0, b'x' * 17)
+        for offset in range(0, 1024, 16):
+            self._manager.write(upload.id, offset, b'x' * 16)
+        with self.assertRaises(conveyor.error.UploadLimitException):
+            self._manager.write(upload.id, 1024, b'x')
+
+    def test_finish_UploadMismatchException(self):
+        '''Test that an upload with the wrong content is removed.'''
+
+        upload = self._manager.begin('bunny.stl', 4, '0' * 64)
+        self._manager.write(upload.id, 0, b'abcd')
+        with self.assertRaises(conveyor.error.UploadMismatchException):
+            self._manager.finish(upload.id)
+        self.assertFalse(os.path.exists(upload.path))
+        with self.assertRaises(conveyor.error.UnknownUploadError):
+            self._manager.get(upload.id)
+
+    def test_expire(self):
+        '''Test that idle uploads are removed unless a job claimed them.'''
+
+        upload1 = self._upload(b'abcd', 4)
+        upload2 = self._upload(b'efgh', 4)
+        self._manager.finish(upload2.id)
+        self._manager.claim(upload2.id)
+        self._manager.expire(time.time() + 61.0)
+        with self.assertRaises(conveyor.error.UnknownUploadError):
+            self._manager.get(upload1.id)
+        self.assertFalse(os.path.exists(upload1.path))
+        self.assertTrue(os.path.exists(upload2.path))
@@ -0,0 +1,730 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/main/python/conveyor/worker.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Slicing on other conveyor services (slicing workers).
+
+A conveyor service with `server.worker_slots` greater than 0 is a slicing
+worker: it runs that many slicers at once for other conveyor services
+(`SliceWorker`). A conveyor service with `server.slicer_workers` hands the
+slicer stage of its recipes to those workers (`WorkerPool`):
+
+  1. the model is uploaded to the worker (see `conveyor.upload`),
+  2. `workerslice` slices the upload; the worker reports the slicer's
+     progress with `sliceprogress` notifications,
+  3. the G-code is read back in chunks with `readslice`, and
+  4. `releaseslice` removes the upload and the G-code from the worker.
+
+Each slice goes to the connected worker with the lowest share of its slots in
+use; a worker without a free slot is passed over. When there is no such
+worker, or the worker goes away before the G-code is back, the slicer runs
+locally instead.
+
+'''
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import base64
+import collections
+import hashlib
+import os.path
+import threading
+import time
+
+import conveyor.client.session
+import conveyor.error
+import conveyor.executor
+import conveyor.log
+import conveyor.recipe
+import conveyor.stoppable
+import conveyor.task
+import conveyor.util
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+
+# The number of `readslice` requests that may wait for a reply.
+_READ_WINDOW = 4
+
+
+class _Slice(object):
+    def __init__(self, id, path, task):
+        self.id = id
+        self.path = path
+        self.task = task
+        self.size = None
+        self.sha256 = None
+        self.finished = None
+
+
+class SliceWorker(conveyor.stoppable.StoppableInterface):
+    '''
+    Slices the uploaded models of other conveyor services. A slice is named
+    after its upload and its G-code is written next to the model, so both are
+    removed along with the upload.
+
+    '''
+
+    @classmethod
+    def create(cls, config, driver_manager, uploads):
+        worker = cls(
+            config, driver_manager, uploads,
+            config.get('server', 'worker_slots'),
+            config.get('server', 'upload_timeout'))
+        return worker
+
+    def __init__(
+            self, config, driver_manager, uploads, slots, timeout,
+            create_slicer=None):
+        '''
+        @param uploads the `conveyor.upload.UploadManager` that receives the
+            models
+        @param slots the number of slicers that run at once
+        @param timeout the number of seconds after which G-code that is never
+            read back is removed
+        @param create_slicer a function of a `conveyor.recipe.SliceRequest`
+            and a task that returns the slicer; by default the slicer named
+            in the request
+        '''
+        conveyor.stoppable.StoppableInterface.__init__(self)
+        self._config = config
+        self._driver_manager = driver_manager
+        self._uploads = uploads
+        self._slots = slots
+        self._timeout = timeout
+        if None is create_slicer:
+            create_slicer = lambda request, task: request.create_slicer(
+                self._config, task)
+        self._create_slicer = create_slicer
+        self._log = conveyor.log.getlogger(self)
+        self._lock = threading.Lock()
+        self._slices = {}
+        self._active = 0
+        if 0 == slots:
+            self._executor = None
+        else:
+            # NOTE: work is only submitted from event callbacks, which must
+            # not block, so the queue is unbounded.
+            self._executor = conveyor.executor.Executor.create(
+                slots, slots, 'slice_worker')
+
+    def stop(self):
+        if None is not self._executor:
+            self._executor.stop()
+        with self._lock:
+            slices = list(self._slices.values())
+            self._slices.clear()
+        for slice_ in slices:
+            self._uploads.release(slice_.id)
+
+    def get_load(self):
+        with self._lock:
+            load = {'slots': self._slots, 'active': self._active}
+        return load
+
+    def slice(
+            self, upload_id, driver_name, profile_name, add_start_end,
+            slicer_name, slicer_settings, material_name, dualstrusion,
+            progress):
+        '''
+        Returns a task that slices a finished upload. It ends with the size
+        and SHA-256 of the G-code. `progress(upload_id, progress)` is called
+        for each of the slicer's heartbeats.
+
+        '''
+
+        if None is self._executor:
+            raise conveyor.error.NotSliceWorkerException
+        self.expire()
+        driver = self._driver_manager.get_driver(driver_name)
+        profile = driver.get_profile(profile_name)
+        input_path = self._uploads.claim(upload_id)
+        root, ext = os.path.splitext(input_path)
+        output_path = root + '.gcode'
+        if output_path == input_path:
+            output_path = root + '.sliced.gcode'
+        request = conveyor.recipe.SliceRequest(
+            slicer_name, profile, input_path, output_path, add_start_end,
+            slicer_settings, material_name, dualstrusion)
+        slicer_task = conveyor.task.Task()
+        task = conveyor.task.Task()
+        slice_ = _Slice(upload_id, output_path, task)
+        with self._lock:
+            self._slices[upload_id] = slice_
+            self._active += 1
+        def work():
+            try:
+                slicer = self._create_slicer(request, slicer_task)
+            except Exception as e:
+                self._log.exception('unhandled exception; failed to create slicer')
+                failure = conveyor.util.exception_to_failure(e)
+                slicer_task.fail(failure)
+            else:
+                slicer.slice()
+        def running_callback(task):
+            self._log.info(
+                'slicing upload %d with %s', upload_id, slicer_name)
+            self._executor.submit(work, False)
+        slicer_task.runningevent.attach(running_callback)
+        def heartbeat_callback(slicer_task):
+            progress(upload_id, slicer_task.progress)
+        slicer_task.heartbeatevent.attach(heartbeat_callback)
+        def stopped_callback(slicer_task):
+            self._stopped(slice_, slicer_task)
+        slicer_task.stoppedevent.attach(stopped_callback)
+        task.runningevent.attach(lambda task: slicer_task.start())
+        def cancel_callback(task):
+            if not slicer_task.isstopped():
+                slicer_task.cancel()
+        task.cancelevent.attach(cancel_callback)
+        return task
+
+    def _stopped(self, slice_, slicer_task):
+        with self._lock:
+            self._active -= 1
+        if slicer_task.isended():
+            sha256 = hashlib.sha256()
+            size = 0
+            with open(slice_.path, 'rb') as fp:
+                while True:
+                    data = fp.read(65536)
+                    if 0 == len(data):
+                        break
+                    sha256.update(data)
+                    size += len(data)
+            slice_.size = size
+            slice_.sha256 = sha256.hexdigest()
+            slice_.finished = time.time()
+            self._log.info(
+                'sliced upload %d: %d bytes, sha256 %s', slice_.id, size,
+                slice_.sha256)
+            if not slice_.task.isstopped():
+                slice_.task.end({
+                    'id': slice_.id,
+                    'size': slice_.size,
+                    'sha256': slice_.sha256,
+                    'chunk_limit': self._uploads.chunk_limit,
+                })
+        else:
+            self.release(slice_.id)
+            if slice_.task.isstopped():
+                pass
+            elif slicer_task.isfailed():
+                slice_.task.fail(slicer_task.failure)
+            else:
+                slice_.task.cancel()
+
+    def read(self, upload_id, offset, length):
+        '''Returns at most `length` bytes of a slice's G-code from `offset`.'''
+
+        slice_ = self._get(upload_id)
+        if None is slice_.finished:
+            raise conveyor.error.UploadStateException(
+                upload_id, slice_.task.state)
+        length = min(length, self._uploads.chunk_limit)
+        with open(slice_.path, 'rb') as fp:
+            fp.seek(offset)
+            data = fp.read(length)
+        slice_.finished = time.time()
+        return data
+
+    def cancel(self, upload_id):
+        slice_ = self._get(upload_id)
+        if not slice_.task.isstopped():
+            slice_.task.cancel()
+
+    def release(self, upload_id):
+        '''Removes a slice's model and G-code.'''
+
+        with self._lock:
+            self._slices.pop(upload_id, None)
+        self._uploads.release(upload_id)
+
+    def expire(self, now=None):
+        '''Removes the G-code that nobody read for longer than the timeout.'''
+
+        if None is now:
+            now = time.time()
+        with self._lock:
+            expired = [
+                slice_ for slice_ in self._slices.values()
+                if (None is not slice_.finished
+                    and self._timeout < now - slice_.finished)]
+        for slice_ in expired:
+            self._log.info('slice %d expired', slice_.id)
+            self.release(slice_.id)
+
+    def _get(self, upload_id):
+        with self._lock:
+            slice_ = self._slices.get(upload_id)
+        if None is slice_:
+            raise conveyor.error.UnknownUploadError(upload_id)
+        return slice_
+
+
+class WorkerPool(conveyor.stoppable.StoppableInterface):
+    '''The slicing workers that a conveyor service hands its slicers to.'''
+
+    @classmethod
+    def create(cls, config):
+        pool = cls(
+            config.get('server', 'slicer_workers'),
+            config.get('server', 'slicer_worker_retry'),
+            config.get('server', 'slicer_worker_timeout'))
+        return pool
+
+    def __init__(self, addresses, retry, timeout):
+        '''
+        @param addresses the workers' `conveyor.address` addresses by name
+        @param retry the number of seconds before a worker that could not be
+            reached is tried again
+        @param timeout the number of seconds to wait for a worker to answer a
+            request (except for the slice itself)
+        '''
+        conveyor.stoppable.StoppableInterface.__init__(self)
+        self._timeout = timeout
+        self._log = conveyor.log.getlogger(self)
+        self._workers = []
+        for name in sorted(addresses):
+            self._workers.append(
+                _RemoteWorker(name, addresses[name], retry, timeout))
+
+    def stop(self):
+        for worker in self._workers:
+            worker.stop()
+
+    def slice(self, task, request, fallback):
+        '''
+        Slices `request` (a `conveyor.recipe.SliceRequest`) on a worker for
+        the running `task`, or calls `fallback()` to slice it locally.
+
+        '''
+
+        if 0 == len(self._workers):
+            fallback()
+        else:
+            # NOTE: this is called on an event thread; placing the slice means
+            # waiting for the workers.
+            thread = threading.Thread(
+                target=self._slice, args=(task, request, fallback),
+                name='slice_placement')
+            thread.daemon = True
+            thread.start()
+
+    def _slice(self, task, request, fallback):
+        try:
+            worker = self._place()
+            if None is worker:
+                self._log.info('no slicing worker is free; slicing locally')
+                fallback()
+            elif not worker.slice(task, request):
+                if not task.isstopped():
+                    self._log.warning(
+                        'slicing worker %s failed; slicing locally',
+                        worker.name)
+                    fallback()
+        except Exception as e:
+            self._log.exception('unhandled exception; failed to place slice')
+            if not task.isstopped():
+                failure = conveyor.util.exception_to_failure(e)
+                task.fail(failure)
+
+    def _place(self):
+        '''Returns the worker with the lowest share of its slots in use.'''
+
+        # NOTE: the load requests are pipelined so that placing a slice waits
+        # for the slowest worker, not for all of them in turn.
+        loads = []
+        for worker in self._workers:
+            future = worker.get_load()
+            if None is not future:
+                loads.append((worker, future))
+        result = None
+        best = None
+        for worker, future in loads:
+            try:
+                load = future.result(self._timeout)
+            except (conveyor.error.RequestFailedException,
+                    conveyor.error.RequestTimeoutException):
+                self._log.debug('handled exception', exc_info=True)
+            else:
+                slots = load['slots']
+                active = load['active']
+                if active < slots:
+                    key = (float(active) / slots, -slots)
+                    if None is best or key < best:
+                        result = worker
+                        best = key
+        return result
+
+
+class _RemoteWorker(object):
+    '''A slicing worker; its connection is opened whenever it is needed.'''
+
+    def __init__(self, name, address, retry, timeout):
+        self.name = name
+        self._address = address
+        self._retry = retry
+        self._timeout = timeout
+        self._log = conveyor.log.getlogger(self)
+        self._lock = threading.Lock()
+        self._session = None
+        self._retry_time = 0.0
+        self._tasks = {}
+
+    def stop(self):
+        with self._lock:
+            session = self._session
+            self._session = None
+            self._retry_time = float('inf')
+        if None is not session:
+            session.close()
+
+    def _get_session(self):
+        with self._lock:
+            session = self._session
+            if None is not session and session.wait(0):
+                session = None
+            if None is session and self._retry_time <= time.time():
+                try:
+                    session = conveyor.client.session.Session.connect(
+                        self._address, timeout=self._timeout)
+                except Exception:
+                    self._log.warning(
+                        'failed to connect to slicing worker %s', self.name,
+                        exc_info=True)
+                    self._retry_time = time.time() + self._retry
+                else:
+                    session.addmethod('sliceprogress', self._sliceprogress)
+            self._session = session
+        return session
+
+    def get_load(self):
+        '''Returns a `Future` for the worker's load or None.'''
+
+        session = self._get_session()
+        if None is session:
+            future = None
+        else:
+            future = session.request('getworker')
+        return future
+
+    def _sliceprogress(self, *args, **kwargs):
+        with self._lock:
+            task = self._tasks.get(kwargs['id'])
+        if None is not task and task.isrunning():
+            task.lazy_heartbeat(kwargs['progress'], task.progress)
+
+    def slice(self, task, request):
+        '''
+        Slices `request` for `task` on the worker. Returns whether or not the
+        task was taken care of; if not the worker failed and the slicer must
+        run elsewhere.
+
+        '''
+
+        session = self._get_session()
+        if None is session:
+            return False
+        try:
+            with open(request.input_path, 'rb') as fp:
+                upload = session.upload(
+                    fp, os.path.basename(request.input_path),
+                    timeout=self._timeout)
+        except (IOError, conveyor.error.RequestFailedException,
+                conveyor.error.RequestTimeoutException):
+            self._log.warning(
+                'failed to upload to slicing worker %s', self.name,
+                exc_info=True)
+            return False
+        upload_id = upload['id']
+        with self._lock:
+            self._tasks[upload_id] = task
+        def cancel_callback(task):
+            session.request('cancelslice', {'id': upload_id})
+        task.cancelevent.attach(cancel_callback)
+        try:
+            if task.isstopped():
+                return True
+            self._log.info(
+                'slicing %s on slicing worker %s', request.input_path,
+                self.name)
+            future = session.request('workerslice', {
+                'id': upload_id,
+                'driver_name': request.profile.driver.name,
+                'profile_name': request.profile.name,
+                'add_start_end': request.add_start_end,
+                'slicer_name': request.slicer_name,
+                'slicer_settings': request.slicer_settings.todict(),
+                'material_name': request.material_name,
+                'dualstrusion': request.dualstrusion,
+            })
+            try:
+                # NOTE: there is no time limit on the slice itself; the future
+                # fails if the connection goes away.
+                result = future.result()
+            except conveyor.error.RequestFailedException as e:
+                failure = e.failure
+                if task.isstopped():
+                    return True
+                elif isinstance(failure, dict) and -32001 == failure.get('code'):
+                    # NOTE: the slicer failed; it would fail here too.
+                    task.fail(failure.get('data'))
+                    return True
+                else:
+                    self._log.debug('handled exception', exc_info=True)
+                    return False
+            try:
+                self._download(session, result, request.output_path)
+            except (IOError, conveyor.error.RequestFailedException,
+                    conveyor.error.RequestTimeoutException):
+                self._log.warning(
+                    'failed to read the G-code from slicing worker %s',
+                    self.name, exc_info=True)
+                return False
+            if not task.isstopped():
+                task.end(None)
+            return True
+        finally:
+            with self._lock:
+                self._tasks.pop(upload_id, None)
+            session.request('releaseslice', {'id': upload_id})
+
+    def _download(self, session, result, path):
+        chunk_limit = result['chunk_limit']
+        size = result['size']
+        sha256 = hashlib.sha256()
+        pending = collections.deque()
+        offset = 0
+        with open(path, 'wb') as fp:
+            while offset < size or 0 != len(pending):
+                while offset < size and _READ_WINDOW > len(pending):
+                    length = min(chunk_limit, size - offset)
+                    pending.append(session.request('readslice', {
+                        'id': result['id'],
+                        'offset': offset,
+                        'length': length,
+                    }))
+                    offset += length
+                data = base64.b64decode(
+                    pending.popleft().result(self._timeout))
+                sha256.update(data)
+                fp.write(data)
+        if sha256.hexdigest() != result['sha256']:
+            raise conveyor.error.RequestFailedException('corrupt G-code')
+
+
+class _DriverManager(object):
+    class _Driver(object):
+        name = 's3g'
+
+        def get_profile(self, profile_name):
+            import conveyor.machine
+            profile = conveyor.machine.Profile(
+                profile_name, self, 1, 1, 1, True, True, False, 1)
+            return profile
+
+    def get_driver(self, driver_name):
+        return self._Driver()
+
+
+class _Slicer(object):
+    '''A stand-in for a slicer that writes a few lines of G-code.'''
+
+    def __init__(self, request, task):
+        self._request = request
+        self._task = task
+
+    def slice(self):
+        with open(self._request.input_path, 'rb') as fp:
+            data = fp.read()
+        if b'fail' == data:
+            self._task.fail('slicer failed')
+        else:
+            self._task.heartbeat({'name': 'slice', 'progress': 50})
+            with open(self._request.output_path, 'wb') as fp:
+                fp.write(b'; sliced with ')
+                fp.write(self._request.slicer_name.encode('utf-8'))
+                fp.write(b'\nG1 X0 Y0 Z0\n' * 1000)
+            self._task.end(None)
+
+
+class _Daemon(object):
+    '''A stand-in for a slicing worker: a JSON-RPC peer on a local TCP port.'''
+
+    def __init__(self, slots):
+        import socket
+        import conveyor.upload
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(1)
+        self.port = self._socket.getsockname()[1]
+        self.uploads = conveyor.upload.UploadManager.create(
+            '', 1 << 20, 256, 60.0)
+        self.worker = SliceWorker(
+            None, _DriverManager(), self.uploads, slots, 60.0, _Slicer)
+        self.jsonrpc = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        import conveyor.connection
+        import conveyor.domain
+        import conveyor.jsonrpc
+        sock, addr = self._socket.accept()
+        connection = conveyor.connection.SocketConnection(sock, None)
+        jsonrpc = conveyor.jsonrpc.JsonRpc(connection, connection)
+        self.jsonrpc = jsonrpc
+        def upload_result(dct):
+            dct['chunk_limit'] = self.uploads.chunk_limit
+            dct['window'] = 4 * self.uploads.chunk_limit
+            return dct
+        def workerslice(
+                id, driver_name, profile_name, add_start_end, slicer_name,
+                slicer_settings, material_name, dualstrusion):
+            return self.worker.slice(
+                id, driver_name, profile_name, add_start_end, slicer_name,
+                conveyor.domain.SlicerConfiguration.fromdict(slicer_settings),
+                material_name, dualstrusion,
+                lambda id, progress: jsonrpc.notify(
+                    'sliceprogress', {'id': id, 'progress': progress}))
+        for method, func in (
+                ('hello', lambda framing=None, codec=(), compression=():
+                    jsonrpc.negotiate(framing, codec, compression)),
+                ('beginupload', lambda name:
+                    upload_result(self.uploads.begin(name).to_dict())),
+                ('uploadchunk', lambda id, offset, data:
+                    self.uploads.write(id, offset, base64.b64decode(data))),
+                ('finishupload', lambda id: self.uploads.finish(id)),
+                ('getworker', self.worker.get_load),
+                ('workerslice', workerslice),
+                ('readslice', lambda id, offset, length:
+                    base64.b64encode(self.worker.read(id, offset, length))),
+                ('cancelslice', lambda id: self.worker.cancel(id)),
+                ('releaseslice', lambda id: self.worker.release(id))):
+            jsonrpc.addmethod(method, func)
+        jsonrpc.run()
+
+    def close(self):
+        if None is not self.jsonrpc:
+            self.jsonrpc.stop()
+        self._socket.close()
+        self.worker.stop()
+        self.uploads.close()
+
+
+class _WorkerPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        import conveyor.address
+        import conveyor.domain
+        import conveyor.event
+        import conveyor.slicer
+        import shutil
+        import tempfile
+        # NOTE: everything that can fail comes before the threads start and
+        # each thread is stopped by a cleanup, even when setUp fails.
+        slicer_settings = conveyor.domain.SlicerConfiguration(
+            conveyor.slicer.Slicer.MIRACLEGRUE, '0', False, False, 0.1, 0.27,
+            2, 230, 110, 80, 100)
+        profile = _DriverManager().get_driver('s3g').get_profile('Replicator2')
+        self._directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._directory, True)
+        self._input_path = os.path.join(self._directory, 'bunny.stl')
+        self._output_path = os.path.join(self._directory, 'bunny.gcode')
+        self._request = conveyor.recipe.SliceRequest(
+            'miraclegrue', profile, self._input_path, self._output_path,
+            False, slicer_settings, 'PLA', False)
+        self._eventthread = conveyor.event.EventQueueThread(
+            conveyor.event.geteventqueue(), 'worker_event_thread')
+        self._eventthread.start()
+        self.addCleanup(self._eventthread.join, 5.0)
+        self.addCleanup(self._eventthread.stop)
+        self._daemons = {}
+        for name, index in (('a', 0), ('b', 1)):
+            self._daemons[name] = _Daemon(index)
+            self.addCleanup(self._daemons[name].close)
+        addresses = dict(
+            (name, conveyor.address.Address.address_factory(
+                'tcp:127.0.0.1:%d' % (daemon.port,)))
+            for name, daemon in self._daemons.items())
+        self._pool = WorkerPool(addresses, 60.0, 5.0)
+        self.addCleanup(self._pool.stop)
+
+    def _slice(self, data):
+        with open(self._input_path, 'wb') as fp:
+            fp.write(data)
+        task = conveyor.task.Task()
+        fallback = threading.Event()
+        stopped = threading.Event()
+        heartbeats = []
+        task.heartbeatevent.attach(
+            lambda task: heartbeats.append(task.progress))
+        task.stoppedevent.attach(lambda task: stopped.set())
+        task.runningevent.attach(
+            lambda task: self._pool.slice(task, self._request, fallback.set))
+        task.start()
+        for i in range(50):
+            if stopped.is_set() or fallback.is_set():
+                break
+            time.sleep(0.1)
+        return task, fallback.is_set(), heartbeats
+
+    def test_slice(self):
+        '''Test that a slice runs on the worker with a free slot.'''
+
+        task, fallback, heartbeats = self._slice(b'solid bunny\n' * 100)
+        self.assertFalse(fallback)
+        self.assertTrue(task.isended())
+        self.assertIn({'name': 'slice', 'progress': 50}, heartbeats)
+        with open(self._output_path, 'rb') as fp:
+            data = fp.read()
+        self.assertEqual(
+            b'; sliced with miraclegrue' + b'\nG1 X0 Y0 Z0\n' * 1000, data)
+        self.assertEqual(
+            {'slots': 1, 'active': 0}, self._daemons['b'].worker.get_load())
+        for i in range(50):
+            if 0 == len(self._daemons['b'].uploads._uploads):
+                break
+            time.sleep(0.1)
+        self.assertEqual({}, self._daemons['b'].uploads._uploads)
+
+    def test_slice_failed(self):
+        '''Test that a slicer that fails on a worker fails the task.'''
+
+        task, fallback, heartbeats = self._slice(b'fail')
+        self.assertFalse(fallback)
+        self.assertTrue(task.isfailed())
+        self.assertEqual('slicer failed', task.failure)
+
+    def test_slice_fallback(self):
+        '''Test that the slicer runs locally when no worker is free.'''
+
+        self._daemons['b'].worker._active = 1
+        task, fallback, heartbeats = self._slice(b'solid bunny\n')
+        self.assertTrue(fallback)
+        self.assertTrue(task.isrunning())
+        self._daemons['b'].worker._active = 0
+        self._daemons['b'].close()
+        task, fallback, heartbeats = self._slice(b'solid bunny\n')
+        self.assertTrue(fallback)
@@ -0,0 +1,115 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/test/python/benchmark_broadcast.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A benchmark for the cost of sending a notification to many clients.
+
+It compares calling `JsonRpc.notify` once for every client (which encodes the
+notification once for every client) against encoding it once as a
+`conveyor.jsonrpc.Notification` and handing it to every client with
+`JsonRpc.sendnotification`.
+
+    $ PYTHONPATH=src/main/python python src/test/python/benchmark_broadcast.py
+
+'''
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import argparse
+import sys
+import time
+
+import conveyor.jsonrpc
+
+
+class _NullWriter(object):
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data, key=None):
+        self.size += len(data)
+
+    def flush(self):
+        pass
+
+
+def _create_params():
+    params = {
+        'type': 'PRINT_TO_FILE_JOB', 'id': 17, 'name': 'bunny',
+        'state': 'RUNNING',
+        'progress': {'name': 'print-to-file', 'progress': 42},
+        'conclusion': None, 'failure': None, 'machine_name': None,
+        'port_name': None, 'driver_name': 's3g',
+        'profile_name': 'Replicator2',
+    }
+    return params
+
+
+def _notify(jsonrpcs, params):
+    for jsonrpc in jsonrpcs:
+        jsonrpc.notify('jobchanged', params)
+
+
+def _sendnotification(jsonrpcs, params):
+    notification = conveyor.jsonrpc.Notification('jobchanged', params)
+    for jsonrpc in jsonrpcs:
+        jsonrpc.sendnotification(notification)
+
+
+def _run(func, clients, count):
+    writers = [_NullWriter() for i in range(clients)]
+    jsonrpcs = [conveyor.jsonrpc.JsonRpc(None, writer) for writer in writers]
+    params = _create_params()
+    start = time.time()
+    for i in range(count):
+        params['progress']['progress'] = i
+        func(jsonrpcs, params)
+    elapsed = time.time() - start
+    size = sum(writer.size for writer in writers)
+    return elapsed, size
+
+
+def _main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--notifications', type=int, default=1000)
+    parser.add_argument(
+        '--clients', type=int, nargs='+', default=[1, 10, 50, 100])
+    parsedargs = parser.parse_args(argv[1:])
+    print('%d notifications' % (parsedargs.notifications,))
+    print('%7s %12s %12s %8s' % ('clients', 'notify', 'broadcast', 'speedup'))
+    for clients in parsedargs.clients:
+        results = []
+        for func in (_notify, _sendnotification):
+            elapsed, size = _run(func, clients, parsedargs.notifications)
+            results.append((elapsed, size))
+        if results[0][1] != results[1][1]:
+            print('%d clients: the notifications differ' % (clients,))
+            return 1
+        print('%7d %10.1f us %10.1f us %7.1fx' % (
+            clients,
+            1e6 * results[0][0] / parsedargs.notifications,
+            1e6 * results[1][0] / parsedargs.notifications,
+            results[0][0] / results[1][0]))
+    return 0
+
+if '__main__' == __name__:
+    code = _main(sys.argv)
+    if None is code:
+        code = 0
+    sys.exit(code)
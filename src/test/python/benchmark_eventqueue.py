@@ -0,0 +1,150 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/test/python/benchmark_eventqueue.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A benchmark for `conveyor.event.EventQueue` with different numbers of event
+threads.
+
+It measures the throughput (events delivered per second while one thread
+fires them as fast as it can) and the wakeup latency (the time from firing an
+event at an idle queue until its handler runs). The cancel latency is the time
+until a control event is delivered while a backlog of telemetry events is
+waiting.
+
+    $ PYTHONPATH=src/main/python python src/test/python/benchmark_eventqueue.py
+
+'''
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import argparse
+import sys
+import threading
+import time
+
+import conveyor.event
+
+
+def _start(threads):
+    eventqueue = conveyor.event.EventQueue()
+    eventthreads = [
+        conveyor.event.EventQueueThread(eventqueue, 'event_thread_%d' % (i,))
+        for i in range(threads)]
+    for eventthread in eventthreads:
+        eventthread.daemon = True
+        eventthread.start()
+    return eventqueue, eventthreads
+
+
+def _stop(eventthreads):
+    for eventthread in eventthreads:
+        eventthread.stop()
+    for eventthread in eventthreads:
+        eventthread.join(5.0)
+
+
+def _throughput(threads, count):
+    eventqueue, eventthreads = _start(threads)
+    lock = threading.Lock()
+    delivered = [0]
+    done = threading.Event()
+    def callback():
+        with lock:
+            delivered[0] += 1
+            if count == delivered[0]:
+                done.set()
+    event = conveyor.event.Event('benchmark', eventqueue)
+    event.attach(callback)
+    start = time.time()
+    for i in range(count):
+        event()
+    done.wait()
+    elapsed = time.time() - start
+    _stop(eventthreads)
+    return count / elapsed
+
+
+def _latency(threads, count):
+    eventqueue, eventthreads = _start(threads)
+    latencies = []
+    delivered = threading.Event()
+    def callback(fired):
+        latencies.append(time.time() - fired)
+        delivered.set()
+    event = conveyor.event.Event('benchmark', eventqueue)
+    event.attach(callback)
+    for i in range(count):
+        # NOTE: give the event threads time to go back to waiting.
+        time.sleep(0.001)
+        delivered.clear()
+        event(time.time())
+        delivered.wait()
+    _stop(eventthreads)
+    latencies.sort()
+    mean = sum(latencies) / len(latencies)
+    p99 = latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))]
+    return mean, p99
+
+
+def _cancel_latency(threads, backlog):
+    eventqueue, eventthreads = _start(threads)
+    gate = threading.Event()
+    telemetry = conveyor.event.Event(
+        'telemetry', eventqueue, conveyor.event.EventPriority.TELEMETRY)
+    telemetry.attach(lambda: gate.wait())
+    delivered = threading.Event()
+    cancel = conveyor.event.Event(
+        'cancel', eventqueue, conveyor.event.EventPriority.CONTROL)
+    cancel.attach(delivered.set)
+    # NOTE: the event threads wait at the gate while the backlog is queued.
+    for i in range(backlog):
+        telemetry()
+    time.sleep(0.1)
+    fired = time.time()
+    cancel()
+    gate.set()
+    delivered.wait()
+    latency = time.time() - fired
+    _stop(eventthreads)
+    return latency
+
+def _main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--wakeups', type=int, default=1000)
+    parser.add_argument('--backlog', type=int, default=100000)
+    parser.add_argument(
+        '--threads', type=int, nargs='+', default=[1, 4, 16])
+    parsedargs = parser.parse_args(argv[1:])
+    print('%d events, %d wakeups' % (parsedargs.events, parsedargs.wakeups))
+    print('%7s %14s %13s %13s %15s' % (
+        'threads', 'events/s', 'latency', 'p99 latency', 'cancel latency'))
+    for threads in parsedargs.threads:
+        rate = _throughput(threads, parsedargs.events)
+        mean, p99 = _latency(threads, parsedargs.wakeups)
+        cancel = _cancel_latency(threads, parsedargs.backlog)
+        print('%7d %14.0f %10.1f us %10.1f us %12.1f us' % (
+            threads, rate, 1e6 * mean, 1e6 * p99, 1e6 * cancel))
+    return 0
+
+if '__main__' == __name__:
+    code = _main(sys.argv)
+    if None is code:
+        code = 0
+    sys.exit(code)
@@ -0,0 +1,121 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/test/python/benchmark_jsonreader.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A throughput benchmark for `conveyor.json.JsonReader`.
+
+It compares the chunk-scanning `feed` against the per-character state machine
+(`_consume` called once per character, which is how `feed` used to work) on a
+stream of JSON-RPC traffic that resembles what the conveyor service sees while
+clients poll `getjobs` and `getprinters` during a print.
+
+    $ PYTHONPATH=src/main/python python src/test/python/benchmark_jsonreader.py
+
+'''
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import argparse
+import sys
+import time
+
+import conveyor.json
+
+
+class _CharacterJsonReader(conveyor.json.JsonReader):
+    '''The previous `feed` implementation.'''
+
+    def feed(self, data):
+        for ch in data:
+            self._consume(ch)
+
+
+def _create_stream(count):
+    job = {
+        'type': 'PRINT_TO_FILE_JOB', 'id': 17, 'name': 'bunny',
+        'state': 'RUNNING',
+        'progress': {'name': 'print-to-file', 'progress': 42},
+        'conclusion': None, 'failure': None, 'machine_name': None,
+        'port_name': None, 'driver_name': 's3g',
+        'profile_name': 'Replicator2',
+    }
+    printer = {
+        'name': '23C1D3A5F6E38EB2', 'display_name': 'The Replicator 2',
+        'state': 'IDLE', 'driver_name': 's3g',
+        'profile_name': 'Replicator2', 'can_print': True,
+        'build_volume': [285, 153, 155],
+        'temperature': {'tools': {'0': 215}, 'heated_platforms': {}},
+        'machine_names': ['The Replicator 2'],
+    }
+    messages = [
+        {'jsonrpc': '2.0', 'method': 'jobchanged', 'params': job},
+        {'jsonrpc': '2.0', 'result': {'17': job, '18': job}, 'id': 3},
+        {'jsonrpc': '2.0', 'result': [printer, printer], 'id': 4},
+        {'jsonrpc': '2.0', 'method': 'getjobs', 'params': {}, 'id': 5},
+    ]
+    texts = [conveyor.json.dumps(message) for message in messages]
+    stream = ''.join(texts[i % len(texts)] for i in range(count))
+    return stream
+
+
+def _run(reader_class, stream, chunk_size, strip_comments):
+    count = [0]
+    def callback(data):
+        count[0] += 1
+    reader = reader_class(callback, strip_comments)
+    start = time.time()
+    for i in range(0, len(stream), chunk_size):
+        reader.feed(stream[i:i + chunk_size])
+    reader.feedeof()
+    elapsed = time.time() - start
+    return count[0], elapsed
+
+
+def _main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--chunk-size', type=int, default=4096)
+    parser.add_argument('--strip-comments', action='store_true')
+    parsedargs = parser.parse_args(argv[1:])
+    stream = _create_stream(parsedargs.messages)
+    size = len(stream.encode('utf-8'))
+    print('%d messages, %d bytes, %d byte chunks' % (
+        parsedargs.messages, size, parsedargs.chunk_size))
+    results = []
+    for name, reader_class in (
+            ('per-character', _CharacterJsonReader),
+            ('chunk-scanning', conveyor.json.JsonReader)):
+        count, elapsed = _run(
+            reader_class, stream, parsedargs.chunk_size,
+            parsedargs.strip_comments)
+        if count != parsedargs.messages:
+            print('%s: expected %d messages, got %d' % (
+                name, parsedargs.messages, count))
+            return 1
+        results.append(elapsed)
+        print('%-15s %8.3f s %10.0f messages/s %8.2f MB/s' % (
+            name, elapsed, count / elapsed, size / elapsed / 1e6))
+    print('speedup: %.1fx' % (results[0] / results[1],))
+    return 0
+
+if '__main__' == __name__:
+    code = _main(sys.argv)
+    if None is code:
+        code = 0
+    sys.exit(code)
@@ -0,0 +1,103 @@
+# vim:ai:et:ff=unix:fileencoding=utf-8:sw=4:ts=4:
+# conveyor/src/test/python/benchmark_task.py
+#
+# conveyor - Printing dispatch engine for 3D objects and their friends.
+# Copyright © 2012 Matthew W. Samsonoff <matthew.samsonoff@makerbot.com>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+A benchmark for `conveyor.task.Task`.
+
+It measures how many tasks per second are created and run through start, a
+number of heartbeats, and end, first with no handlers and then with a
+stoppedevent handler (as `conveyor.process` attaches), and how many objects
+the garbage collector tracks for each task that is kept.
+
+    $ PYTHONPATH=src/main/python python src/test/python/benchmark_task.py
+
+'''
+
+from __future__ import (absolute_import, print_function, unicode_literals)
+
+import argparse
+import gc
+import sys
+import time
+
+import conveyor.event
+import conveyor.task
+
+
+def _drain(eventqueue):
+    while eventqueue.runiteration(False):
+        pass
+
+
+def _run(count, heartbeats, handler):
+    eventqueue = conveyor.event.EventQueue()
+    progress = {'name': 'benchmark', 'progress': 0}
+    def callback(task):
+        pass
+    start = time.time()
+    for i in range(count):
+        task = conveyor.task.Task(eventqueue)
+        if handler:
+            task.stoppedevent.attach(callback)
+        task.start()
+        for j in range(heartbeats):
+            task.heartbeat(progress)
+        task.end(None)
+        _drain(eventqueue)
+    elapsed = time.time() - start
+    return count / elapsed
+
+
+def _objects(count, handler):
+    eventqueue = conveyor.event.EventQueue()
+    def callback(task):
+        pass
+    gc.collect()
+    before = len(gc.get_objects())
+    tasks = []
+    for i in range(count):
+        task = conveyor.task.Task(eventqueue)
+        if handler:
+            task.stoppedevent.attach(callback)
+        tasks.append(task)
+    gc.collect()
+    after = len(gc.get_objects())
+    return (after - before - 1) / float(count)
+
+
+def _main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tasks', type=int, default=20000)
+    parser.add_argument('--heartbeats', type=int, default=10)
+    parsedargs = parser.parse_args(argv[1:])
+    print('%d tasks, %d heartbeats each' % (
+        parsedargs.tasks, parsedargs.heartbeats))
+    print('%8s %12s %16s' % ('handlers', 'tasks/s', 'objects/task'))
+    for handler in (False, True):
+        rate = _run(parsedargs.tasks, parsedargs.heartbeats, handler)
+        objects = _objects(parsedargs.tasks, handler)
+        print('%8s %12.0f %16.1f' % (
+            'stopped' if handler else 'none', rate, objects))
+    return 0
+
+if '__main__' == __name__:
+    code = _main(sys.argv)
+    if None is code:
+        code = 0
+    sys.exit(code)
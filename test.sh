@@ -4,16 +4,26 @@
 
 _modules='
 	conveyor
+	conveyor.binary
 	conveyor.client
+	conveyor.client.session
+	conveyor.connection
 	conveyor.debug
+	conveyor.embed
 	conveyor.enum
 	conveyor.event
+	conveyor.executor
+	conveyor.federation
 	conveyor.ipc
+	conveyor.jobstore
+	conveyor.json
 	conveyor.jsonrpc
 	conveyor.log
 	conveyor.main
 	conveyor.process
+	conveyor.reactor
 	conveyor.recipe
+	conveyor.scheduler
 	conveyor.server
 	conveyor.stoppable
 	conveyor.task
@@ -21,7 +31,9 @@ _modules='
 	conveyor.thing
 	conveyor.toolpath
 	conveyor.toolpath.skeinforge
+	conveyor.upload
 	conveyor.visitor
+	conveyor.worker
 '
 
 if [ ! -d obj/ ]